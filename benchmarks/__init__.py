@@ -0,0 +1,7 @@
+"""
+Performance benchmarks for Trio JSON-RPC.
+
+These are not unit tests: they are excluded from the test suite and are meant to be run
+by hand or in CI, e.g. ``python -m benchmarks --compare baseline.json``. Run ``python -m
+benchmarks --help`` for details.
+"""
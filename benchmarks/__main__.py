@@ -0,0 +1,107 @@
+"""
+Run the benchmark suite.
+
+    $ python -m benchmarks --save baseline.json
+    $ python -m benchmarks --compare baseline.json --threshold 0.1
+
+The process exits with a non-zero status if any benchmark regresses past the threshold
+relative to the baseline.
+"""
+import argparse
+import fnmatch
+import logging
+import sys
+
+import trio
+
+from . import cases  # noqa: F401 (registers the benchmarks)
+from .harness import (
+    BENCHMARKS,
+    compare,
+    format_header,
+    format_result,
+    load_results,
+    run_benchmark,
+    save_results,
+)
+
+
+async def main(args):
+    names = [
+        name
+        for name in BENCHMARKS
+        if not args.filter or any(fnmatch.fnmatch(name, f) for f in args.filter)
+    ]
+    if args.list:
+        print("\n".join(names))
+        return 0
+
+    print(format_header())
+    results = list()
+    for name in names:
+        result = await run_benchmark(name, args.duration)
+        print(format_result(result), flush=True)
+        results.append(result)
+
+    if args.save:
+        save_results(args.save, results)
+        print(f"Saved results to {args.save}")
+
+    if args.compare:
+        regressions = compare(
+            load_results(args.compare),
+            results,
+            args.threshold,
+            args.latency_threshold,
+        )
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) compared to {args.compare}:")
+            for regression in regressions:
+                print("  " + regression)
+            return 1
+        print(f"\nNo regressions compared to {args.compare}.")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Trio JSON-RPC Benchmarks")
+    parser.add_argument(
+        "filter",
+        nargs="*",
+        help="Only run benchmarks matching these glob patterns, e.g. 'memory/*'",
+    )
+    parser.add_argument(
+        "--list", action="store_true", help="List benchmarks and exit"
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=1.0,
+        help="Seconds to run each benchmark (default: 1.0)",
+    )
+    parser.add_argument("--save", metavar="PATH", help="Save results to a JSON file")
+    parser.add_argument(
+        "--compare", metavar="PATH", help="Compare results to a saved baseline"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Maximum allowed throughput drop as a fraction (default: 0.1)",
+    )
+    parser.add_argument(
+        "--latency-threshold",
+        type=float,
+        default=0.25,
+        help="Maximum allowed p99 latency increase as a fraction (default: 0.25)",
+    )
+    parser.add_argument(
+        "--log-level",
+        default="warning",
+        metavar="LEVEL",
+        choices=["debug", "info", "warning", "error", "critical"],
+        help="Set logging verbosity (default: warning)",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+    sys.exit(trio.run(main, args))
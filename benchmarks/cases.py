@@ -0,0 +1,329 @@
+"""
+Benchmark cases.
+
+Each transport is benchmarked with a client and a ``Dispatch``-based server running in
+the same process, so that the numbers reflect the overhead of this library rather than
+network conditions. The ``inprocess`` transports pass message objects instead of bytes,
+so the difference between ``memory`` and ``inprocess`` is the cost of JSON
+serialization. The ``direct`` transports bind the server connection to the dispatch,
+so the difference between ``memory`` and ``memory-direct`` is the cost of the channel
+between the background task and ``iter_requests()``. The ``pool`` transports are direct,
+but run handlers on a ``WorkerPool`` instead of starting a task for each request. The
+``capture`` transport records every frame on the server to a capture file.
+"""
+from contextlib import asynccontextmanager
+from functools import partial
+import json
+import tempfile
+import typing
+
+from sansio_jsonrpc import JsonRpcRequest
+import trio
+from trio_jsonrpc import (
+    Dispatch,
+    JsonRpcConnection,
+    JsonRpcConnectionType,
+    JsonRpcException,
+    RawJson,
+    open_jsonrpc_inprocess,
+    open_jsonrpc_shm,
+    open_jsonrpc_ws,
+    WorkerPool,
+)
+from trio_jsonrpc.main import jsonrpc_client
+from trio_jsonrpc.transport.capture import CaptureFile
+from trio_jsonrpc.transport.memory import MemoryTransport
+from trio_jsonrpc.transport.shm import SharedMemoryTransport
+from trio_jsonrpc.transport.ws import WebSocketTransport
+import trio_websocket
+
+from .harness import benchmark
+
+
+BATCH_SIZES = (1, 10, 100)
+PAYLOAD_SIZES = (64, 4096, 65536)
+
+
+async def echo(value):
+    return value
+
+
+async def ping():
+    return True
+
+
+def ping_inline():
+    return True
+
+
+# A document of about 55KB, like a record read from a cache, as an object and as JSON.
+DOCUMENT = {
+    "items": [
+        {"id": n, "name": f"item-{n}", "tags": ["a", "b"], "price": n * 0.5}
+        for n in range(800)
+    ]
+}
+DOCUMENT_JSON = RawJson(json.dumps(DOCUMENT))
+
+
+async def document():
+    return DOCUMENT
+
+
+async def document_raw():
+    return DOCUMENT_JSON
+
+
+dispatch = Dispatch()
+dispatch.handler(echo)
+dispatch.handler(ping)
+dispatch.handler(ping_inline, inline=True)
+dispatch.handler(document)
+dispatch.handler(document_raw)
+
+
+async def serve(rpc_conn: JsonRpcConnection, dispatch: Dispatch) -> None:
+    """
+    Serve requests on a connection until it closes. If the connection is bound to the
+    dispatch, its background task does all of the work.
+    """
+    if rpc_conn._dispatch is not None:
+        await rpc_conn._background_task()
+        return
+
+    async def responder(recv_channel):
+        async for request, result in recv_channel:
+            if request.is_notification:
+                continue
+            if isinstance(result, JsonRpcException):
+                await rpc_conn.respond_with_error(request, result.get_error())
+            else:
+                await rpc_conn.respond_with_result(request, result)
+
+    result_send, result_recv = trio.open_memory_channel(100)
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(rpc_conn._background_task)
+        nursery.start_soon(responder, result_recv)
+        async for request in rpc_conn.iter_requests():
+            nursery.start_soon(dispatch.handle_request, request, result_send)
+        nursery.cancel_scope.cancel()
+
+
+def server_connection(
+    transport, direct: bool, executor: typing.Optional[WorkerPool] = None
+) -> JsonRpcConnection:
+    """
+    Create a server connection, bound to the dispatch if ``direct`` is True, that
+    submits requests to ``executor`` if it is set.
+    """
+    return JsonRpcConnection(
+        transport,
+        JsonRpcConnectionType.SERVER,
+        dispatch=dispatch if direct else None,
+        executor=executor,
+    )
+
+
+@asynccontextmanager
+async def memory_client(
+    direct: bool = False, pool: bool = False, capture: bool = False
+) -> typing.AsyncIterator[JsonRpcConnection]:
+    """ Connect a client to the benchmark server using in-memory transport. """
+    client_send, server_recv = trio.open_memory_channel(0)
+    server_send, client_recv = trio.open_memory_channel(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        async with trio.open_nursery() as nursery:
+            executor = None
+            if pool:
+                executor = WorkerPool(dispatch, min_workers=16, max_workers=256)
+                await nursery.start(executor.run)
+            transport = MemoryTransport(server_send, server_recv)
+            if capture:
+                capture_file = CaptureFile(f"{tmp}/benchmark.cap")
+                transport = capture_file.wrap(transport)
+            server = server_connection(transport, direct or pool, executor)
+            nursery.start_soon(serve, server, dispatch)
+            client = jsonrpc_client(MemoryTransport(client_send, client_recv), nursery)
+            yield client
+            nursery.cancel_scope.cancel()
+        if capture:
+            capture_file.close()
+
+
+@asynccontextmanager
+async def ws_client(
+    direct: bool = False, **kwargs
+) -> typing.AsyncIterator[JsonRpcConnection]:
+    """
+    Connect a client to the benchmark server using WebSocket over localhost. Keyword
+    arguments are passed to the client connection.
+    """
+
+    async def connection_handler(ws_request):
+        ws = await ws_request.accept()
+        transport = WebSocketTransport(ws)
+        await serve(server_connection(transport, direct), dispatch)
+
+    async with trio.open_nursery() as nursery:
+        server = await nursery.start(
+            trio_websocket.serve_websocket, connection_handler, "127.0.0.1", 0, None
+        )
+        async with open_jsonrpc_ws(f"ws://127.0.0.1:{server.port}", **kwargs) as client:
+            yield client
+        nursery.cancel_scope.cancel()
+
+
+@asynccontextmanager
+async def shm_client() -> typing.AsyncIterator[JsonRpcConnection]:
+    """
+    Connect a client to the benchmark server using shared memory. Both ends run in this
+    process, but they only communicate through the shared ring buffers, exactly as
+    they would between two processes. Compare to ``ws`` to see the cost of a socket.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        transport = SharedMemoryTransport.create(f"{tmp}/benchmark")
+        try:
+            async with trio.open_nursery() as nursery:
+                server = JsonRpcConnection(transport, JsonRpcConnectionType.SERVER)
+                nursery.start_soon(serve, server, dispatch)
+                async with open_jsonrpc_shm(f"{tmp}/benchmark") as client:
+                    yield client
+                nursery.cancel_scope.cancel()
+        finally:
+            transport.close()
+
+
+def inprocess_client(copy: bool):
+    """
+    Connect a client to the benchmark server by passing objects, which skips JSON
+    serialization. Compare to ``memory`` to see the cost of serialization.
+    """
+    return lambda: open_jsonrpc_inprocess(dispatch, copy=copy)
+
+
+TRANSPORTS = {
+    "memory": memory_client,
+    "memory-direct": partial(memory_client, direct=True),
+    "memory-pool": partial(memory_client, pool=True),
+    "memory-capture": partial(memory_client, capture=True),
+    "inprocess": inprocess_client(copy=False),
+    "inprocess-copy": inprocess_client(copy=True),
+    "shm": shm_client,
+    "ws": ws_client,
+    "ws-batch": partial(ws_client, batch_delay=0.0005),
+    "ws-direct": partial(ws_client, direct=True),
+}
+
+
+def register_transport_benchmarks(transport: str, open_client) -> None:
+    """ Register the benchmarks that run against a client/server pair. """
+
+    @benchmark(f"{transport}/request")
+    async def request_roundtrip():
+        async with open_client() as client:
+
+            async def operation():
+                await client.request("ping")
+                return 1
+
+            yield operation
+
+    @benchmark(f"{transport}/request-inline")
+    async def request_inline():
+        """ Only bound connections run inline handlers without starting a task. """
+        async with open_client() as client:
+
+            async def operation():
+                await client.request("ping_inline")
+                return 1
+
+            yield operation
+
+    @benchmark(f"{transport}/notify")
+    async def notify():
+        async with open_client() as client:
+
+            async def operation():
+                await client.notify("ping")
+                return 1
+
+            yield operation
+
+    for batch_size in BATCH_SIZES:
+
+        @benchmark(f"{transport}/concurrent-{batch_size}")
+        async def concurrent(batch_size=batch_size):
+            """ Issue ``batch_size`` requests concurrently and wait for all of them. """
+            async with open_client() as client:
+
+                async def operation():
+                    async with trio.open_nursery() as nursery:
+                        for _ in range(batch_size):
+                            nursery.start_soon(client.request, "ping")
+                    return batch_size
+
+                yield operation
+
+    for method in ("document", "document_raw"):
+
+        @benchmark(f"{transport}/{method.replace('_', '-')}")
+        async def document_roundtrip(method=method):
+            """ Fetch a 55KB document, which is pre-serialized for ``document-raw``. """
+            async with open_client() as client:
+
+                async def operation():
+                    await client.request(method)
+                    return 1
+
+                yield operation
+
+    for payload_size in PAYLOAD_SIZES:
+
+        @benchmark(f"{transport}/payload-{payload_size}")
+        async def payload(payload_size=payload_size):
+            """ Echo a string of ``payload_size`` bytes. """
+            value = "x" * payload_size
+            async with open_client() as client:
+
+                async def operation():
+                    await client.request("echo", [value])
+                    return 1
+
+                yield operation
+
+
+for name, open_client in TRANSPORTS.items():
+    register_transport_benchmarks(name, open_client)
+
+
+class NullChannel:
+    """ A result channel that discards everything sent to it. """
+
+    async def send(self, value):
+        pass
+
+
+def register_dispatch_benchmark(middleware_count: int) -> None:
+    """ Measure ``Dispatch.handle_request()`` without any transport. """
+
+    async def passthrough(request, call_next):
+        return await call_next(request)
+
+    @benchmark(f"dispatch/middleware-{middleware_count}")
+    async def handle_request():
+        local_dispatch = Dispatch()
+        local_dispatch.handler(echo)
+        for _ in range(middleware_count):
+            local_dispatch.middleware(passthrough)
+        request = JsonRpcRequest(id=0, method="echo", params=[1])
+        channel = NullChannel()
+
+        async def operation():
+            await local_dispatch.handle_request(request, channel)
+            return 1
+
+        yield operation
+
+
+for middleware_count in (0, 3):
+    register_dispatch_benchmark(middleware_count)
@@ -0,0 +1,163 @@
+"""
+The benchmark harness: a registry of benchmark cases, a runner that measures throughput
+and latency, and helpers for saving and comparing baseline results.
+"""
+from __future__ import annotations
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+import json
+import platform
+import time
+import typing
+
+import trio
+
+
+# An operation is an async function that performs one unit of work and returns the
+# number of JSON-RPC messages that it processed.
+Operation = typing.Callable[[], typing.Awaitable[int]]
+BenchmarkFactory = typing.Callable[[], typing.AsyncContextManager[Operation]]
+BENCHMARKS: typing.Dict[str, BenchmarkFactory] = dict()
+
+
+def benchmark(name: str):
+    """
+    A decorator that registers a benchmark.
+
+    The decorated function must be an async generator that sets up any fixtures (e.g. a
+    client and server) and then yields an :data:`Operation`. The harness calls the
+    operation repeatedly and times each call.
+    """
+
+    def decorator(fn):
+        if name in BENCHMARKS:
+            raise RuntimeError(f'Duplicate benchmark name "{name}"')
+        BENCHMARKS[name] = asynccontextmanager(fn)
+        return fn
+
+    return decorator
+
+
+def percentile(sorted_values: typing.Sequence[float], q: float) -> float:
+    """ Return the ``q`` percentile (0 < q < 1) of a sorted sequence. """
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+@dataclass
+class Result:
+    """ The measurements for one benchmark. """
+
+    name: str
+    messages: int
+    elapsed: float
+    latencies: typing.List[float] = field(default_factory=list, repr=False)
+
+    @property
+    def ops_per_sec(self) -> float:
+        """ JSON-RPC messages processed per second. """
+        return self.messages / self.elapsed if self.elapsed else 0.0
+
+    def to_json_dict(self) -> dict:
+        """ Summarize the result. Latencies are in seconds. """
+        latencies = sorted(self.latencies)
+        return {
+            "messages": self.messages,
+            "elapsed": self.elapsed,
+            "ops_per_sec": self.ops_per_sec,
+            "p50": percentile(latencies, 0.50),
+            "p99": percentile(latencies, 0.99),
+            "p999": percentile(latencies, 0.999),
+        }
+
+
+async def run_benchmark(
+    name: str, duration: float, warmup: float = 0.2, min_iterations: int = 10
+) -> Result:
+    """
+    Run one benchmark for approximately ``duration`` seconds.
+
+    Each call to the benchmark's operation is timed individually, so the latency
+    percentiles describe a single operation (which may contain many messages).
+    """
+    async with BENCHMARKS[name]() as operation:
+        warmup_end = time.perf_counter() + warmup
+        while time.perf_counter() < warmup_end:
+            await operation()
+
+        latencies = list()
+        messages = 0
+        start = time.perf_counter()
+        end = start + duration
+        now = start
+        while now < end or len(latencies) < min_iterations:
+            messages += await operation()
+            then, now = now, time.perf_counter()
+            latencies.append(now - then)
+        return Result(name, messages, now - start, latencies)
+
+
+def save_results(path: str, results: typing.Iterable[Result]) -> None:
+    """ Save results to a JSON file so that they can be used as a baseline. """
+    doc = {
+        "python": platform.python_version(),
+        "trio": trio.__version__,
+        "platform": platform.platform(),
+        "results": {result.name: result.to_json_dict() for result in results},
+    }
+    with open(path, "w") as file:
+        json.dump(doc, file, indent=2, sort_keys=True)
+
+
+def load_results(path: str) -> typing.Dict[str, dict]:
+    """ Load results saved by :func:`save_results`. """
+    with open(path) as file:
+        return json.load(file)["results"]
+
+
+def compare(
+    baseline: typing.Dict[str, dict],
+    results: typing.Iterable[Result],
+    throughput_threshold: float,
+    latency_threshold: float,
+) -> typing.List[str]:
+    """
+    Compare results to a baseline and return a list of regressions.
+
+    A benchmark regresses if its throughput drops by more than ``throughput_threshold``
+    or its p99 latency rises by more than ``latency_threshold``. Both thresholds are
+    fractions, e.g. 0.1 means 10%. Benchmarks missing from the baseline are ignored.
+    """
+    regressions = list()
+    for result in results:
+        try:
+            base = baseline[result.name]
+        except KeyError:
+            continue
+        current = result.to_json_dict()
+        if current["ops_per_sec"] < base["ops_per_sec"] * (1 - throughput_threshold):
+            change = current["ops_per_sec"] / base["ops_per_sec"] - 1
+            regressions.append(f"{result.name}: throughput {change:+.1%}")
+        if current["p99"] > base["p99"] * (1 + latency_threshold):
+            change = current["p99"] / base["p99"] - 1
+            regressions.append(f"{result.name}: p99 latency {change:+.1%}")
+    return regressions
+
+
+def format_result(result: Result) -> str:
+    """ Format a result as one line of a table. """
+    summary = result.to_json_dict()
+    return "{:<32} {:>12,.0f} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+        result.name,
+        summary["ops_per_sec"],
+        summary["p50"] * 1e6,
+        summary["p99"] * 1e6,
+        summary["p999"] * 1e6,
+    )
+
+
+def format_header() -> str:
+    return "{:<32} {:>12} {:>10} {:>10} {:>10}".format(
+        "benchmark", "msgs/s", "p50 (us)", "p99 (us)", "p999 (us)"
+    )
@@ -0,0 +1,423 @@
+"""
+A soak test that looks for memory leaks and slow memory growth.
+
+Many client sessions run at once over in-memory and WebSocket transports against
+``Dispatch``-based servers in this process. Each session opens a connection, sends a
+random mix of requests, notifications, errors, cancellations and timeouts from several
+tasks, and then disconnects, sometimes abruptly with requests still in flight. The
+harness samples RSS and the memory traced by :mod:`tracemalloc` at a fixed interval, and
+fails if either one grows steadily after the warm-up, or if any per-request state is
+left behind at the end.
+
+    $ python -m benchmarks.soak --duration 60
+    $ python -m benchmarks.soak --requests 5000000 --interval 30
+
+The process exits with a non-zero status if the soak test fails. RSS is read from
+``/proc``, so it is only sampled on Linux.
+"""
+import argparse
+from collections import Counter
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+import gc
+import logging
+import os
+import random
+import sys
+import tracemalloc
+import typing
+
+import trio
+from trio_jsonrpc import (
+    Dispatch,
+    JsonRpcApplicationError,
+    JsonRpcConnection,
+    JsonRpcConnectionType,
+    JsonRpcException,
+    Scheduler,
+    open_jsonrpc_ws,
+)
+from trio_jsonrpc.dispatch import contexts
+from trio_jsonrpc.main import jsonrpc_client
+from trio_jsonrpc.transport.memory import MemoryTransport
+from trio_jsonrpc.transport.ws import WebSocketTransport
+import trio_websocket
+
+
+# The operations that each session chooses from, with their weights.
+MIX = {
+    "echo": 50,
+    "whoami": 10,
+    "notify": 10,
+    "error": 10,
+    "cancel": 10,
+    "timeout": 9,
+    "disconnect": 1,
+}
+# The number of tasks that send requests on each connection at once.
+CONCURRENCY = 4
+MB = 1024 * 1024
+
+
+dispatch = Dispatch()
+scheduler = Scheduler(dispatch, max_concurrent=64)
+
+
+@dispatch.handler
+async def echo(value):
+    return value
+
+
+@dispatch.handler
+async def nap(seconds):
+    await trio.sleep(seconds)
+    return seconds
+
+
+@dispatch.handler
+async def whoami():
+    return dispatch.ctx["id"]
+
+
+@dispatch.handler
+async def fail():
+    raise JsonRpcApplicationError("This handler always fails.")
+
+
+@dataclass
+class Sample:
+    """ A measurement of memory use during the soak test. """
+
+    elapsed: float
+    requests: int
+    rss: int
+    traced: int
+    contexts: int
+    running: int
+    outbound: int
+
+    def format(self) -> str:
+        return (
+            "{:>8.0f}s {:>12,d} requests  rss={:>7.1f}MB  traced={:>7.1f}MB  "
+            "contexts={:<4d} running={:<4d} outbound={:<4d}".format(
+                self.elapsed,
+                self.requests,
+                self.rss / MB,
+                self.traced / MB,
+                self.contexts,
+                self.running,
+                self.outbound,
+            )
+        )
+
+
+def current_rss() -> int:
+    """ Return the resident set size of this process in bytes, or 0 if unknown. """
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+class Soak:
+    """ The state of a soak test run. """
+
+    def __init__(self, args, ws_port: int):
+        self.args = args
+        self.ws_url = f"ws://127.0.0.1:{ws_port}"
+        self.rng = random.Random(args.seed)
+        self.ops = list(MIX)
+        self.weights = list(MIX.values())
+        self.outcomes: typing.Counter[str] = Counter()
+        self.requests = 0
+        self.start = trio.current_time()
+        self.clients: typing.Set[JsonRpcConnection] = set()
+        #: The number of outbound requests left on connections when they were closed.
+        self.leaked = 0
+
+    @property
+    def finished(self) -> bool:
+        elapsed = trio.current_time() - self.start
+        return self.requests >= self.args.requests or elapsed >= self.args.duration
+
+    def sample(self) -> Sample:
+        gc.collect()
+        traced = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+        return Sample(
+            elapsed=trio.current_time() - self.start,
+            requests=self.requests,
+            rss=current_rss(),
+            traced=traced,
+            contexts=len(contexts),
+            running=len(dispatch._running),
+            outbound=sum(len(c._outbound_requests) for c in self.clients),
+        )
+
+    @asynccontextmanager
+    async def open_memory(self, server_nursery: trio.Nursery):
+        """ Connect a client to a new server connection over memory channels. """
+        client_send, server_recv = trio.open_memory_channel(0)
+        server_send, client_recv = trio.open_memory_channel(0)
+        server = JsonRpcConnection(
+            MemoryTransport(server_send, server_recv),
+            JsonRpcConnectionType.SERVER,
+            dispatch=dispatch,
+            context={"id": self.rng.random()},
+        )
+        server_nursery.start_soon(server._background_task)
+        try:
+            async with trio.open_nursery() as nursery:
+                transport = MemoryTransport(client_send, client_recv)
+                yield jsonrpc_client(transport, nursery)
+                nursery.cancel_scope.cancel()
+        finally:
+            await client_send.aclose()
+            await client_recv.aclose()
+
+    async def session(self, open_connection: typing.Callable) -> None:
+        """ Open connections and send a random mix of requests until finished. """
+        while not self.finished:
+            async with open_connection() as client:
+                self.clients.add(client)
+                try:
+                    with trio.CancelScope() as connection_scope:
+                        async with trio.open_nursery() as nursery:
+                            for _ in range(CONCURRENCY):
+                                nursery.start_soon(
+                                    self.send_requests, client, connection_scope
+                                )
+                    if not connection_scope.cancelled_caught:
+                        # Give the server time to respond to cancelled requests, then
+                        # nothing should be left on the open connection.
+                        await trio.sleep(0.1)
+                        self.leaked += len(client._outbound_requests)
+                finally:
+                    self.clients.discard(client)
+
+    async def send_requests(
+        self, client: JsonRpcConnection, connection_scope: trio.CancelScope
+    ) -> None:
+        """ Send requests on a connection until it is time to reconnect. """
+        for _ in range(self.rng.randint(1, 2 * self.args.requests_per_connection)):
+            if self.finished:
+                return
+            op = self.rng.choices(self.ops, self.weights)[0]
+            self.requests += 1
+            self.outcomes[op] += 1
+            try:
+                await self.send_request(client, op, connection_scope)
+            except JsonRpcException as jre:
+                self.outcomes[type(jre).__name__] += 1
+            except trio.TooSlowError:
+                self.outcomes["TooSlowError"] += 1
+
+    async def send_request(
+        self, client: JsonRpcConnection, op: str, connection_scope: trio.CancelScope
+    ) -> None:
+        if op == "echo":
+            value = "x" * self.rng.randrange(1000)
+            assert await client.request("echo", [value]) == value
+        elif op == "whoami":
+            await client.request("whoami")
+        elif op == "notify":
+            await client.notify("echo", [op])
+        elif op == "error":
+            await client.request("fail")
+        elif op == "cancel":
+            with trio.move_on_after(self.rng.uniform(0, 0.01)):
+                await client.request("nap", [0.01])
+        elif op == "timeout":
+            deadline = trio.current_time() + self.rng.uniform(0, 0.01)
+            await client.request("nap", [0.01], deadline=deadline)
+        elif op == "disconnect":
+            # Drop the connection while the other tasks have requests in flight.
+            await trio.sleep(self.rng.uniform(0, 0.005))
+            connection_scope.cancel()
+
+
+async def serve_ws(task_status=trio.TASK_STATUS_IGNORED) -> None:
+    """ Serve WebSocket connections with a scheduler, and report the port. """
+    ids = iter(range(sys.maxsize))
+
+    async def connection_handler(ws_request):
+        ws = await ws_request.accept()
+        rpc_conn = JsonRpcConnection(
+            WebSocketTransport(ws),
+            JsonRpcConnectionType.SERVER,
+            dispatch=dispatch,
+            context={"id": next(ids)},
+            executor=scheduler,
+        )
+        await rpc_conn._background_task()
+
+    async with trio.open_nursery() as nursery:
+        await nursery.start(scheduler.run)
+        server = await nursery.start(
+            trio_websocket.serve_websocket, connection_handler, "127.0.0.1", 0, None
+        )
+        task_status.started(server.port)
+
+
+def check_growth(
+    samples: typing.List[Sample], name: str, limit: int
+) -> typing.Optional[str]:
+    """
+    Return an error message if a measurement grows steadily over the samples.
+
+    Growth is the least-squares slope of the measurement against the number of
+    requests, times the number of requests. It is sustained if the smallest
+    measurement in the last third of the samples is larger than the largest
+    measurement in the first third, i.e. memory was never given back.
+    """
+    if len(samples) < 6:
+        return None
+    xs = [float(sample.requests) for sample in samples]
+    ys = [float(getattr(sample, name)) for sample in samples]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    variance = sum((x - mean_x) ** 2 for x in xs)
+    if not variance:
+        return None
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / variance
+    growth = slope * (xs[-1] - xs[0])
+    third = len(ys) // 3
+    sustained = min(ys[-third:]) > max(ys[:third])
+    if growth > limit and sustained:
+        return "{} grew by {:.1f}MB ({:.1f} bytes per 1,000 requests)".format(
+            name, growth / MB, slope * 1000
+        )
+    return None
+
+
+async def main(args) -> int:
+    if args.tracemalloc:
+        tracemalloc.start()
+    samples: typing.List[Sample] = list()
+    baseline_snapshot = None
+    async with trio.open_nursery() as servers:
+        port = await servers.start(serve_ws)
+        soak = Soak(args, port)
+
+        async def sampler():
+            nonlocal baseline_snapshot
+            while True:
+                await trio.sleep(args.interval)
+                sample = soak.sample()
+                print(sample.format(), flush=True)
+                if sample.elapsed < args.warmup:
+                    continue
+                if not samples and args.tracemalloc:
+                    baseline_snapshot = tracemalloc.take_snapshot()
+                samples.append(sample)
+
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(sampler)
+            async with trio.open_nursery() as sessions:
+                for n in range(args.sessions):
+                    if n % 2:
+                        connect = lambda: open_jsonrpc_ws(soak.ws_url)  # noqa: E731
+                    else:
+                        connect = lambda: soak.open_memory(servers)  # noqa: E731
+                    sessions.start_soon(soak.session, connect)
+            nursery.cancel_scope.cancel()
+        # Let the servers notice that every connection has closed.
+        await trio.sleep(1)
+        final = soak.sample()
+        servers.cancel_scope.cancel()
+
+    print()
+    for outcome, count in sorted(soak.outcomes.items()):
+        print("{:<32} {:>12,d}".format(outcome, count))
+    print(final.format())
+    failures = list()
+    for name, limit in (("rss", args.max_rss_growth), ("traced", args.max_growth)):
+        failure = check_growth(samples, name, int(limit * MB))
+        if failure:
+            failures.append(failure)
+    for name in ("contexts", "running", "outbound"):
+        if getattr(final, name):
+            failures.append(f"{getattr(final, name)} {name} entries were left behind")
+    if soak.leaked:
+        failures.append(f"{soak.leaked} outbound requests were left on connections")
+    if dispatch.in_flight:
+        failures.append(f"{dispatch.in_flight} requests are still in flight")
+    if len(samples) < 6:
+        print("Too few samples after the warm-up to check for growth.")
+    if baseline_snapshot is not None and (failures or args.verbose):
+        print("\nTop allocation growth since the end of the warm-up:")
+        snapshot = tracemalloc.take_snapshot()
+        for stat in snapshot.compare_to(baseline_snapshot, "lineno")[:10]:
+            print(stat)
+    if failures:
+        print("\nFAILED:\n" + "\n".join(failures))
+        return 1
+    print("\nPASSED")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Trio JSON-RPC soak test")
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=1_000_000,
+        help="Stop after this many requests (default: 1,000,000)",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=3600.0,
+        help="Stop after this many seconds (default: 3600)",
+    )
+    parser.add_argument(
+        "--sessions",
+        type=int,
+        default=16,
+        help="Number of concurrent client sessions, half over WebSocket (default: 16)",
+    )
+    parser.add_argument(
+        "--requests-per-connection",
+        type=int,
+        default=200,
+        help="Average requests per task before reconnecting (default: 200)",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=10.0,
+        help="Seconds between memory samples (default: 10)",
+    )
+    parser.add_argument(
+        "--warmup",
+        type=float,
+        default=30.0,
+        help="Seconds before growth is measured (default: 30)",
+    )
+    parser.add_argument(
+        "--max-growth",
+        type=float,
+        default=5.0,
+        help="Fail if traced memory grows by more than this many MB (default: 5)",
+    )
+    parser.add_argument(
+        "--max-rss-growth",
+        type=float,
+        default=20.0,
+        help="Fail if RSS grows by more than this many MB (default: 20)",
+    )
+    parser.add_argument(
+        "--no-tracemalloc",
+        dest="tracemalloc",
+        action="store_false",
+        help="Only sample RSS, which is much faster",
+    )
+    parser.add_argument("--seed", type=int, help="Random seed")
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Always show the top allocation growth",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    sys.exit(trio.run(main, args))
@@ -3,16 +3,21 @@ import argparse
 from copy import copy
 from dataclasses import dataclass
 import logging
+import signal
 import typing
 
 import trio
 from trio_jsonrpc import (
+    ConnectionMonitor,
     Dispatch,
     JsonRpcApplicationError,
     JsonRpcConnection,
     JsonRpcConnectionType,
     JsonRpcException,
+    JsonRpcRateLimitError,
+    Scheduler,
 )
+from trio_jsonrpc.transport.capture import CaptureFile
 from trio_jsonrpc.transport.ws import WebSocketTransport
 import trio_websocket
 
@@ -28,6 +33,8 @@ user_balances = {
     "jane": 100,
 }
 dispatch = Dispatch()
+# Each user may make up to 10 transfers per second.
+dispatch.rate_limit(10, method="transfer", key=lambda ctx: ctx.user)
 logger = logging.getLogger("server")
 
 
@@ -90,9 +97,16 @@ async def transfer(*, to: str, amount: int) -> None:
     user_balances[from_] -= amount
 
 
-async def run_server(port):
+async def run_server(port, drain_timeout=30, capture=None):
     """ The main entry point for the server. """
     base_context = ConnectionContext()
+    # Shed requests when the queue delay stays above 100ms for a second.
+    scheduler = Scheduler(
+        dispatch, max_concurrent=100, shed_target=0.1, shed_interval=1.0
+    )
+    # Ping quiet clients every 30 seconds, and close connections that are idle for 10
+    # minutes.
+    monitor = ConnectionMonitor(heartbeat_interval=30, idle_timeout=600)
 
     async def responder(conn, recv_channel):
         """ This task reads results from finished method handlers and sends them back
@@ -106,28 +120,85 @@ async def run_server(port):
     async def connection_handler(ws_request):
         """ Handle a new connection by completing the WebSocket handshake and then
         iterating over incoming messages. """
+        if dispatch.draining:
+            await ws_request.reject(503)
+            return
         ws = await ws_request.accept()
         transport = WebSocketTransport(ws)
+        if capture is not None:
+            transport = capture.wrap(transport)
         rpc_conn = JsonRpcConnection(transport, JsonRpcConnectionType.SERVER)
         conn_context = copy(base_context)
         result_send, result_recv = trio.open_memory_channel(10)
-        async with trio.open_nursery() as nursery:
-            nursery.start_soon(responder, rpc_conn, result_recv)
-            nursery.start_soon(rpc_conn._background_task)
-            async with dispatch.connection_context(conn_context):
-                async for request in rpc_conn.iter_requests():
-                    nursery.start_soon(dispatch.handle_request, request, result_send)
-            nursery.cancel_scope.cancel()
-
-    logger.info("Listening on port %d (Type ctrl+c to exit) ", port)
-    await trio_websocket.serve_websocket(connection_handler, "localhost", port, None)
+        with monitor.watch(rpc_conn):
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(rpc_conn._background_task)
+                async with trio.open_nursery() as responders:
+                    responders.start_soon(responder, rpc_conn, result_recv)
+                    async with dispatch.connection_context(conn_context):
+                        with dispatch.until_drained():
+                            async for request in rpc_conn.iter_requests():
+                                try:
+                                    dispatch.check_rate_limit(request)
+                                except JsonRpcRateLimitError as exc:
+                                    if not request.is_notification:
+                                        error = exc.get_error()
+                                        await rpc_conn.respond_with_error(
+                                            request, error
+                                        )
+                                    continue
+                                await scheduler.submit(request, result_send)
+                    if dispatch.drained:
+                        # Every handler has finished, so flush the remaining results
+                        # before closing the connection.
+                        await result_send.aclose()
+                    else:
+                        responders.cancel_scope.cancel()
+                # Handlers that are still running discard their results instead of
+                # blocking on a full channel while holding scheduler capacity.
+                await result_recv.aclose()
+                nursery.cancel_scope.cancel()
+
+    async def drain_on_sigterm(listener_scope):
+        """ Shut down gracefully when SIGTERM is received, e.g. during a deploy. """
+        with trio.open_signal_receiver(signal.SIGTERM) as signals:
+            async for _ in signals:
+                break
+        logger.info("Received SIGTERM: draining connections")
+        # Stop accepting connections, then reject new requests and let in-flight
+        # requests finish. Each connection flushes its results and closes.
+        listener_scope.cancel()
+        if not await dispatch.drain(drain_timeout):
+            logger.warning("Some requests were cancelled after %ds", drain_timeout)
+
+    async with trio.open_nursery() as nursery:
+        await nursery.start(scheduler.run)
+        await nursery.start(monitor.run)
+        async with trio.open_nursery() as connections:
+            with trio.CancelScope() as listener_scope:
+                connections.start_soon(drain_on_sigterm, listener_scope)
+                logger.info("Listening on port %d (Type ctrl+c to exit) ", port)
+                await trio_websocket.serve_websocket(
+                    connection_handler,
+                    "localhost",
+                    port,
+                    None,
+                    handler_nursery=connections,
+                )
+        nursery.cancel_scope.cancel()
 
 
 async def main(args):
+    # Optionally record all traffic so that it can be replayed with
+    # `python -m trio_jsonrpc.replay`.
+    capture = CaptureFile(args.capture) if args.capture else None
     try:
-        await run_server(args.port)
+        await run_server(args.port, capture=capture)
     except KeyboardInterrupt:
         logger.info("Received SIGINT: quitting")
+    finally:
+        if capture is not None:
+            capture.close()
 
 
 if __name__ == "__main__":
@@ -140,6 +211,7 @@ if __name__ == "__main__":
         help="Set logging verbosity (default: info)",
     )
     parser.add_argument("--port", default=8000, type=int, help="Port to listen on")
+    parser.add_argument("--capture", metavar="PATH", help="Record traffic to this file")
     args = parser.parse_args()
     logging.basicConfig(level=getattr(logging, args.log_level.upper()))
     trio.run(main, args)
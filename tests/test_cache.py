@@ -0,0 +1,89 @@
+import pytest
+import trio
+from trio_jsonrpc import ResponseCache
+
+
+async def test_cache_policy(autojump_clock):
+    cache = ResponseCache()
+    cache.policy("get_balance", ttl=5)
+    cache.put("get_balance", {"user": "john"}, 100)
+    cache.put("get_time", None, 123)
+    assert cache.is_cached("get_balance")
+    assert not cache.is_cached("get_time")
+    assert cache.get("get_balance", {"user": "john"}) == (True, 100)
+    assert cache.get("get_balance", {"user": "jane"}) == (False, None)
+    assert cache.get("get_time", None) == (False, None)
+
+
+async def test_cache_key_ignores_member_order():
+    cache = ResponseCache()
+    cache.policy("search", ttl=5)
+    cache.put("search", {"q": "foo", "limit": 10}, ["a"])
+    assert cache.get("search", {"limit": 10, "q": "foo"}) == (True, ["a"])
+    assert cache.get("search", ["foo", 10]) == (False, None)
+
+
+async def test_cache_ttl(autojump_clock):
+    cache = ResponseCache()
+    cache.policy("get_balance", ttl=5)
+    cache.put("get_balance", None, 100)
+    await trio.sleep(4.9)
+    assert cache.get("get_balance", None) == (True, 100)
+    await trio.sleep(0.2)
+    assert cache.get("get_balance", None) == (False, None)
+    assert len(cache) == 0
+
+
+async def test_cache_lru():
+    cache = ResponseCache(max_entries=2)
+    cache.policy("get", ttl=5)
+    cache.put("get", [1], 1)
+    cache.put("get", [2], 2)
+    assert cache.get("get", [1]) == (True, 1)
+    cache.put("get", [3], 3)
+    assert len(cache) == 2
+    assert cache.get("get", [1]) == (True, 1)
+    assert cache.get("get", [2]) == (False, None)
+    assert cache.get("get", [3]) == (True, 3)
+
+
+async def test_cache_invalidate():
+    cache = ResponseCache()
+    cache.policy("get", ttl=5, tags=lambda params: [f"user:{params[0]}"])
+    cache.policy("list", ttl=5)
+    cache.put("get", ["john", 1], 1)
+    cache.put("get", ["john", 2], 2)
+    cache.put("get", ["jane", 3], 3)
+    cache.put("list", [1], 4)
+    cache.put("list", [2], 5)
+
+    cache.invalidate("list", [1])
+    assert cache.get("list", [1]) == (False, None)
+    assert cache.get("list", [2]) == (True, 5)
+
+    cache.invalidate(tags=["user:john"])
+    assert cache.get("get", ["john", 1]) == (False, None)
+    assert cache.get("get", ["john", 2]) == (False, None)
+    assert cache.get("get", ["jane", 3]) == (True, 3)
+
+    cache.invalidate("list")
+    assert cache.get("list", [2]) == (False, None)
+    assert len(cache) == 1
+
+    cache.invalidate()
+    assert len(cache) == 0
+
+
+async def test_cache_put_after_invalidation_is_ignored():
+    cache = ResponseCache()
+    cache.policy("get", ttl=5)
+    generation = cache.generation
+    cache.invalidate(tags=["anything"])
+    cache.put("get", None, 1, generation)
+    assert cache.get("get", None) == (False, None)
+
+
+def test_cache_policy_ttl_must_be_positive():
+    cache = ResponseCache()
+    with pytest.raises(ValueError):
+        cache.policy("get", ttl=0)
@@ -0,0 +1,101 @@
+import json
+
+import pytest
+import trio
+from trio_jsonrpc import Dispatch, open_jsonrpc_memory
+from trio_jsonrpc.main import jsonrpc_server
+from trio_jsonrpc.replay import dispatch_target, load_requests, replay
+from trio_jsonrpc.transport.capture import CaptureFile, RecordKind, read_capture
+from trio_jsonrpc.transport.memory import MemoryTransport
+
+from . import fail_after
+
+
+def make_dispatch():
+    dispatch = Dispatch()
+
+    @dispatch.handler
+    async def nap(seconds):
+        await trio.sleep(seconds)
+        return seconds
+
+    @dispatch.handler
+    async def log(message):
+        pass
+
+    return dispatch
+
+
+async def record_traffic(path, dispatch):
+    """ Send two overlapping requests and a notification through a captured server. """
+    client_send, server_recv = trio.open_memory_channel(10)
+    server_send, client_recv = trio.open_memory_channel(10)
+    with CaptureFile(path) as capture:
+        async with trio.open_nursery() as nursery:
+            transport = capture.wrap(MemoryTransport(server_send, server_recv))
+            jsonrpc_server(transport, nursery, dispatch=dispatch)
+            async with open_jsonrpc_memory(client_send, client_recv) as client:
+                async with trio.open_nursery() as requests:
+                    requests.start_soon(client.request, "nap", [1])
+                    await trio.sleep(0.5)
+                    requests.start_soon(client.request, "nap", [2])
+                    await trio.sleep(0.25)
+                    await client.notify("log", ["hello"])
+            nursery.cancel_scope.cancel()
+
+
+@fail_after(10)
+async def test_capture_and_load_requests(autojump_clock, tmp_path):
+    path = str(tmp_path / "traffic.cap")
+    await record_traffic(path, make_dispatch())
+
+    frames = list(read_capture(path))
+    assert [frame.kind for frame in frames] == [
+        RecordKind.OPEN_SERVER,
+        RecordKind.RECV,
+        RecordKind.RECV,
+        RecordKind.RECV,
+        RecordKind.SEND,
+        RecordKind.SEND,
+    ]
+    assert {frame.connection for frame in frames} == {0}
+    requests = load_requests(frames)
+    assert [(r.method, r.params, r.is_notification) for r in requests] == [
+        ("nap", [1], False),
+        ("nap", [2], False),
+        ("log", ["hello"], True),
+    ]
+    assert [r.time for r in requests] == pytest.approx([0, 0.5, 0.75])
+    assert [r.latency for r in requests] == pytest.approx([1, 2, None])
+
+    # A second capture appends to the file, and a truncated record is discarded.
+    with open(path, "ab") as file:
+        file.write(b"\x00\x01\x02")
+    await record_traffic(path, make_dispatch())
+    frames = list(read_capture(path))
+    assert len(frames) == 12
+    assert [frame.connection for frame in frames[6:]] == [1] * 6
+
+
+@fail_after(10)
+async def test_replay_into_dispatch(autojump_clock, tmp_path):
+    path = str(tmp_path / "traffic.cap")
+    dispatch = make_dispatch()
+    await record_traffic(path, dispatch)
+    requests = load_requests(read_capture(path))
+
+    start = trio.current_time()
+    report = await replay(requests, dispatch_target(dispatch), speed=2)
+    assert trio.current_time() - start == pytest.approx(2.25)
+    nap = report.methods["nap"]
+    assert nap.sent == 2
+    assert nap.latency.count == 2
+    assert nap.latency.max == pytest.approx(2)
+    assert nap.original.count == 2
+    assert report.methods["log"].sent == 1
+    assert "nap" in report.format()
+
+    # A later run can be compared to the saved results.
+    baseline = json.loads(json.dumps(report.to_json_dict()))
+    assert baseline["methods"]["nap"]["p99"] == pytest.approx(2, rel=0.01)
+    assert "compared to baseline" in report.format(baseline)
@@ -1,16 +1,26 @@
 import json
+import statistics
+import time
 import types
 from unittest.mock import Mock
 
 import pytest
 from sansio_jsonrpc import JsonRpcRequest
+from sansio_jsonrpc.main import MissingId
 import trio
+import trio.testing
+from trio_jsonrpc.main import JsonRpcRequestWithDeadline
 from trio_jsonrpc import (
     Dispatch,
     JsonRpcApplicationError,
+    JsonRpcDeadlineExceededError,
     JsonRpcError,
     JsonRpcMethodNotFoundError,
     JsonRpcInternalError,
+    JsonRpcRateLimitError,
+    JsonRpcRequestCancelledError,
+    JsonRpcServerOverloadedError,
+    JsonRpcServerShuttingDownError,
     serve_jsonrpc_memory,
 )
 
@@ -101,6 +111,53 @@ async def test_handler_raises_exc(caplog):
     assert 'An unhandled exception occurred in handler "foo_bar"' in caplog.text
 
 
+async def test_inline_handler(caplog):
+    """ An inline handler is a plain function that is called synchronously. """
+    dispatch = Dispatch(inline_threshold=0.005)
+    prices = {"apple": 1, "pear": 2}
+
+    @dispatch.handler(inline=True)
+    def price(fruit):
+        return prices[fruit]
+
+    @dispatch.handler(inline=True)
+    def slow():
+        time.sleep(0.01)
+        return True
+
+    assert dispatch.is_inline("price")
+    assert not dispatch.is_inline("missing")
+    request = JsonRpcRequest(id=0, method="price", params=["pear"])
+    assert dispatch.call_inline(request) == 2
+    request = JsonRpcRequest(id=0, method="price", params={"fruit": "apple"})
+    assert dispatch.call_inline(request) == 1
+    # It can also be called in a task like any other handler.
+    assert await dispatch.execute(request) == 1
+    result = dispatch.call_inline(JsonRpcRequest(id=0, method="price", params=["fig"]))
+    assert isinstance(result, JsonRpcInternalError)
+    assert 'An unhandled exception occurred in handler "price"' in caplog.text
+
+    # A slow inline handler is recorded every time but only logged once.
+    for _ in range(2):
+        assert dispatch.call_inline(JsonRpcRequest(id=0, method="slow"))
+    assert dispatch.slow_inline.count == 2
+    assert caplog.text.count('Inline handler "slow" blocked the event loop') == 1
+
+    # Middleware is async, so it turns off the inline path.
+    @dispatch.middleware
+    async def passthrough(request, call_next):
+        return await call_next(request)
+
+    assert not dispatch.is_inline("price")
+    assert await dispatch.execute(request) == 1
+
+    with pytest.raises(RuntimeError):
+
+        @dispatch.handler(inline=True)
+        async def not_plain():
+            pass
+
+
 async def test_dispatch_context_inside_request():
     """
     If a context is set, it should be visible inside the handler and the handler should
@@ -155,3 +212,440 @@ async def test_cannot_nest_contexts():
         async with dispatch.connection_context(context):
             async with dispatch.connection_context(context):
                 pass
+
+
+async def test_middleware_wraps_handlers_in_order():
+    dispatch = Dispatch()
+    calls = list()
+
+    @dispatch.middleware
+    async def outer(request, call_next):
+        calls.append(("outer", request.method))
+        result = await call_next(request)
+        calls.append("outer done")
+        return result
+
+    @dispatch.middleware
+    async def inner(request, call_next):
+        calls.append(("inner", request.method))
+        return {"wrapped": await call_next(request)}
+
+    @dispatch.handler
+    async def add(a, b):
+        calls.append("add")
+        return a + b
+
+    result = await dispatch.execute(JsonRpcRequest(id=0, method="add", params=[1, 2]))
+    assert result == {"wrapped": 3}
+    assert calls == [("outer", "add"), ("inner", "add"), "add", "outer done"]
+
+
+async def test_middleware_can_reject_and_map_errors():
+    dispatch = Dispatch()
+
+    @dispatch.middleware
+    async def auth(request, call_next):
+        if request.method == "secret":
+            raise JsonRpcApplicationError(code=1000, message="Not authorized")
+        try:
+            return await call_next(request)
+        except KeyError:
+            raise JsonRpcApplicationError(code=1001, message="No such key")
+
+    @dispatch.handler
+    async def secret():
+        return "hunter2"
+
+    @dispatch.handler
+    async def lookup(key):
+        return dict()[key]
+
+    with pytest.raises(JsonRpcApplicationError) as exc_info:
+        await dispatch.execute(JsonRpcRequest(id=0, method="secret"))
+    assert exc_info.value.code == 1000
+
+    with pytest.raises(JsonRpcApplicationError) as exc_info:
+        await dispatch.execute(JsonRpcRequest(id=1, method="lookup", params=["x"]))
+    assert exc_info.value.code == 1001
+
+
+async def test_middleware_chain_is_cached_and_rebuilt():
+    """ Chains are composed once per method, and are rebuilt when middleware or
+    handlers change. """
+    dispatch = Dispatch()
+
+    @dispatch.handler
+    async def hello():
+        return "hello"
+
+    @dispatch.middleware
+    async def shout(request, call_next):
+        return (await call_next(request)).upper()
+
+    await dispatch.execute(JsonRpcRequest(id=0, method="hello"))
+    chain = dispatch._chains["hello"]
+    assert await dispatch.execute(JsonRpcRequest(id=1, method="hello")) == "HELLO"
+    assert dispatch._chains["hello"] is chain
+
+    @dispatch.middleware
+    async def exclaim(request, call_next):
+        return (await call_next(request)) + "!"
+
+    assert "hello" not in dispatch._chains
+    assert await dispatch.execute(JsonRpcRequest(id=2, method="hello")) == "HELLO!"
+
+    async def hello():
+        return "goodbye"
+
+    dispatch.handler(hello)
+    assert await dispatch.execute(JsonRpcRequest(id=3, method="hello")) == "GOODBYE!"
+
+
+async def test_middleware_method_not_found():
+    dispatch = Dispatch()
+
+    @dispatch.middleware
+    async def passthrough(request, call_next):
+        return await call_next(request)
+
+    with pytest.raises(JsonRpcMethodNotFoundError):
+        await dispatch.execute(JsonRpcRequest(id=0, method="hello_world"))
+
+
+async def test_rate_limit_global_and_per_method(autojump_clock):
+    dispatch = Dispatch()
+    dispatch.rate_limit(10, burst=3)
+    dispatch.rate_limit(1, method="slow")
+    fast = JsonRpcRequest(id=0, method="fast")
+    slow = JsonRpcRequest(id=1, method="slow")
+
+    dispatch.check_rate_limit(slow)
+    with pytest.raises(JsonRpcRateLimitError) as exc_info:
+        dispatch.check_rate_limit(slow)
+    assert exc_info.value.data["retry_after"] == pytest.approx(1.0)
+
+    # The rejected request did not consume a global token.
+    dispatch.check_rate_limit(fast)
+    dispatch.check_rate_limit(fast)
+    with pytest.raises(JsonRpcRateLimitError) as exc_info:
+        dispatch.check_rate_limit(fast)
+    assert exc_info.value.data["retry_after"] == pytest.approx(0.1)
+
+    await trio.sleep(0.1)
+    dispatch.check_rate_limit(fast)
+
+    # Cancellations are never limited.
+    cancel = JsonRpcRequest(id=MissingId(), method="$/cancelRequest", params=[0])
+    for _ in range(5):
+        dispatch.check_rate_limit(cancel)
+
+
+async def test_rate_limit_per_connection_context(autojump_clock):
+    dispatch = Dispatch()
+    limit = dispatch.rate_limit(1, key=lambda ctx: ctx.user, max_keys=2)
+
+    class MyRequestContext:
+        def __init__(self, user):
+            self.user = user
+
+    request = JsonRpcRequest(id=0, method="hello")
+
+    async def check(user):
+        async with dispatch.connection_context(MyRequestContext(user)):
+            dispatch.check_rate_limit(request)
+
+    await check("john")
+    await check("jane")
+    with pytest.raises(JsonRpcRateLimitError):
+        await check("john")
+
+    # The least recently used bucket is discarded when there are too many keys.
+    await check("jack")
+    assert list(limit._buckets) == ["john", "jack"]
+    await check("jane")
+
+
+async def test_dispatch_deadline(autojump_clock):
+    dispatch = Dispatch()
+    calls = list()
+
+    @dispatch.handler
+    async def nap(seconds):
+        calls.append(seconds)
+        await trio.sleep(seconds)
+        return "rested"
+
+    def make_request(seconds, timeout):
+        return JsonRpcRequestWithDeadline(
+            id=0,
+            method="nap",
+            params=[seconds],
+            deadline=trio.current_time() + timeout,
+        )
+
+    assert await dispatch.execute(make_request(1, 2)) == "rested"
+
+    # The handler is cancelled when the deadline passes.
+    start = trio.current_time()
+    with pytest.raises(JsonRpcDeadlineExceededError):
+        await dispatch.execute(make_request(2, 1))
+    assert trio.current_time() - start == pytest.approx(1)
+
+    # The handler is skipped if the deadline has already passed.
+    with pytest.raises(JsonRpcDeadlineExceededError):
+        await dispatch.execute(make_request(3, 0))
+    assert calls == [1, 2]
+
+
+async def test_dispatch_cancel_request(autojump_clock, nursery):
+    dispatch = Dispatch()
+
+    @dispatch.handler
+    async def nap():
+        await trio.sleep(10)
+
+    result_send, result_recv = trio.open_memory_channel(1)
+    async with dispatch.connection_context("john"):
+        request = JsonRpcRequest(id=7, method="nap")
+        nursery.start_soon(dispatch.handle_request, request, result_send)
+        await trio.sleep(1)
+        assert not dispatch.cancel_request(8)
+        cancel = JsonRpcRequest(
+            id=MissingId(), method="$/cancelRequest", params={"id": 7}
+        )
+        await dispatch.handle_request(cancel, result_send)
+        _, result = await result_recv.receive()
+    assert isinstance(result, JsonRpcRequestCancelledError)
+    assert trio.current_time() == pytest.approx(1)
+    assert not dispatch._running
+
+
+async def test_dispatch_cancel_request_other_connection(autojump_clock, nursery):
+    """ A request can only be cancelled from the connection that sent it. """
+    dispatch = Dispatch()
+
+    @dispatch.handler
+    async def nap():
+        await trio.sleep(10)
+        return "rested"
+
+    result_send, result_recv = trio.open_memory_channel(1)
+    async with dispatch.connection_context("john"):
+        request = JsonRpcRequest(id=7, method="nap")
+        nursery.start_soon(dispatch.handle_request, request, result_send)
+    await trio.sleep(1)
+    async with dispatch.connection_context("jane"):
+        assert not dispatch.cancel_request(7)
+    _, result = await result_recv.receive()
+    assert result == "rested"
+
+
+async def test_dispatch_cancel_request_without_context(autojump_clock, nursery):
+    """
+    Without connection contexts, a cancellation only applies to the connection whose
+    result channel it was sent with, even though request IDs repeat.
+    """
+    dispatch = Dispatch()
+
+    @dispatch.handler
+    async def nap():
+        await trio.sleep(10)
+        return "rested"
+
+    john_send, john_recv = trio.open_memory_channel(1)
+    jane_send, jane_recv = trio.open_memory_channel(1)
+    for result_send in (john_send, jane_send):
+        request = JsonRpcRequest(id=0, method="nap")
+        nursery.start_soon(dispatch.handle_request, request, result_send)
+    await trio.sleep(1)
+    cancel = JsonRpcRequest(id=MissingId(), method="$/cancelRequest", params={"id": 0})
+    await dispatch.handle_request(cancel, jane_send)
+    assert not dispatch.cancel_request(0)
+    _, result = await jane_recv.receive()
+    assert isinstance(result, JsonRpcRequestCancelledError)
+    _, result = await john_recv.receive()
+    assert result == "rested"
+    assert trio.current_time() == pytest.approx(10)
+
+
+async def test_dispatch_malformed_cancel_request(autojump_clock, nursery):
+    """
+    A cancellation without a request ID is ignored, so it can't cancel a notification,
+    even one with a deadline.
+    """
+    dispatch = Dispatch()
+    finished = list()
+
+    @dispatch.handler
+    async def nap():
+        await trio.sleep(10)
+        finished.append(trio.current_time())
+
+    result_send, _ = trio.open_memory_channel(1)
+    async with dispatch.connection_context("john"):
+        notification = JsonRpcRequestWithDeadline(
+            id=MissingId(), method="nap", deadline=trio.current_time() + 20
+        )
+        nursery.start_soon(dispatch.handle_request, notification, result_send)
+        await trio.sleep(1)
+        assert not dispatch._running
+        for params in ([], {"method": "nap"}):
+            cancel = JsonRpcRequest(
+                id=MissingId(), method="$/cancelRequest", params=params
+            )
+            await dispatch.handle_request(cancel, result_send)
+            assert not dispatch.cancel_request(None)
+        await trio.sleep(10)
+    assert finished == [pytest.approx(10)]
+
+
+async def test_dispatch_drain(autojump_clock, nursery):
+    dispatch = Dispatch()
+
+    nap_started = trio.Event()
+
+    @dispatch.handler
+    async def nap(seconds):
+        nap_started.set()
+        await trio.sleep(seconds)
+        return "rested"
+
+    result_send, result_recv = trio.open_memory_channel(10)
+    drained = None
+    drain_finished = trio.Event()
+
+    async def drain(task_status=trio.TASK_STATUS_IGNORED):
+        nonlocal drained
+        task_status.started()
+        # drain() starts draining before it blocks for the first time.
+        drained = await dispatch.drain(timeout=5)
+        drain_finished.set()
+
+    async def read_requests(task_status=trio.TASK_STATUS_IGNORED):
+        with dispatch.until_drained():
+            task_status.started()
+            await trio.sleep_forever()
+
+    await nursery.start(read_requests)
+    request = JsonRpcRequest(id=0, method="nap", params=[2])
+    nursery.start_soon(dispatch.handle_request, request, result_send)
+    await nap_started.wait()
+    assert dispatch.in_flight == 1
+    await nursery.start(drain)
+    assert dispatch.draining
+    assert not dispatch.drained
+
+    # New requests are rejected while the old one finishes.
+    request = JsonRpcRequest(id=1, method="nap", params=[1])
+    await dispatch.handle_request(request, result_send)
+    request, result = await result_recv.receive()
+    assert request.id == 1
+    assert isinstance(result, JsonRpcServerShuttingDownError)
+    request, result = await result_recv.receive()
+    assert (request.id, result) == (0, "rested")
+    await drain_finished.wait()
+    assert drained
+    assert dispatch.drained
+    assert trio.current_time() == pytest.approx(2)
+
+    # A block that starts after draining is cancelled immediately.
+    with dispatch.until_drained():
+        await trio.sleep(1)
+        assert False
+
+
+async def test_dispatch_drain_timeout(autojump_clock, nursery):
+    dispatch = Dispatch()
+
+    @dispatch.handler
+    async def nap():
+        await trio.sleep(10)
+
+    result_send, result_recv = trio.open_memory_channel(10)
+    request = JsonRpcRequest(id=0, method="nap")
+    nursery.start_soon(dispatch.handle_request, request, result_send)
+    await trio.sleep(1)
+    assert not await dispatch.drain(timeout=2)
+    assert trio.current_time() == pytest.approx(3)
+    _, result = await result_recv.receive()
+    assert isinstance(result, JsonRpcRequestCancelledError)
+    assert dispatch.in_flight == 0
+
+
+async def run_adaptive_limit(backend_capacity, seconds, **kwargs):
+    """
+    Send requests from 50 clients in a loop to a handler whose backend can serve
+    ``backend_capacity`` requests at once. Return the adaptive limit, its median value
+    over the second half of the run, and the most calls that were in flight.
+    """
+    dispatch = Dispatch()
+    backend = trio.CapacityLimiter(backend_capacity)
+    limit = dispatch.adaptive_limit("work", **kwargs)
+    assert dispatch.adaptive_limits == {"work": limit}
+    max_in_flight = 0
+
+    @dispatch.handler
+    async def work():
+        nonlocal max_in_flight
+        max_in_flight = max(max_in_flight, limit.in_flight)
+        async with backend:
+            await trio.sleep(0.1)
+
+    async def client():
+        while True:
+            await dispatch.execute(JsonRpcRequest(id=0, method="work"))
+
+    samples = list()
+    async with trio.open_nursery() as nursery:
+        for _ in range(50):
+            nursery.start_soon(client)
+        for _ in range(seconds * 10):
+            await trio.sleep(0.1)
+            samples.append(limit.limit)
+        nursery.cancel_scope.cancel()
+    settled = statistics.median(samples[len(samples) // 2 :])
+    return limit, settled, max_in_flight
+
+
+async def test_adaptive_limit_backs_off_slow_backend(autojump_clock):
+    limit, settled, max_in_flight = await run_adaptive_limit(5, 20, initial=20)
+    # The handler's latency doubles at about twice the backend's capacity, and the
+    # limit settles there instead of letting all 50 clients queue in the backend, which
+    # would take 1 second per call. Trio runs tasks in a random order, and the limit
+    # briefly drops and recovers whenever the minimum latency is probed, so the test
+    # checks the median limit rather than its value at one moment.
+    assert 5 <= settled <= 15
+    assert max_in_flight < 50
+    assert limit.min_latency == pytest.approx(0.1)
+    assert limit.latency.percentile(99) < 1
+
+
+async def test_adaptive_limit_grows_for_fast_backend(autojump_clock):
+    limit, settled, max_in_flight = await run_adaptive_limit(1000, 5, max_limit=40)
+    assert settled == 40
+    assert max_in_flight == 40
+    assert limit.waiting == 0
+
+
+async def test_adaptive_limit_max_waiting(autojump_clock, nursery):
+    dispatch = Dispatch()
+    dispatch.adaptive_limit("nap", initial=1, max_waiting=1)
+
+    @dispatch.handler
+    async def nap():
+        await trio.sleep(1)
+        return "rested"
+
+    results = list()
+
+    async def call():
+        try:
+            results.append(await dispatch.execute(JsonRpcRequest(id=0, method="nap")))
+        except JsonRpcServerOverloadedError:
+            results.append("overloaded")
+
+    for _ in range(3):
+        nursery.start_soon(call)
+        await trio.sleep(0.1)
+    await trio.sleep(3)
+    assert results == ["overloaded", "rested", "rested"]
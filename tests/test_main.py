@@ -10,12 +10,23 @@ import logging
 import pytest
 import trio
 from trio_jsonrpc import (
+    Dispatch,
     JsonRpcException,
+    JsonRpcInternalError,
     JsonRpcMethodNotFoundError,
+    JsonRpcRateLimitError,
+    JsonRpcServerShuttingDownError,
+    RawJson,
+    ResponseCache,
+    Scheduler,
+    WorkerPool,
+    open_jsonrpc_inprocess,
     open_jsonrpc_memory,
     serve_jsonrpc_memory,
 )
 
+from trio_jsonrpc.main import _JsonRpcPeer
+
 from . import AsyncMock, fail_after, parse_bytes
 
 
@@ -134,6 +145,131 @@ async def test_request_error(nursery, server):
         assert exc_info.value.data is None
 
 
+@fail_after(5)
+async def test_request_cancelled_before_response(
+    autojump_clock, caplog, nursery, server
+):
+    """
+    If a request is cancelled, a late response is discarded and does not block the
+    background task from handling later responses.
+    """
+
+    async def background():
+        await server.recv()
+        await server.recv()
+        await trio.sleep(2)
+        await server.send(b'{"id": 0, "result": "late", "jsonrpc": "2.0"}')
+        await server.send(b'{"id": 1, "result": "on time", "jsonrpc": "2.0"}')
+
+    nursery.start_soon(background)
+
+    async with open_jsonrpc_memory(*server.client_channels()) as client:
+        with trio.move_on_after(1) as cancel_scope:
+            await client.request(method="slow")
+        assert cancel_scope.cancelled_caught
+        assert not client._outbound_requests
+        with trio.fail_after(3):
+            assert await client.request(method="fast") == "on time"
+        assert not client._cancelled_requests
+    assert "No in-flight request matches" not in caplog.text
+
+
+@fail_after(5)
+async def test_cancelled_request_notifies_server(autojump_clock, nursery, server):
+    """ If a request is cancelled after it is sent, the client notifies the server. """
+
+    async def background():
+        assert parse_bytes(await server.recv())["id"] == 0
+        assert parse_bytes(await server.recv()) == {
+            "method": "$/cancelRequest",
+            "params": {"id": 0},
+            "jsonrpc": "2.0",
+        }
+
+    nursery.start_soon(background)
+
+    async with open_jsonrpc_memory(*server.client_channels()) as client:
+        with trio.move_on_after(1):
+            await client.request(method="slow")
+        await trio.sleep(1)
+        # The server never responds, but the client doesn't wait for it forever.
+        assert not client._outbound_requests
+
+
+@fail_after(5)
+async def test_request_cancelled_before_sent(autojump_clock):
+    """
+    If a request is cancelled while it is blocked sending, the server never receives
+    it, so the client forgets it without waiting for a response.
+    """
+    server = MemoryServer(channel_size=0)
+    async with open_jsonrpc_memory(*server.client_channels()) as client:
+        with trio.move_on_after(1) as cancel_scope:
+            await client.request(method="blocked")
+        assert cancel_scope.cancelled_caught
+        assert client.in_flight == 0
+        assert not client._outbound_requests
+
+
+@fail_after(5)
+async def test_request_deadline(autojump_clock, nursery, server):
+    """
+    A request with a deadline sends its remaining time to the server, and raises
+    TooSlowError if the response does not arrive before the deadline.
+    """
+
+    async def background():
+        server_bytes = await server.recv()
+        assert parse_bytes(server_bytes) == {
+            "id": 0,
+            "method": "slow",
+            "jsonrpc": "2.0",
+            "timeout": 2.0,
+        }
+        await trio.sleep(3)
+        await server.send(b'{"id": 0, "result": "late", "jsonrpc": "2.0"}')
+
+    nursery.start_soon(background)
+
+    async with open_jsonrpc_memory(*server.client_channels()) as client:
+        with pytest.raises(trio.TooSlowError):
+            await client.request("slow", deadline=trio.current_time() + 2)
+
+
+@fail_after(1)
+async def test_serve_request_with_deadline(autojump_clock, nursery, client):
+    """ The server converts a request's timeout into a deadline on its own clock. """
+
+    async def background():
+        await client.send(
+            b'{"id": 0, "method": "foo", "jsonrpc": "2.0", "timeout": 1.5}'
+        )
+        await client.send(b'{"id": 1, "method": "foo", "jsonrpc": "2.0"}')
+
+    nursery.start_soon(background)
+
+    async with serve_jsonrpc_memory(*client.server_channels()) as server:
+        requests = server.iter_requests()
+        request = await requests.__anext__()
+        assert request.deadline == pytest.approx(trio.current_time() + 1.5)
+        request = await requests.__anext__()
+        assert request.deadline is None
+
+
+@pytest.mark.parametrize(
+    "timeout", ["true", "false", "-1", "NaN", "Infinity", "-Infinity", '"1.5"']
+)
+async def test_parse_ignores_invalid_timeout(autojump_clock, timeout):
+    """ A timeout that isn't a finite, non-negative number does not set a deadline. """
+    peer = _JsonRpcPeer()
+    data = '{"id": 0, "method": "foo", "jsonrpc": "2.0", "timeout": %s}' % timeout
+    (request,) = peer.parse(data.encode("ascii"))
+    assert request.deadline is None
+    data = b'{"id": 0, "method": "foo", "jsonrpc": "2.0", "timeout": 0}'
+    (request,) = peer.parse(data)
+    assert request.deadline == trio.current_time()
+
+
 @fail_after(1)
 async def test_client_response_does_not_match_request(
     autojump_clock, caplog, nursery, server
@@ -226,6 +362,231 @@ async def test_notify(nursery, server):
         await trio.sleep(0)
 
 
+@fail_after(1)
+async def test_request_cache(nursery, server):
+    """
+    Cached results are returned without a round trip until the server invalidates
+    them. The invalidation is not surfaced as a request.
+    """
+
+    async def background():
+        for id_ in range(3):
+            request = parse_bytes(await server.recv())
+            assert request["id"] == id_
+            response = {"id": id_, "result": id_, "jsonrpc": "2.0"}
+            await server.send(json.dumps(response).encode("ascii"))
+            if id_ == 1:
+                await server.send(
+                    b'{"method": "$/invalidateCache", "params": {"tags": ["john"]}, '
+                    b'"jsonrpc": "2.0"}'
+                )
+
+    nursery.start_soon(background)
+
+    async with open_jsonrpc_memory(*server.client_channels()) as client:
+        client.cache = ResponseCache()
+        client.cache.policy("get", ttl=60, tags=lambda params: params)
+        assert await client.request("get", ["john"]) == 0
+        assert await client.request("get", ["john"]) == 0
+        assert await client.request("get", ["jane"]) == 1
+        await trio.sleep(0.1)
+        assert client.cache.get("get", ["john"]) == (False, None)
+        assert await client.request("get", ["john"]) == 2
+        assert await client.request("get", ["john"]) == 2
+
+
+@fail_after(1)
+async def test_serve_invalidate_cache(nursery, client):
+    async def background():
+        client_bytes = await client.recv()
+        assert parse_bytes(client_bytes) == {
+            "method": "$/invalidateCache",
+            "params": {"method": "get", "params": ["john"], "tags": ["user:john"]},
+            "jsonrpc": "2.0",
+        }
+
+    nursery.start_soon(background)
+
+    async with serve_jsonrpc_memory(*client.server_channels()) as server:
+        await server.invalidate_cache("get", ["john"], tags=["user:john"])
+
+
+@fail_after(1)
+async def test_request_batching(autojump_clock, nursery, server):
+    """
+    Concurrent requests are sent as one batch, and the responses in a batch are
+    delivered to the individual callers.
+    """
+
+    async def background():
+        batch = parse_bytes(await server.recv())
+        assert trio.current_time() == pytest.approx(0.01)
+        assert batch[0] == {"id": 0, "method": "echo", "params": [0], "jsonrpc": "2.0"}
+        # Trio doesn't guarantee the order that the other two tasks run in.
+        assert sorted(batch[1:], key=lambda message: message["method"]) == [
+            {"id": 1, "method": "echo", "params": [1], "jsonrpc": "2.0"},
+            {"method": "hello", "jsonrpc": "2.0"},
+        ]
+        await server.send(
+            b'[{"id": 1, "result": 1, "jsonrpc": "2.0"},'
+            b'{"id": 0, "result": 0, "jsonrpc": "2.0"}]'
+        )
+        # A single message is not wrapped in a batch.
+        assert parse_bytes(await server.recv()) == {
+            "id": 2,
+            "method": "echo",
+            "params": [2],
+            "jsonrpc": "2.0",
+        }
+        await server.send(b'{"id": 2, "result": 2, "jsonrpc": "2.0"}')
+
+    nursery.start_soon(background)
+    results = dict()
+
+    async def request(client, value):
+        results[value] = await client.request("echo", [value])
+
+    async with open_jsonrpc_memory(
+        *server.client_channels(), batch_delay=0.01
+    ) as client:
+        async with trio.open_nursery() as request_nursery:
+            request_nursery.start_soon(request, client, 0)
+            await trio.sleep(0.001)
+            request_nursery.start_soon(request, client, 1)
+            request_nursery.start_soon(client.notify, "hello")
+        assert results == {0: 0, 1: 1}
+        assert await client.request("echo", [2]) == 2
+
+
+@fail_after(1)
+async def test_request_batching_full_batch(autojump_clock, nursery, server):
+    """ A full batch is sent without waiting for the delay. """
+
+    async def background():
+        batch = parse_bytes(await server.recv())
+        assert len(batch) == 2
+        assert trio.current_time() == 0
+        assert len(parse_bytes(await server.recv())) == 2
+
+    nursery.start_soon(background)
+
+    async with open_jsonrpc_memory(
+        *server.client_channels(), batch_delay=10, batch_size=2
+    ) as client:
+        async with trio.open_nursery() as notify_nursery:
+            for _ in range(4):
+                notify_nursery.start_soon(client.notify, "hello")
+        assert trio.current_time() == 0
+
+
+@fail_after(1)
+async def test_request_batching_cancelled(autojump_clock, nursery, server):
+    """ A message that is cancelled before its batch is sent is withdrawn. """
+
+    async def background():
+        batch = parse_bytes(await server.recv())
+        assert batch == {"method": "sent", "jsonrpc": "2.0"}
+
+    nursery.start_soon(background)
+
+    async with open_jsonrpc_memory(
+        *server.client_channels(), batch_delay=1
+    ) as client:
+        with trio.move_on_after(0.5):
+            await client.notify("withdrawn")
+        await client.notify("sent")
+
+
+@fail_after(5)
+async def test_max_in_flight(autojump_clock, nursery, server):
+    """ Requests beyond max_in_flight wait for capacity, and the wait is recorded. """
+
+    async def background():
+        for id_ in range(3):
+            request = parse_bytes(await server.recv())
+            assert request["id"] == id_
+            await trio.sleep(1)
+            response = {"id": id_, "result": id_, "jsonrpc": "2.0"}
+            await server.send(json.dumps(response).encode("ascii"))
+
+    nursery.start_soon(background)
+
+    async with open_jsonrpc_memory(
+        *server.client_channels(), max_in_flight=1
+    ) as client:
+        async with trio.open_nursery() as request_nursery:
+            for _ in range(3):
+                request_nursery.start_soon(client.request, "foo")
+            await trio.sleep(0.5)
+            assert client.in_flight == 1
+            assert client.in_flight_waiting == 2
+        assert client.in_flight == 0
+        assert client.in_flight_wait.count == 3
+        assert client.in_flight_wait.max == pytest.approx(2, rel=0.01)
+
+
+@fail_after(5)
+async def test_max_in_flight_fail_fast(autojump_clock, nursery, server):
+    async def background():
+        await server.recv()
+        await trio.sleep(1)
+        await server.send(b'{"id": 0, "result": 0, "jsonrpc": "2.0"}')
+
+    nursery.start_soon(background)
+
+    async with open_jsonrpc_memory(
+        *server.client_channels(), max_in_flight=1, in_flight_fail_fast=True
+    ) as client:
+        async with trio.open_nursery() as request_nursery:
+            request_nursery.start_soon(client.request, "foo")
+            await trio.sleep(0.5)
+            with pytest.raises(trio.WouldBlock):
+                await client.request("foo")
+
+
+@fail_after(5)
+async def test_max_in_flight_deadline(autojump_clock, nursery, server):
+    """ The deadline includes the wait for capacity, and the server gets the rest. """
+
+    async def background():
+        await server.recv()
+        await trio.sleep(1)
+        await server.send(b'{"id": 0, "result": 0, "jsonrpc": "2.0"}')
+        request = parse_bytes(await server.recv())
+        assert request["timeout"] == pytest.approx(1.5)
+
+    nursery.start_soon(background)
+
+    async with open_jsonrpc_memory(
+        *server.client_channels(), max_in_flight=1
+    ) as client:
+        async with trio.open_nursery() as request_nursery:
+            request_nursery.start_soon(client.request, "foo")
+            await trio.sleep(0.5)
+            with pytest.raises(trio.TooSlowError):
+                await client.request("bar", deadline=trio.current_time() + 2)
+
+
+@fail_after(1)
+async def test_serve_batch(nursery, client):
+    async def background():
+        await client.send(
+            b'[{"id": 0, "method": "foo", "jsonrpc": "2.0"},'
+            b'{"method": "bar", "jsonrpc": "2.0"}]'
+        )
+
+    nursery.start_soon(background)
+
+    async with serve_jsonrpc_memory(*client.server_channels()) as server:
+        requests = server.iter_requests()
+        request = await requests.__anext__()
+        assert request.method == "foo"
+        assert request.id == 0
+        request = await requests.__anext__()
+        assert request.method == "bar"
+        assert request.is_notification
+
+
 @fail_after(1)
 async def test_serve_two_responses(nursery, client):
     async def background():
@@ -254,6 +615,25 @@ async def test_serve_two_responses(nursery, client):
                 break
 
 
+@fail_after(1)
+async def test_serve_respond_with_raw_json(nursery, client):
+    """ A RawJson result is sent exactly as it was serialized. """
+
+    async def background():
+        await client.send(b'{"id": "a", "method": "foo", "jsonrpc": "2.0"}')
+        client_bytes = await client.recv()
+        assert client_bytes == (
+            b'{"id": "a", "jsonrpc": "2.0", "result": {"foo":[1,2]}}'
+        )
+
+    nursery.start_soon(background)
+
+    async with serve_jsonrpc_memory(*client.server_channels()) as server:
+        async for request in server.iter_requests():
+            await server.respond_with_result(request, RawJson('{"foo":[1,2]}'))
+            break
+
+
 @fail_after(1)
 async def test_serve_respond_with_error(nursery, client):
     async def background():
@@ -327,3 +707,214 @@ async def test_server_bg_task_exc_transport_closed(caplog, nursery, client):
         "Server cannot send error response because the transport is closed"
         in caplog.text
     )
+
+
+@fail_after(1)
+async def test_inprocess_request():
+    dispatch = Dispatch()
+
+    @dispatch.handler
+    async def greet(name):
+        return {"greeting": f"Hello, {name}!"}
+
+    @dispatch.handler
+    async def whoami():
+        return dispatch.ctx
+
+    @dispatch.handler
+    async def raw():
+        return RawJson(b'{"foo": [1, 2]}')
+
+    async with open_jsonrpc_inprocess(dispatch, context="john") as client:
+        assert await client.request("greet", {"name": "John"}) == {
+            "greeting": "Hello, John!"
+        }
+        assert await client.request("whoami") == "john"
+        assert await client.request("raw") == {"foo": [1, 2]}
+        with pytest.raises(JsonRpcMethodNotFoundError):
+            await client.request("hello_world")
+        await client.notify("greet", ["Jane"])
+
+
+@pytest.mark.parametrize("copy", [False, True])
+@fail_after(1)
+async def test_inprocess_copy(copy):
+    """ Params are shared between client and handler unless copy is enabled. """
+    dispatch = Dispatch()
+
+    @dispatch.handler
+    async def append(items):
+        items.append("server")
+        return items
+
+    async with open_jsonrpc_inprocess(dispatch, copy=copy) as client:
+        items = ["client"]
+        result = await client.request("append", [items])
+    assert result == ["client", "server"]
+    assert (result is items) != copy
+    assert items == (["client"] if copy else ["client", "server"])
+
+
+@fail_after(5)
+async def test_inprocess_cancel_and_deadline(autojump_clock):
+    dispatch = Dispatch()
+    cancelled = list()
+
+    @dispatch.handler
+    async def nap(seconds):
+        try:
+            await trio.sleep(seconds)
+        except trio.Cancelled:
+            cancelled.append(seconds)
+            raise
+
+    async with open_jsonrpc_inprocess(dispatch) as client:
+        with trio.move_on_after(1):
+            await client.request("nap", [10])
+        with pytest.raises(trio.TooSlowError):
+            await client.request("nap", [20], deadline=trio.current_time() + 1)
+        await trio.sleep(0)
+    assert cancelled == [10, 20]
+
+
+@fail_after(5)
+async def test_direct_dispatch(autojump_clock):
+    """ A server bound to a dispatch runs handlers from its background task. """
+    dispatch = Dispatch()
+    dispatch.rate_limit(1, burst=3, method="whoami")
+    notified = list()
+
+    @dispatch.handler
+    async def nap(seconds):
+        await trio.sleep(seconds)
+        return seconds
+
+    @dispatch.handler
+    async def whoami():
+        return dispatch.ctx
+
+    @dispatch.handler
+    async def notify(value):
+        notified.append(value)
+
+    client_send, server_recv = trio.open_memory_channel(10)
+    server_send, client_recv = trio.open_memory_channel(10)
+    async with serve_jsonrpc_memory(
+        server_send, server_recv, dispatch=dispatch, context="john"
+    ):
+        async with open_jsonrpc_memory(client_send, client_recv) as client:
+            results = list()
+
+            async def request(seconds):
+                results.append(await client.request("nap", [seconds]))
+
+            # Handlers run concurrently.
+            async with trio.open_nursery() as nursery:
+                for seconds in (3, 1, 2):
+                    nursery.start_soon(request, seconds)
+            assert results == [1, 2, 3]
+            assert trio.current_time() == pytest.approx(3)
+
+            await client.notify("notify", ["hello"])
+            for _ in range(3):
+                assert await client.request("whoami") == "john"
+            with pytest.raises(JsonRpcRateLimitError):
+                await client.request("whoami")
+            assert notified == ["hello"]
+            with pytest.raises(JsonRpcMethodNotFoundError):
+                await client.request("missing")
+
+            # A cancelled request cancels its handler.
+            with trio.move_on_after(1):
+                await client.request("nap", [10])
+            await trio.sleep(0.1)
+            assert not dispatch._running
+
+
+@pytest.mark.parametrize("executor_type", [None, Scheduler, WorkerPool])
+@fail_after(10)
+async def test_direct_dispatch_unencodable_result(
+    autojump_clock, caplog, nursery, executor_type
+):
+    """
+    If a handler's result can't be encoded, the client gets an internal error, and the
+    connection and the executor keep running.
+    """
+    dispatch = Dispatch()
+
+    @dispatch.handler
+    async def nothing():
+        return None
+
+    @dispatch.handler
+    async def thing():
+        return object()
+
+    @dispatch.handler
+    async def things():
+        return [object()]
+
+    @dispatch.handler
+    async def echo(value):
+        return value
+
+    executor = None
+    if executor_type is not None:
+        executor = executor_type(dispatch)
+        await nursery.start(executor.run)
+    client_send, server_recv = trio.open_memory_channel(10)
+    server_send, client_recv = trio.open_memory_channel(10)
+    async with serve_jsonrpc_memory(
+        server_send, server_recv, dispatch=dispatch, executor=executor
+    ):
+        async with open_jsonrpc_memory(client_send, client_recv) as client:
+            for method in ("nothing", "thing", "things"):
+                with pytest.raises(JsonRpcInternalError):
+                    await client.request(method)
+            assert await client.request("echo", ["still here"]) == "still here"
+    assert 'Cannot encode the result of method "nothing"' in caplog.text
+
+
+@fail_after(10)
+async def test_direct_dispatch_inline(autojump_clock):
+    """ A bound server calls inline handlers from its background task. """
+    dispatch = Dispatch()
+    tasks = list()
+
+    @dispatch.handler(inline=True)
+    def whoami():
+        tasks.append(trio.lowlevel.current_task())
+        return dispatch.ctx
+
+    @dispatch.handler(inline=True)
+    def cached(key):
+        return RawJson(b'{"key": "%s"}' % key.encode())
+
+    @dispatch.handler(inline=True)
+    def nothing():
+        return None
+
+    @dispatch.handler(inline=True)
+    def thing():
+        return object()
+
+    client_send, server_recv = trio.open_memory_channel(10)
+    server_send, client_recv = trio.open_memory_channel(10)
+    async with serve_jsonrpc_memory(
+        server_send, server_recv, dispatch=dispatch, context="john"
+    ):
+        async with open_jsonrpc_memory(client_send, client_recv) as client:
+            for _ in range(3):
+                assert await client.request("whoami") == "john"
+            assert await client.request("cached", ["k"]) == {"key": "k"}
+            # A result that can't be encoded is an error, and the connection survives.
+            for method in ("nothing", "thing"):
+                with pytest.raises(JsonRpcInternalError):
+                    await client.request(method)
+            assert await client.request("whoami") == "john"
+            assert await dispatch.drain()
+            with pytest.raises(JsonRpcServerShuttingDownError):
+                await client.request("whoami")
+    # No task was started for any of the requests.
+    assert len(tasks) == 4
+    assert len(set(tasks)) == 1
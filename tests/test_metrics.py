@@ -0,0 +1,52 @@
+import pytest
+from trio_jsonrpc.metrics import Histogram
+
+
+def test_histogram_percentiles_within_precision():
+    hist = Histogram(precision=0.01)
+    for n in range(1, 1001):
+        hist.record(n / 1000)
+    assert hist.count == 1000
+    assert hist.min == pytest.approx(0.001)
+    assert hist.max == pytest.approx(1.0)
+    assert hist.mean == pytest.approx(0.5005)
+    assert hist.percentile(50) == pytest.approx(0.5, rel=0.01)
+    assert hist.percentile(99) == pytest.approx(0.99, rel=0.01)
+    assert hist.percentile(100) == pytest.approx(1.0)
+
+
+def test_histogram_empty():
+    hist = Histogram()
+    assert hist.count == 0
+    assert hist.min == 0.0
+    assert hist.percentile(99) == 0.0
+    assert list(hist.iter_percentiles()) == []
+
+
+def test_histogram_merge_and_reset():
+    a = Histogram()
+    b = Histogram()
+    a.record(0.010, count=3)
+    b.record(0.100)
+    a.merge(b)
+    assert a.count == 4
+    assert a.max == pytest.approx(0.100)
+    assert a.percentile(75) == pytest.approx(0.010, rel=0.01)
+    with pytest.raises(ValueError):
+        a.merge(Histogram(precision=0.1))
+    a.reset()
+    assert a.count == 0
+
+
+def test_histogram_percentile_distribution():
+    hist = Histogram()
+    for n in range(1, 101):
+        hist.record(n / 1000)
+    rows = list(hist.iter_percentiles())
+    assert rows[0][1] == 0.0
+    assert rows[-1] == (hist.max, 100.0, 100)
+    percentiles = [row[1] for row in rows]
+    assert percentiles == sorted(percentiles)
+    table = hist.format_percentile_distribution()
+    assert "1/(1-Percentile)" in table
+    assert "Total count    =          100" in table
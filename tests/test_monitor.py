@@ -0,0 +1,104 @@
+import trio
+from trio_jsonrpc import ConnectionMonitor, JsonRpcConnection, JsonRpcConnectionType
+from trio_jsonrpc.transport import BaseTransport, TransportClosed
+
+from . import fail_after
+
+
+class FakeTransport(BaseTransport):
+    """ A transport that never receives anything and answers pings as configured. """
+
+    def __init__(self, pong=True):
+        self.pong = pong
+        self.pings = 0
+
+    async def recv(self):
+        await trio.sleep_forever()
+
+    async def send(self, data):
+        pass
+
+    async def ping(self):
+        self.pings += 1
+        if self.pong is None:
+            raise TransportClosed()
+        if not self.pong:
+            await trio.sleep_forever()
+
+
+async def serve(monitor, connection, task_status=trio.TASK_STATUS_IGNORED):
+    """ Hold a connection open until it is reaped, and return the time it closed. """
+    with monitor.watch(connection):
+        task_status.started()
+        await trio.sleep_forever()
+    return trio.current_time()
+
+
+def make_connection(**kwargs):
+    return JsonRpcConnection(FakeTransport(**kwargs), JsonRpcConnectionType.SERVER)
+
+
+@fail_after(100)
+async def test_idle_timeout(autojump_clock, nursery):
+    monitor = ConnectionMonitor(idle_timeout=10, idle_threshold=5)
+    await nursery.start(monitor.run)
+    quiet = make_connection()
+    busy = make_connection()
+    closed = dict()
+
+    async def run(name, connection):
+        closed[name] = await serve(monitor, connection)
+
+    nursery.start_soon(run, "quiet", quiet)
+    nursery.start_soon(run, "busy", busy)
+    await trio.sleep(6)
+    assert monitor.open == 2
+    assert monitor.idle == 2
+    busy.last_activity = trio.current_time()
+    assert monitor.idle == 1
+    await trio.sleep(9)
+    assert closed == {"quiet": 10}
+    assert monitor.open == 1
+    assert monitor.reaped["idle"] == 1
+    await trio.sleep(10)
+    assert closed == {"quiet": 10, "busy": 16}
+    assert monitor.open == 0
+
+
+@fail_after(100)
+async def test_max_lifetime(autojump_clock, nursery):
+    monitor = ConnectionMonitor(max_lifetime=30)
+    await nursery.start(monitor.run)
+    connection = make_connection()
+    assert await serve(monitor, connection) == 30
+    assert monitor.reaped["lifetime"] == 1
+
+
+@fail_after(100)
+async def test_heartbeat(autojump_clock, nursery):
+    monitor = ConnectionMonitor(heartbeat_interval=10, heartbeat_timeout=5)
+    await nursery.start(monitor.run)
+    alive = make_connection(pong=True)
+    dead = make_connection(pong=False)
+    closed = make_connection(pong=None)
+    await nursery.start(serve, monitor, alive)
+    await nursery.start(serve, monitor, closed)
+    assert await serve(monitor, dead) == 15
+    assert monitor.reaped["heartbeat"] == 2
+    assert monitor.open == 1
+    await trio.sleep(20)
+    assert monitor.open == 1
+    assert alive._transport.pings == 3
+    assert closed._transport.pings == 1
+
+
+@fail_after(100)
+async def test_activity_delays_heartbeat(autojump_clock, nursery):
+    monitor = ConnectionMonitor(heartbeat_interval=10)
+    await nursery.start(monitor.run)
+    connection = make_connection()
+    await nursery.start(serve, monitor, connection)
+    for _ in range(5):
+        await trio.sleep(5)
+        connection.last_activity = trio.current_time()
+    assert connection._transport.pings == 0
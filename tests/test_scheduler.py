@@ -0,0 +1,351 @@
+import pytest
+from sansio_jsonrpc import JsonRpcRequest
+from sansio_jsonrpc.main import MissingId
+import trio
+import trio.testing
+from trio_jsonrpc import (
+    Dispatch,
+    JsonRpcRequestCancelledError,
+    JsonRpcServerOverloadedError,
+    JsonRpcServerShuttingDownError,
+    Priority,
+    Scheduler,
+)
+
+from . import fail_after
+
+
+def make_dispatch(started):
+    dispatch = Dispatch()
+
+    @dispatch.handler(priority=Priority.HIGH)
+    async def health():
+        started.append("health")
+
+    @dispatch.handler
+    async def normal(n):
+        started.append(f"normal{n}")
+        await trio.sleep(1)
+
+    @dispatch.handler(priority=Priority.LOW)
+    async def bulk(n):
+        started.append(f"bulk{n}")
+        await trio.sleep(1)
+
+    return dispatch
+
+
+@fail_after(10)
+async def test_scheduler_runs_higher_priority_first(autojump_clock, nursery):
+    started = list()
+    dispatch = make_dispatch(started)
+    assert dispatch.get_priority("health") == Priority.HIGH
+    assert dispatch.get_priority("unknown") == Priority.NORMAL
+    scheduler = Scheduler(dispatch, max_concurrent=1, max_wait=10)
+    await nursery.start(scheduler.run)
+    result_send, result_recv = trio.open_memory_channel(10)
+
+    async def submit(id_, method, *params):
+        request = JsonRpcRequest(id=id_, method=method, params=list(params))
+        await scheduler.submit(request, result_send)
+
+    await submit(0, "bulk", 0)
+    await trio.sleep(0.1)
+    await submit(1, "bulk", 1)
+    await submit(2, "normal", 0)
+    await submit(3, "health")
+    assert scheduler.queued == 3
+
+    ids = [(await result_recv.receive())[0].id for _ in range(4)]
+    assert started == ["bulk0", "health", "normal0", "bulk1"]
+    assert ids == [0, 3, 2, 1]
+
+
+@fail_after(10)
+async def test_scheduler_prevents_starvation(autojump_clock, nursery):
+    started = list()
+    dispatch = make_dispatch(started)
+    scheduler = Scheduler(dispatch, max_concurrent=1, max_wait=1.5)
+    await nursery.start(scheduler.run)
+    result_send, result_recv = trio.open_memory_channel(10)
+
+    await scheduler.submit(JsonRpcRequest(id=0, method="bulk", params=[0]), result_send)
+    await trio.sleep(0.1)
+    await scheduler.submit(JsonRpcRequest(id=1, method="bulk", params=[1]), result_send)
+    await trio.sleep(0.5)
+    for n in range(4):
+        await scheduler.submit(
+            JsonRpcRequest(id=n + 2, method="normal", params=[n]), result_send
+        )
+
+    for _ in range(6):
+        await result_recv.receive()
+    # bulk1 has waited for more than 1.5s when normal0 finishes.
+    assert started == ["bulk0", "normal0", "bulk1", "normal1", "normal2", "normal3"]
+
+
+async def test_scheduler_propagates_connection_context(nursery):
+    dispatch = Dispatch()
+
+    @dispatch.handler
+    async def whoami():
+        return dispatch.ctx
+
+    scheduler = Scheduler(dispatch)
+    await nursery.start(scheduler.run)
+    result_send, result_recv = trio.open_memory_channel(10)
+    async with dispatch.connection_context("john"):
+        await scheduler.submit(JsonRpcRequest(id=0, method="whoami"), result_send)
+        _, result = await result_recv.receive()
+    assert result == "john"
+
+
+@fail_after(20)
+async def test_scheduler_shares_capacity_between_connections(autojump_clock, nursery):
+    started = list()
+    dispatch = make_dispatch(started)
+    scheduler = Scheduler(
+        dispatch, max_concurrent=1, weight=lambda ctx: 2 if ctx == "A" else 1
+    )
+    await nursery.start(scheduler.run)
+    result_send, result_recv = trio.open_memory_channel(10)
+
+    # Occupy the only slot so that all of the requests below are queued.
+    async with dispatch.connection_context("C"):
+        request = JsonRpcRequest(id=0, method="normal", params=["C0"])
+        await scheduler.submit(request, result_send)
+    await trio.sleep(0.1)
+
+    async with dispatch.connection_context("A"):
+        for n in range(6):
+            request = JsonRpcRequest(id=n, method="normal", params=[f"A{n}"])
+            await scheduler.submit(request, result_send)
+    async with dispatch.connection_context("B"):
+        for n in range(2):
+            request = JsonRpcRequest(id=n, method="normal", params=[f"B{n}"])
+            await scheduler.submit(request, result_send)
+
+    for _ in range(9):
+        await result_recv.receive()
+    assert started == [
+        "normalC0",
+        "normalA0",
+        "normalA1",
+        "normalB0",
+        "normalA2",
+        "normalA3",
+        "normalB1",
+        "normalA4",
+        "normalA5",
+    ]
+    assert scheduler.queued == 0
+    assert not any(class_.flows for class_ in scheduler._classes)
+
+
+async def test_scheduler_rejects_non_positive_weight(nursery):
+    dispatch = make_dispatch(list())
+    scheduler = Scheduler(dispatch, weight=lambda ctx: 0)
+    await nursery.start(scheduler.run)
+    result_send, result_recv = trio.open_memory_channel(10)
+
+    async with dispatch.connection_context("A"):
+        request = JsonRpcRequest(id=0, method="normal", params=[0])
+        with pytest.raises(ValueError):
+            await scheduler.submit(request, result_send)
+    assert scheduler.queued == 0
+    assert dispatch.in_flight == 0
+
+
+@fail_after(10)
+async def test_scheduler_cancels_running_and_queued_requests(autojump_clock, nursery):
+    started = list()
+    dispatch = make_dispatch(started)
+    scheduler = Scheduler(dispatch, max_concurrent=1)
+    await nursery.start(scheduler.run)
+    result_send, result_recv = trio.open_memory_channel(10)
+
+    async def cancel(id_):
+        request = JsonRpcRequest(
+            id=MissingId(), method="$/cancelRequest", params={"id": id_}
+        )
+        await scheduler.submit(request, result_send)
+
+    async with dispatch.connection_context("A"):
+        for n in range(3):
+            request = JsonRpcRequest(id=n, method="normal", params=[n])
+            await scheduler.submit(request, result_send)
+        await trio.sleep(0.1)
+        await cancel(1)
+        await cancel(0)
+        results = [await result_recv.receive() for _ in range(3)]
+
+    assert started == ["normal0", "normal2"]
+    assert [request.id for request, _ in results] == [0, 1, 2]
+    assert isinstance(results[0][1], JsonRpcRequestCancelledError)
+    assert isinstance(results[1][1], JsonRpcRequestCancelledError)
+    assert trio.current_time() == pytest.approx(1.1)
+
+
+@fail_after(10)
+async def test_scheduler_survives_closed_result_channel(autojump_clock, nursery):
+    """
+    If a connection closes its result channel while its requests are running or
+    queued, the results are discarded and other connections are still served.
+    """
+    started = list()
+    dispatch = make_dispatch(started)
+    scheduler = Scheduler(dispatch, max_concurrent=1)
+    await nursery.start(scheduler.run)
+    closed_send, closed_recv = trio.open_memory_channel(10)
+    result_send, result_recv = trio.open_memory_channel(10)
+
+    async with dispatch.connection_context("A"):
+        for n in range(3):
+            request = JsonRpcRequest(id=n, method="normal", params=[f"A{n}"])
+            await scheduler.submit(request, closed_send)
+        await trio.sleep(0.1)
+        cancel = JsonRpcRequest(
+            id=MissingId(), method="$/cancelRequest", params={"id": 1}
+        )
+        await scheduler.submit(cancel, closed_send)
+    await closed_recv.aclose()
+
+    async with dispatch.connection_context("B"):
+        request = JsonRpcRequest(id=0, method="normal", params=["B0"])
+        await scheduler.submit(request, result_send)
+        request, result = await result_recv.receive()
+
+    assert request.id == 0
+    await trio.sleep(2)
+    assert started == ["normalA0", "normalB0", "normalA2"]
+    assert dispatch.in_flight == 0
+
+
+class FailingChannel:
+    """ A result channel that raises an unexpected exception. """
+
+    async def send(self, item):
+        raise RuntimeError("This channel always fails.")
+
+
+@fail_after(10)
+async def test_scheduler_survives_failing_result_channel(autojump_clock, nursery):
+    """ An unexpected exception in one job is logged and doesn't stop the others. """
+    started = list()
+    dispatch = make_dispatch(started)
+    scheduler = Scheduler(dispatch, max_concurrent=1)
+    await nursery.start(scheduler.run)
+    result_send, result_recv = trio.open_memory_channel(10)
+
+    await scheduler.submit(JsonRpcRequest(id=0, method="health"), FailingChannel())
+    await scheduler.submit(JsonRpcRequest(id=1, method="health"), result_send)
+    request, result = await result_recv.receive()
+
+    assert request.id == 1
+    assert started == ["health", "health"]
+    await trio.testing.wait_all_tasks_blocked()
+    assert dispatch.in_flight == 0
+
+
+@fail_after(10)
+async def test_scheduler_drain_waits_for_queued_requests(autojump_clock, nursery):
+    started = list()
+    dispatch = make_dispatch(started)
+    scheduler = Scheduler(dispatch, max_concurrent=1)
+    await nursery.start(scheduler.run)
+    result_send, result_recv = trio.open_memory_channel(10)
+    for n in range(3):
+        request = JsonRpcRequest(id=n, method="normal", params=[n])
+        if n == 2:
+            nursery.start_soon(dispatch.drain)
+            await trio.sleep(0.5)
+        await scheduler.submit(request, result_send)
+    assert dispatch.in_flight == 2
+    results = [await result_recv.receive() for _ in range(3)]
+    assert [request.id for request, _ in results] == [2, 0, 1]
+    assert isinstance(results[0][1], JsonRpcServerShuttingDownError)
+    assert started == ["normal0", "normal1"]
+    assert trio.current_time() == pytest.approx(2)
+    await trio.testing.wait_all_tasks_blocked()
+    assert dispatch.drained
+
+
+@fail_after(30)
+async def test_scheduler_sheds_standing_queue(autojump_clock, nursery):
+    started = list()
+    dispatch = make_dispatch(started)
+    scheduler = Scheduler(dispatch, max_concurrent=1, shed_target=0.5, shed_interval=1)
+    await nursery.start(scheduler.run)
+    result_send, result_recv = trio.open_memory_channel(20)
+    for n in range(10):
+        request = JsonRpcRequest(id=n, method="normal", params=[n])
+        await scheduler.submit(request, result_send)
+    results = dict()
+    for _ in range(10):
+        request, result = await result_recv.receive()
+        results[request.id] = result
+
+    # The queue delay went above the target at 1s and stayed there until 2s, so every
+    # request that was still waiting at 2s was shed.
+    assert started == ["normal0", "normal1"]
+    for n in range(2, 10):
+        assert isinstance(results[n], JsonRpcServerOverloadedError)
+    assert scheduler.shed[Priority.NORMAL] == 8
+    assert scheduler.queue_delay.count == 2
+    assert scheduler.queue_delay.max == pytest.approx(1, rel=0.01)
+
+    # Once the queue is short again, requests are admitted.
+    await trio.sleep(1)
+    request = JsonRpcRequest(id=10, method="normal", params=[10])
+    await scheduler.submit(request, result_send)
+    await result_recv.receive()
+    assert started[-1] == "normal10"
+    assert scheduler.shed[Priority.NORMAL] == 8
+
+
+@fail_after(30)
+async def test_scheduler_shedding_resets_when_queue_empties(autojump_clock, nursery):
+    started = list()
+    dispatch = make_dispatch(started)
+    scheduler = Scheduler(dispatch, max_concurrent=1, shed_target=0.5, shed_interval=1)
+    await nursery.start(scheduler.run)
+    result_send, result_recv = trio.open_memory_channel(20)
+
+    async def submit(id_, method, *params):
+        request = JsonRpcRequest(id=id_, method=method, params=list(params))
+        await scheduler.submit(request, result_send)
+
+    # The second request waits for 1s, which is above the target, and then the queue
+    # is empty.
+    await submit(0, "normal", 0)
+    await submit(1, "normal", 1)
+    await trio.sleep(10)
+
+    # After the idle period, a request that waits for 0.9s starts a new interval
+    # instead of being shed right away.
+    await submit(2, "bulk", 0)
+    await trio.sleep(0.1)
+    await submit(3, "normal", 2)
+    await trio.sleep(10)
+    assert started == ["normal0", "normal1", "bulk0", "normal2"]
+    assert scheduler.shed[Priority.NORMAL] == 0
+
+
+@fail_after(30)
+async def test_scheduler_sheds_low_priority_first(autojump_clock, nursery):
+    started = list()
+    dispatch = make_dispatch(started)
+    scheduler = Scheduler(dispatch, max_concurrent=1, shed_target=1.5, shed_interval=1)
+    await nursery.start(scheduler.run)
+    result_send, result_recv = trio.open_memory_channel(20)
+    for n in range(6):
+        request = JsonRpcRequest(id=n, method="bulk", params=[n])
+        await scheduler.submit(request, result_send)
+    for n in range(6):
+        await trio.sleep(0.5)
+        request = JsonRpcRequest(id=f"h{n}", method="health")
+        await scheduler.submit(request, result_send)
+    await trio.sleep(5)
+    assert [s for s in started if s.startswith("bulk")] == ["bulk0", "bulk1", "bulk2"]
+    assert started.count("health") == 6
+    assert scheduler.shed == {Priority.HIGH: 0, Priority.NORMAL: 0, Priority.LOW: 3}
@@ -0,0 +1,231 @@
+import subprocess
+import sys
+import textwrap
+
+import pytest
+import trio
+from trio_jsonrpc import open_jsonrpc_shm
+from trio_jsonrpc.transport import TransportClosed
+from trio_jsonrpc.transport.shm import SharedMemoryTransport
+
+from . import fail_after
+
+
+@pytest.fixture
+async def shm_pair(tmp_path):
+    server = SharedMemoryTransport.create(str(tmp_path / "rpc"), capacity=64)
+    client = SharedMemoryTransport.connect(str(tmp_path / "rpc"))
+    yield server, client
+    client.close()
+    server.close()
+    server.unlink()
+
+
+@fail_after(5)
+async def test_shm_transport_send_and_recv(shm_pair):
+    server, client = shm_pair
+    await client.send(b"foo")
+    await client.send(b"")
+    await server.send(b"bar")
+    assert await server.recv() == b"foo"
+    assert await server.recv() == b""
+    assert await client.recv() == b"bar"
+
+
+@fail_after(5)
+async def test_shm_transport_wraps_around(shm_pair):
+    server, client = shm_pair
+    # Each frame is 4 + 25 bytes, so the frames don't line up with the 64 byte buffer.
+    for i in range(20):
+        message = b"%025d" % i
+        await client.send(message)
+        assert await server.recv() == message
+
+
+@fail_after(5)
+async def test_shm_transport_recv_waits_for_send(shm_pair):
+    server, client = shm_pair
+
+    async def send_later():
+        await trio.sleep(0.1)
+        await client.send(b"foo")
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(send_later)
+        assert await server.recv() == b"foo"
+
+
+@fail_after(5)
+async def test_shm_transport_send_waits_for_space(shm_pair):
+    server, client = shm_pair
+    received = list()
+
+    async def recv_later():
+        await trio.sleep(0.1)
+        for _ in range(5):
+            received.append(await server.recv())
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(recv_later)
+        # Only two 20 byte frames fit in the buffer at a time.
+        for i in range(5):
+            await client.send(b"%016d" % i)
+    assert received == [b"%016d" % i for i in range(5)]
+
+
+@fail_after(5)
+async def test_shm_transport_concurrent_senders_wait_for_space(shm_pair):
+    """ Several tasks can wait for space in a full buffer at the same time. """
+    server, client = shm_pair
+    received = list()
+
+    async def recv_later():
+        await trio.sleep(0.1)
+        for _ in range(8):
+            received.append(await server.recv())
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(recv_later)
+        # Only two 34 byte frames fit in the buffer at a time.
+        for i in range(8):
+            nursery.start_soon(client.send, b"%030d" % i)
+    assert sorted(received) == [b"%030d" % i for i in range(8)]
+
+
+@fail_after(5)
+async def test_shm_transport_concurrent_receivers_wait_for_data(shm_pair):
+    """ Several tasks can wait for data in an empty buffer at the same time. """
+    server, client = shm_pair
+    received = list()
+
+    async def recv():
+        received.append(await server.recv())
+
+    async with trio.open_nursery() as nursery:
+        for _ in range(4):
+            nursery.start_soon(recv)
+        await trio.sleep(0.1)
+        for i in range(4):
+            await client.send(b"%d" % i)
+    assert sorted(received) == [b"0", b"1", b"2", b"3"]
+
+
+async def test_shm_transport_message_too_large(shm_pair):
+    server, client = shm_pair
+    await client.send(b"x" * 60)
+    with pytest.raises(ValueError):
+        await client.send(b"x" * 61)
+
+
+@fail_after(5)
+async def test_shm_transport_recv_closed(shm_pair):
+    server, client = shm_pair
+    await server.send(b"foo")
+    server.close()
+    assert await client.recv() == b"foo"
+    with pytest.raises(TransportClosed):
+        await client.recv()
+    with pytest.raises(TransportClosed):
+        await client.send(b"bar")
+
+
+@fail_after(5)
+async def test_shm_transport_close_wakes_peer(shm_pair):
+    server, client = shm_pair
+
+    async def close_later():
+        await trio.sleep(0.1)
+        server.close()
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(close_later)
+        with pytest.raises(TransportClosed):
+            await client.recv()
+
+
+@fail_after(5)
+async def test_shm_transport_close_wakes_own_task(shm_pair):
+    server, client = shm_pair
+
+    async def close_later():
+        await trio.sleep(0.1)
+        client.close()
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(close_later)
+        with pytest.raises(TransportClosed):
+            await client.recv()
+
+
+CRASHING_CLIENT_SCRIPT = textwrap.dedent(
+    """
+    import os
+    import sys
+    import trio
+    from trio_jsonrpc.transport.shm import SharedMemoryTransport
+
+    async def main(path):
+        transport = SharedMemoryTransport.connect(path)
+        await transport.send(b"foo")
+        os._exit(0)
+
+    trio.run(main, sys.argv[1])
+    """
+)
+
+
+@fail_after(30)
+async def test_shm_transport_peer_exits_without_closing(tmp_path):
+    """ If the peer process exits without closing the transport, recv() notices. """
+    path = str(tmp_path / "rpc")
+    server = SharedMemoryTransport.create(path)
+    try:
+        await trio.run_process([sys.executable, "-c", CRASHING_CLIENT_SCRIPT, path])
+        assert await server.recv() == b"foo"
+        with pytest.raises(TransportClosed):
+            await server.recv()
+    finally:
+        server.close()
+        server.unlink()
+
+
+SERVER_SCRIPT = textwrap.dedent(
+    """
+    import sys
+    import trio
+    from trio_jsonrpc import Dispatch, serve_jsonrpc_shm
+
+    dispatch = Dispatch()
+
+    @dispatch.handler
+    async def add(a, b):
+        return a + b
+
+    async def main(path):
+        async with serve_jsonrpc_shm(path, dispatch=dispatch):
+            print("ready", flush=True)
+            await trio.sleep_forever()
+
+    trio.run(main, sys.argv[1])
+    """
+)
+
+
+@fail_after(30)
+async def test_shm_between_processes(tmp_path):
+    path = str(tmp_path / "rpc")
+    process = subprocess.Popen(
+        [sys.executable, "-c", SERVER_SCRIPT, path], stdout=subprocess.PIPE
+    )
+    try:
+        line = await trio.to_thread.run_sync(process.stdout.readline)
+        assert line == b"ready\n"
+        async with open_jsonrpc_shm(path) as client:
+            async with trio.open_nursery() as nursery:
+                for i in range(50):
+                    nursery.start_soon(client.request, "add", [i, 1])
+            assert await client.request("add", [2, 3]) == 5
+    finally:
+        process.kill()
+        process.wait()
+        process.stdout.close()
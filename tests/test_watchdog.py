@@ -0,0 +1,46 @@
+import time
+
+from sansio_jsonrpc import JsonRpcRequest
+import trio
+from trio_jsonrpc import Dispatch, Watchdog
+
+
+async def test_watchdog_flags_blocking_handler(caplog, nursery):
+    watchdog = Watchdog(threshold=0.02, lag_interval=0.01)
+    dispatch = Dispatch(watchdog=watchdog)
+
+    @dispatch.handler
+    async def crunch(n):
+        time.sleep(0.1)
+        return n
+
+    nursery.start_soon(watchdog.run)
+    await trio.sleep(0.05)
+    request = JsonRpcRequest(id=0, method="crunch", params={"n": "x" * 100})
+    assert await dispatch.execute(request) == "x" * 100
+    await trio.sleep(0.05)
+
+    assert 'Handler "crunch" has blocked the event loop' in caplog.text
+    assert "time.sleep(0.1)" in caplog.text
+    assert "xxx...xxx" in caplog.text
+    assert 'Handler "crunch" yielded after blocking' in caplog.text
+    assert watchdog.slow_steps.count == 1
+    assert watchdog.slow_steps.max >= 0.1
+    assert watchdog.lag.count > 0
+    assert watchdog.lag.max >= 0.05
+
+
+async def test_watchdog_ignores_fast_handler(caplog, nursery):
+    watchdog = Watchdog(threshold=0.05)
+    dispatch = Dispatch(watchdog=watchdog)
+
+    @dispatch.handler
+    async def nap():
+        await trio.sleep(0.1)
+
+    nursery.start_soon(watchdog.run)
+    await dispatch.execute(JsonRpcRequest(id=0, method="nap"))
+
+    assert "blocked the event loop" not in caplog.text
+    assert watchdog.slow_steps.count == 0
+    assert not watchdog._requests
@@ -0,0 +1,211 @@
+import pytest
+from sansio_jsonrpc import JsonRpcRequest
+from sansio_jsonrpc.main import MissingId
+import trio
+import trio.testing
+from trio_jsonrpc import (
+    Dispatch,
+    JsonRpcRequestCancelledError,
+    JsonRpcServerShuttingDownError,
+    WorkerPool,
+    open_jsonrpc_memory,
+    serve_jsonrpc_memory,
+)
+
+from . import fail_after
+
+
+def make_dispatch():
+    dispatch = Dispatch()
+
+    @dispatch.handler
+    async def nap(seconds):
+        await trio.sleep(seconds)
+        return seconds
+
+    @dispatch.handler
+    async def whoami():
+        return dispatch.ctx
+
+    return dispatch
+
+
+@fail_after(10)
+async def test_fixed_pool_reuses_workers(autojump_clock, nursery):
+    dispatch = make_dispatch()
+    pool = WorkerPool(dispatch, min_workers=2)
+    await nursery.start(pool.run)
+    assert pool.size == 2
+    await trio.testing.wait_all_tasks_blocked()
+    assert pool.idle == 2
+    result_send, result_recv = trio.open_memory_channel(10)
+
+    for n in range(6):
+        await pool.submit(JsonRpcRequest(id=n, method="nap", params=[1]), result_send)
+    assert pool.size == 2
+    assert pool.queued == 4
+
+    results = [await result_recv.receive() for _ in range(6)]
+    assert sorted(request.id for request, _ in results) == list(range(6))
+    assert trio.current_time() == 3
+    assert pool.size == 2
+    assert sorted(w.requests for w in pool.workers) == [3, 3]
+    assert all(w.busy_time == 3 and not w.busy for w in pool.workers)
+    assert pool.queue_delay.count == 6
+    assert pool.queue_delay.max == 2
+
+
+@fail_after(100)
+async def test_elastic_pool_grows_and_shrinks(autojump_clock, nursery):
+    dispatch = make_dispatch()
+    pool = WorkerPool(dispatch, min_workers=1, max_workers=4, idle_timeout=5)
+    await nursery.start(pool.run)
+    result_send, result_recv = trio.open_memory_channel(10)
+
+    for n in range(6):
+        await pool.submit(JsonRpcRequest(id=n, method="nap", params=[1]), result_send)
+        await trio.testing.wait_all_tasks_blocked()
+    assert pool.size == 4
+    assert pool.queued == 2
+    for _ in range(6):
+        await result_recv.receive()
+    assert trio.current_time() == 2
+
+    # Extra workers exit after they have been idle for 5 seconds.
+    await trio.sleep(3)
+    assert pool.size == 4
+    await trio.sleep(3)
+    assert pool.size == 1
+    await trio.sleep(60)
+    assert pool.size == 1
+
+
+@fail_after(10)
+async def test_pool_sets_context_variables(autojump_clock, nursery):
+    dispatch = make_dispatch()
+    pool = WorkerPool(dispatch, min_workers=1)
+    await nursery.start(pool.run)
+    result_send, result_recv = trio.open_memory_channel(10)
+
+    done = trio.Event()
+
+    async def connection(context, id_):
+        async with dispatch.connection_context(context):
+            request = JsonRpcRequest(id=id_, method="whoami", params=[])
+            await pool.submit(request, result_send)
+            await done.wait()
+
+    async with trio.open_nursery() as connections:
+        connections.start_soon(connection, "john", 0)
+        connections.start_soon(connection, "jane", 1)
+        results = [await result_recv.receive() for _ in range(2)]
+        done.set()
+    assert {request.id: result for request, result in results} == {
+        0: "john",
+        1: "jane",
+    }
+
+
+@fail_after(10)
+async def test_pool_rejects_requests_while_draining(autojump_clock, nursery):
+    dispatch = make_dispatch()
+    pool = WorkerPool(dispatch, min_workers=1)
+    await nursery.start(pool.run)
+    result_send, result_recv = trio.open_memory_channel(10)
+    await pool.submit(JsonRpcRequest(id=0, method="nap", params=[1]), result_send)
+    await pool.submit(JsonRpcRequest(id=1, method="nap", params=[1]), result_send)
+    nursery.start_soon(dispatch.drain)
+    await trio.testing.wait_all_tasks_blocked()
+
+    await pool.submit(JsonRpcRequest(id=2, method="nap", params=[1]), result_send)
+    request, result = await result_recv.receive()
+    assert request.id == 2
+    assert isinstance(result, JsonRpcServerShuttingDownError)
+
+    # Queued requests were admitted before the drain, so they still run.
+    results = [await result_recv.receive() for _ in range(2)]
+    assert [(request.id, result) for request, result in results] == [(0, 1), (1, 1)]
+    await trio.testing.wait_all_tasks_blocked()
+    assert dispatch.drained
+
+
+@fail_after(10)
+async def test_pool_cancels_running_and_queued_requests(autojump_clock, nursery):
+    dispatch = make_dispatch()
+    pool = WorkerPool(dispatch, min_workers=1)
+    await nursery.start(pool.run)
+    result_send, result_recv = trio.open_memory_channel(10)
+
+    async def cancel(id_):
+        request = JsonRpcRequest(
+            id=MissingId(), method="$/cancelRequest", params={"id": id_}
+        )
+        await pool.submit(request, result_send)
+
+    async with dispatch.connection_context("A"):
+        for n in range(3):
+            request = JsonRpcRequest(id=n, method="nap", params=[1])
+            await pool.submit(request, result_send)
+        await trio.sleep(0.1)
+        await cancel(1)
+        await cancel(0)
+        results = [await result_recv.receive() for _ in range(3)]
+
+    assert [request.id for request, _ in results] == [0, 1, 2]
+    assert isinstance(results[0][1], JsonRpcRequestCancelledError)
+    assert isinstance(results[1][1], JsonRpcRequestCancelledError)
+    assert results[2][1] == 1
+    assert trio.current_time() == pytest.approx(1.1)
+    await trio.testing.wait_all_tasks_blocked()
+    assert dispatch.in_flight == 0
+
+
+class FailingChannel:
+    """ A result channel that raises an unexpected exception. """
+
+    async def send(self, item):
+        raise RuntimeError("This channel always fails.")
+
+
+@fail_after(10)
+async def test_pool_survives_failing_result_channel(autojump_clock, nursery):
+    """ An unexpected exception in one request is logged and the worker carries on. """
+    dispatch = make_dispatch()
+    pool = WorkerPool(dispatch, min_workers=1)
+    await nursery.start(pool.run)
+    result_send, result_recv = trio.open_memory_channel(10)
+
+    await pool.submit(JsonRpcRequest(id=0, method="nap", params=[1]), FailingChannel())
+    await pool.submit(JsonRpcRequest(id=1, method="nap", params=[1]), result_send)
+    request, result = await result_recv.receive()
+
+    assert (request.id, result) == (1, 1)
+    assert trio.current_time() == 2
+    await trio.testing.wait_all_tasks_blocked()
+    assert [w.requests for w in pool.workers] == [2]
+    assert dispatch.in_flight == 0
+
+
+@fail_after(10)
+async def test_bound_connection_with_pool(autojump_clock, nursery):
+    dispatch = make_dispatch()
+    pool = WorkerPool(dispatch, min_workers=2)
+    await nursery.start(pool.run)
+    client_send, server_recv = trio.open_memory_channel(10)
+    server_send, client_recv = trio.open_memory_channel(10)
+    async with serve_jsonrpc_memory(
+        server_send, server_recv, dispatch=dispatch, context="john", executor=pool
+    ):
+        async with open_jsonrpc_memory(client_send, client_recv) as client:
+            results = list()
+
+            async def request(seconds):
+                results.append(await client.request("nap", [seconds]))
+
+            async with trio.open_nursery() as requests:
+                for seconds in (1, 1, 1):
+                    requests.start_soon(request, seconds)
+            assert results == [1, 1, 1]
+            assert trio.current_time() == 2
+            assert await client.request("whoami", []) == "john"
+    assert sum(w.requests for w in pool.workers) == 4
@@ -139,3 +139,22 @@ async def test_client_closed(nursery):
         client_nursery.start_soon(client, 1)
 
     assert client_count == 1
+
+
+@fail_after(1)
+async def test_ping(nursery):
+    """ A WebSocket ping is answered by the peer, and fails once it disconnects. """
+    closed = trio.Event()
+
+    async def connection_handler(ws_request):
+        await ws_request.accept()
+        await closed.wait()
+
+    server = await nursery.start(
+        trio_websocket.serve_websocket, connection_handler, "localhost", 0, None
+    )
+    async with open_jsonrpc_ws(f"ws://localhost:{server.port}") as client_conn:
+        await client_conn.ping()
+    closed.set()
+    with pytest.raises(TransportClosed):
+        await client_conn.ping()
@@ -1,8 +1,14 @@
 from .main import (
+    CACHE_INVALIDATE_METHOD,
+    CANCEL_REQUEST_METHOD,
     JsonRpcConnection,
     JsonRpcConnectionType,
+    RawJson,
+    open_jsonrpc_inprocess,
     open_jsonrpc_memory,
     serve_jsonrpc_memory,
+    open_jsonrpc_shm,
+    serve_jsonrpc_shm,
     open_jsonrpc_ws,
 )
 from sansio_jsonrpc import (
@@ -16,4 +22,16 @@ from sansio_jsonrpc import (
     JsonRpcReservedError,
     JsonRpcParseError,
 )
+from .exc import (
+    JsonRpcDeadlineExceededError,
+    JsonRpcRateLimitError,
+    JsonRpcRequestCancelledError,
+    JsonRpcServerOverloadedError,
+    JsonRpcServerShuttingDownError,
+)
+from .cache import ResponseCache
 from .dispatch import Dispatch
+from .monitor import ConnectionMonitor
+from .scheduler import Priority, Scheduler
+from .watchdog import Watchdog
+from .workers import WorkerPool
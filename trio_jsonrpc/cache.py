@@ -0,0 +1,191 @@
+"""
+This module contains a client-side response cache that is used by
+:meth:`~trio_jsonrpc.main.JsonRpcConnection.request`.
+"""
+from collections import OrderedDict
+import json
+import typing
+
+import trio
+
+
+Tags = typing.Callable[[typing.Any], typing.Iterable[typing.Hashable]]
+
+
+class CachePolicy:
+    """ How long to cache the results of one method, and which tags they have. """
+
+    __slots__ = ("ttl", "tags")
+
+    def __init__(self, ttl: float, tags: typing.Optional[Tags] = None):
+        """
+        Constructor.
+
+        :param ttl: The number of seconds that a result is cached.
+        :param tags: A function that is called with the request params and returns the
+            tags for the result.
+        """
+        if ttl <= 0:
+            raise ValueError("The TTL must be positive.")
+        self.ttl = ttl
+        self.tags = tags
+
+
+class _Entry:
+    """ A cached result. """
+
+    __slots__ = ("result", "expires", "tags")
+
+    def __init__(self, result, expires, tags):
+        self.result: typing.Any = result
+        self.expires: float = expires
+        self.tags: typing.Tuple[typing.Hashable, ...] = tags
+
+
+class ResponseCache:
+    """
+    A cache of successful results, keyed by method and params.
+
+    Only methods that have a policy (see :meth:`policy`) are cached. Each result expires
+    after its method's TTL. To bound memory usage, at most ``max_entries`` results are
+    kept, and the least recently used result is discarded when that limit is reached.
+
+    A server can also invalidate cached results before they expire by sending a
+    :data:`~trio_jsonrpc.CACHE_INVALIDATE_METHOD` notification (see
+    :meth:`JsonRpcConnection.invalidate_cache
+    <trio_jsonrpc.main.JsonRpcConnection.invalidate_cache>`).
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        """
+        Constructor.
+
+        :param max_entries: The maximum number of results to keep.
+        """
+        self.max_entries = max_entries
+        self._policies: typing.Dict[str, CachePolicy] = dict()
+        self._entries: "OrderedDict[tuple, _Entry]" = OrderedDict()
+        # Maps each tag to the keys of the entries that have it.
+        self._tags: typing.Dict[typing.Hashable, typing.Set[tuple]] = dict()
+        #: This counter is incremented by every invalidation. A request compares it
+        #: before and after the round trip, so that a result that might have been
+        #: invalidated while it was in flight is not cached.
+        self.generation = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def policy(self, method: str, ttl: float, tags: typing.Optional[Tags] = None):
+        """
+        Cache the results of a method.
+
+        :param method: The method name.
+        :param ttl: The number of seconds that a result is cached.
+        :param tags: A function that is called with the request params and returns the
+            tags for the result, e.g. ``lambda params: [f"user:{params['user']}"]``.
+            The server can invalidate all results with a given tag at once.
+        """
+        self._policies[method] = CachePolicy(ttl, tags)
+
+    def is_cached(self, method: str) -> bool:
+        """ Return True if the results of a method are cached. """
+        return method in self._policies
+
+    def get(
+        self, method: str, params: typing.Union[dict, list, None]
+    ) -> typing.Tuple[bool, typing.Any]:
+        """
+        Look up a result.
+
+        :returns: A tuple of ``(True, result)`` if the result is cached, or else
+            ``(False, None)``.
+        """
+        key = _key(method, params)
+        try:
+            entry = self._entries[key]
+        except KeyError:
+            return False, None
+        if entry.expires <= trio.current_time():
+            self._remove(key)
+            return False, None
+        self._entries.move_to_end(key)
+        return True, entry.result
+
+    def put(
+        self,
+        method: str,
+        params: typing.Union[dict, list, None],
+        result: typing.Any,
+        generation: typing.Optional[int] = None,
+    ) -> None:
+        """
+        Cache a result, if its method has a policy.
+
+        :param generation: The value of :attr:`generation` when the request was sent.
+            If any invalidation happened since then, the result is not cached.
+        """
+        policy = self._policies.get(method)
+        if policy is None:
+            return
+        if generation is not None and generation != self.generation:
+            return
+        key = _key(method, params)
+        if key in self._entries:
+            self._remove(key)
+        elif len(self._entries) >= self.max_entries:
+            self._remove(next(iter(self._entries)))
+        tags = tuple(policy.tags(params)) if policy.tags is not None else ()
+        self._entries[key] = _Entry(result, trio.current_time() + policy.ttl, tags)
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+
+    def invalidate(
+        self,
+        method: typing.Optional[str] = None,
+        params: typing.Union[dict, list, None] = None,
+        tags: typing.Optional[typing.Iterable[typing.Hashable]] = None,
+    ) -> None:
+        """
+        Discard cached results.
+
+        If ``method`` and ``params`` are both given, then the result for that request is
+        discarded. If only ``method`` is given, then all results for that method are
+        discarded. All results that have any of the ``tags`` are discarded. If no
+        arguments are given, everything is discarded.
+        """
+        self.generation += 1
+        if method is None and tags is None:
+            self._entries.clear()
+            self._tags.clear()
+            return
+        if method is not None:
+            if params is not None:
+                keys: typing.Iterable[tuple] = (_key(method, params),)
+            else:
+                keys = [key for key in self._entries if key[0] == method]
+            for key in keys:
+                self._remove(key)
+        for tag in tags or ():
+            for key in list(self._tags.get(tag, ())):
+                self._remove(key)
+
+    def _remove(self, key: tuple) -> None:
+        """ Remove an entry, if present, and its tags. """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry.tags:
+            keys = self._tags[tag]
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+
+
+def _key(method: str, params: typing.Union[dict, list, None]) -> tuple:
+    """
+    Return the cache key for a request. Params are serialized canonically, so that
+    equal params have equal keys regardless of the order of object members.
+    """
+    if params is None:
+        return (method, None)
+    return (method, json.dumps(params, sort_keys=True, separators=(",", ":")))
@@ -0,0 +1,171 @@
+"""
+This module contains adaptive concurrency limits that are used by
+:meth:`~trio_jsonrpc.Dispatch.adaptive_limit`.
+
+A fixed concurrency limit for a handler is always wrong for some downstream dependency:
+too low and the server leaves capacity unused, too high and a slow backend builds a
+queue that every request waits in. An adaptive limit finds the right value from the
+handler's latency, in the style of TCP Vegas. It tracks the lowest latency seen
+recently, which estimates the latency without queueing, and compares each new latency
+to it. If latency rises, then requests are queueing somewhere downstream, and the limit
+is lowered. If latency stays close to the minimum while the limit is in use, then the
+limit is raised.
+"""
+import math
+import typing
+
+import trio
+
+from .exc import JsonRpcServerOverloadedError
+from .metrics import Histogram
+
+
+class AdaptiveLimit:
+    """
+    A concurrency limit for one method that adapts to the method's latency.
+
+    After each call, the limit estimates how many calls are queued downstream as
+    ``limit * (1 - min_latency / latency)``. If fewer than ``alpha`` calls are queued,
+    the limit increases, and if more than ``beta`` calls are queued, it decreases, where
+    ``alpha`` and ``beta`` are 3 and 6 times ``log10(limit)``. A call that is cancelled,
+    e.g. because its deadline passed, also decreases the limit. The limit does not
+    increase while fewer than half of its slots are in use, since latency says nothing
+    about spare capacity then.
+
+    The minimum latency is measured again periodically, so that the limit can adjust if
+    a backend becomes permanently slower. Latency measured under load includes queueing,
+    so to probe, the limit briefly drops to ``min_limit``, and the latency of the first
+    call that starts after the downstream queue has drained becomes the new minimum.
+    """
+
+    def __init__(
+        self,
+        initial: int = 10,
+        min_limit: int = 1,
+        max_limit: int = 200,
+        max_waiting: typing.Optional[int] = None,
+        probe_multiplier: int = 30,
+    ):
+        """
+        Constructor.
+
+        :param initial: The initial limit.
+        :param min_limit: The lowest limit.
+        :param max_limit: The highest limit.
+        :param max_waiting: If set, a call that arrives while this many calls are
+            waiting for a slot fails with a
+            :class:`~trio_jsonrpc.JsonRpcServerOverloadedError`. Otherwise, calls wait
+            without limit.
+        :param probe_multiplier: The minimum latency is probed after
+            ``probe_multiplier * limit`` calls.
+        """
+        if not 1 <= min_limit <= initial <= max_limit:
+            raise ValueError("The limits must satisfy 1 <= min <= initial <= max.")
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_waiting = max_waiting
+        self.probe_multiplier = probe_multiplier
+        self._limiter = trio.CapacityLimiter(initial)
+        self._estimate = float(initial)
+        self._waiting = 0
+        self._samples = 0
+        # Each change to the limit starts a new epoch. Only calls that started in the
+        # current epoch can change the limit again, so that it changes at most once
+        # per round trip, after the previous change has had an effect.
+        self._epoch = 0
+        self._probing = False
+        #: The lowest latency seen since the last reset, in seconds.
+        self.min_latency = math.inf
+        #: The latency of each call, in seconds, not counting the wait for a slot.
+        self.latency = Histogram()
+
+    @property
+    def limit(self) -> int:
+        """ The current limit. """
+        return int(self._limiter.total_tokens)
+
+    @property
+    def in_flight(self) -> int:
+        """ The number of calls that are running. """
+        return self._limiter.borrowed_tokens
+
+    @property
+    def waiting(self) -> int:
+        """ The number of calls that are waiting for a slot. """
+        return self._waiting
+
+    async def run(self, fn: typing.Callable, *args) -> typing.Any:
+        """ Wait for a slot, call ``await fn(*args)``, and update the limit. """
+        if (
+            self.max_waiting is not None
+            and self._waiting >= self.max_waiting
+            and self._limiter.available_tokens < 1
+        ):
+            raise JsonRpcServerOverloadedError(
+                "Too many calls are waiting for the concurrency limit."
+            )
+        borrower = object()
+        self._waiting += 1
+        try:
+            await self._limiter.acquire_on_behalf_of(borrower)
+        finally:
+            self._waiting -= 1
+        in_flight = self._limiter.borrowed_tokens
+        epoch = self._epoch
+        start = trio.current_time()
+        dropped = True
+        try:
+            result = await fn(*args)
+            dropped = False
+            return result
+        finally:
+            self._limiter.release_on_behalf_of(borrower)
+            self._update(trio.current_time() - start, in_flight, dropped, epoch)
+
+    def _update(
+        self, latency: float, in_flight: int, dropped: bool, epoch: int
+    ) -> None:
+        """ Adjust the limit after a call. """
+        if not dropped:
+            self.latency.record(latency)
+        if epoch != self._epoch:
+            if not dropped and latency < self.min_latency:
+                self.min_latency = latency
+            return
+        if self._probing:
+            if not dropped:
+                # This call started after the probe drained the queue.
+                self.min_latency = latency
+                self._probing = False
+                self._epoch += 1
+                self._limiter.total_tokens = max(1, int(self._estimate))
+            return
+        estimate = self._estimate
+        step = max(1.0, math.log10(estimate))
+        if dropped:
+            estimate -= step
+        else:
+            self._samples += 1
+            if self._samples >= self.probe_multiplier * estimate:
+                self._samples = 0
+                self._probing = True
+                self._epoch += 1
+                self._limiter.total_tokens = self.min_limit
+                return
+            if latency < self.min_latency:
+                self.min_latency = latency
+            if in_flight * 2 < estimate or latency <= 0:
+                return
+            queued = estimate * (1 - self.min_latency / latency)
+            if queued <= step:
+                # Almost nothing is queued, so grow quickly.
+                estimate += 6 * step
+            elif queued < 3 * step:
+                estimate += step
+            elif queued > 6 * step:
+                estimate -= step
+            else:
+                return
+        self._estimate = max(self.min_limit, min(self.max_limit, estimate))
+        self._epoch += 1
+        self._limiter.total_tokens = max(1, int(self._estimate))
@@ -4,22 +4,37 @@ server to specific handler functions. Use of this module is completely optional,
 is entirely possible to dispatch JSON-RPC methods yourself by directly calling the
 server's ``iter_requests()`` method.
 """
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, contextmanager
 import contextvars
-from functools import partial
+import enum
+from functools import partial, wraps
+import inspect
 from itertools import count
 import logging
+import math
+import time
 import types
 import typing
 
 from sansio_jsonrpc import JsonRpcRequest
 import trio
 from trio_jsonrpc import (
+    CANCEL_REQUEST_METHOD,
     JsonRpcConnection,
     JsonRpcInternalError,
     JsonRpcException,
     JsonRpcMethodNotFoundError,
 )
+from .exc import (
+    JsonRpcDeadlineExceededError,
+    JsonRpcRateLimitError,
+    JsonRpcRequestCancelledError,
+    JsonRpcServerShuttingDownError,
+)
+from .concurrency import AdaptiveLimit
+from .metrics import Histogram
+from .ratelimit import RateLimit
+from .watchdog import Watchdog
 
 # A sentinel value indicating that a connection context has not been set.
 ContextNotSet = type("ContextNotSet", (object,), dict())()
@@ -28,6 +43,20 @@ logger = logging.getLogger(__name__)
 contexts: typing.Dict[int, typing.Any] = dict()
 connection_id = contextvars.ContextVar("connection_id", default=ContextNotSet)
 connection_id_gen = count()
+Middleware = typing.Callable[..., typing.Awaitable[typing.Any]]
+
+
+class Priority(enum.IntEnum):
+    """
+    The priority class of a JSON-RPC method. Lower values are served first.
+    """
+
+    #: Health checks and other control-plane methods.
+    HIGH = 0
+    #: The default priority.
+    NORMAL = 1
+    #: Bulk or background work.
+    LOW = 2
 
 
 class Dispatch:
@@ -38,13 +67,49 @@ class Dispatch:
     dispatcher, it looks up the registered handler and calls it in a new task.
     """
 
-    def __init__(self):
+    def __init__(
+        self,
+        watchdog: typing.Optional[Watchdog] = None,
+        inline_threshold: float = 0.001,
+    ):
         """
         Constructor.
 
-        :param nursery: A Nursery to launch handler tasks in.
+        :param watchdog: An optional watchdog that flags handlers that block the event
+            loop.
+        :param inline_threshold: An inline handler that runs for longer than this many
+            seconds is logged and recorded in :attr:`slow_inline`.
         """
-        self._handlers = dict()
+        self._handlers: typing.Dict[str, typing.Callable] = dict()
+        # Maps method name to the plain function of each inline handler.
+        self._inline: typing.Dict[str, typing.Callable] = dict()
+        self._slow_inline_methods: typing.Set[str] = set()
+        self.inline_threshold = inline_threshold
+        #: The duration of each inline handler call that exceeded the threshold.
+        self.slow_inline = Histogram()
+        self._watchdog = watchdog
+        self._middleware: typing.List[Middleware] = list()
+        # Maps method name to a pre-composed middleware chain. Chains are built lazily
+        # on first use and thrown away whenever the handlers or middleware change.
+        self._chains: typing.Dict[str, typing.Callable] = dict()
+        self._priorities: typing.Dict[str, Priority] = dict()
+        # Maps (connection ID, request ID) to the cancel scope of a running handler.
+        self._running: typing.Dict[tuple, trio.CancelScope] = dict()
+        # Maps method name to its rate limits. Global limits use the key None.
+        self._rate_limits: typing.Dict[
+            typing.Optional[str], typing.List[RateLimit]
+        ] = dict()
+        # Maps method name to its adaptive concurrency limit.
+        self._adaptive_limits: typing.Dict[str, AdaptiveLimit] = dict()
+        # State for draining (see drain()): the number of admitted requests that have
+        # not sent their results, the cancel scopes of running handlers, and the cancel
+        # scopes of blocks that run until the dispatch is drained.
+        self._draining = False
+        self._drain_expired = False
+        self._drained = trio.Event()
+        self._in_flight = 0
+        self._handler_scopes: typing.Set[trio.CancelScope] = set()
+        self._intake_scopes: typing.Set[trio.CancelScope] = set()
 
     @property
     def ctx(self) -> typing.Any:
@@ -70,19 +135,236 @@ class Dispatch:
             connection_id.reset(token)
             del contexts[id_]
 
-    def handler(self, fn):
+    def handler(
+        self, fn=None, *, priority: Priority = Priority.NORMAL, inline: bool = False
+    ):
         """
         A decorator that registers an async function as a handler.
 
+        It may be used bare, as ``@dispatch.handler``, or with a priority class, as
+        ``@dispatch.handler(priority=Priority.HIGH)``. The priority is used by
+        :class:`~trio_jsonrpc.Scheduler`.
+
+        A plain function that returns quickly without blocking, such as a lookup in a
+        dictionary, can be registered with ``inline=True``. A connection that is bound
+        to the dispatch calls an inline handler directly from its background task and
+        sends the result immediately, without starting a task (see :meth:`is_inline`).
+
         :param fn: The function to decorate.
+        :param priority: The method's priority class.
+        :param inline: True if ``fn`` is a plain function to run inline.
         """
+        if fn is None:
+            return partial(self.handler, priority=priority, inline=inline)
         try:
             name = fn.__name__
         except AttributeError:
             raise RuntimeError(
                 "The Dispatch.handler() decorator must be applied to a named function."
             )
-        self._handlers[name] = fn
+        self._inline.pop(name, None)
+        if inline:
+            if inspect.iscoroutinefunction(fn):
+                raise RuntimeError(
+                    f'Inline handler "{name}" must be a plain function, not async.'
+                )
+            self._inline[name] = fn
+            self._handlers[name] = self._wrap_inline(name, fn)
+        else:
+            self._handlers[name] = fn
+        self._priorities[name] = Priority(priority)
+        self._chains.pop(name, None)
+
+    def middleware(self, fn: Middleware) -> Middleware:
+        """
+        A decorator that registers an async function as middleware.
+
+        Middleware is called as ``await fn(request, call_next)`` around every handler
+        and must return the method's result, typically by returning ``await
+        call_next(request)``. It may also raise a :class:`JsonRpcException` instead of
+        calling the next layer, or catch and translate exceptions raised by inner
+        layers. Middleware is applied in registration order, i.e. the first middleware
+        registered is the outermost layer.
+
+        :param fn: The function to decorate.
+        """
+        self._middleware.append(fn)
+        self._chains.clear()
+        return fn
+
+    def rate_limit(
+        self,
+        rate: float,
+        burst: typing.Optional[float] = None,
+        *,
+        method: typing.Optional[str] = None,
+        key: typing.Optional[typing.Callable[[typing.Any], typing.Hashable]] = None,
+        max_keys: int = 10_000,
+    ) -> RateLimit:
+        """
+        Add a token-bucket rate limit that is enforced by :meth:`check_rate_limit`.
+
+        :param rate: The number of requests per second.
+        :param burst: The number of requests that can be made at once after a period of
+            inactivity. Defaults to ``rate``.
+        :param method: If set, only this method is limited. Otherwise, the limit
+            applies to all methods combined.
+        :param key: If set, this function is called with the connection context (see
+            :attr:`ctx`) and the limit applies separately to each distinct return
+            value, e.g. ``key=lambda ctx: ctx.user`` limits each user. The connection
+            context must be set when :meth:`check_rate_limit` is called, or it raises
+            ``RuntimeError``.
+        :param max_keys: The maximum number of distinct keys to track.
+        :returns: The new rate limit.
+        """
+        limit = RateLimit(rate, burst, key, max_keys)
+        self._rate_limits.setdefault(method, list()).append(limit)
+        return limit
+
+    def check_rate_limit(self, request: JsonRpcRequest) -> None:
+        """
+        Consume a token from each rate limit that applies to a request.
+
+        This is synchronous so that the server can reject a request before starting a
+        handler task for it. A request that is rejected does not consume any tokens.
+        A :data:`~trio_jsonrpc.CANCEL_REQUEST_METHOD` notification is never limited,
+        so that clients can still cancel requests when the server is overloaded.
+
+        :raises JsonRpcRateLimitError: if any of the rate limits is exceeded.
+        """
+        if not self._rate_limits or request.method == CANCEL_REQUEST_METHOD:
+            return
+        now = trio.current_time()
+        buckets = list()
+        retry_after = 0.0
+        for method in (None, request.method):
+            for limit in self._rate_limits.get(method, ()):
+                ctx = self.ctx if limit.key is not None else None
+                bucket = limit.get_bucket(ctx, now)
+                tokens = bucket.refill(limit.rate, limit.burst, now)
+                if tokens < 1:
+                    retry_after = max(retry_after, (1 - tokens) / limit.rate)
+                buckets.append(bucket)
+        if retry_after:
+            raise JsonRpcRateLimitError(
+                f'Rate limit exceeded for method "{request.method}".',
+                data={"retry_after": retry_after},
+            )
+        for bucket in buckets:
+            bucket.tokens -= 1
+
+    def adaptive_limit(
+        self,
+        method: str,
+        initial: int = 10,
+        min_limit: int = 1,
+        max_limit: int = 200,
+        max_waiting: typing.Optional[int] = None,
+    ) -> AdaptiveLimit:
+        """
+        Limit the number of concurrent calls to a method's handler, and adjust that
+        limit from the handler's latency.
+
+        A call that exceeds the limit waits for a slot inside the request's deadline, so
+        a slow backend applies backpressure to the clients that use it.
+
+        :param method: The method to limit.
+        :param initial: The initial limit.
+        :param min_limit: The lowest limit.
+        :param max_limit: The highest limit.
+        :param max_waiting: If set, a call that arrives while this many calls are
+            waiting for a slot fails with a :class:`JsonRpcServerOverloadedError`.
+        :returns: The new limit, which reports its current value and statistics.
+        """
+        limit = AdaptiveLimit(initial, min_limit, max_limit, max_waiting)
+        self._adaptive_limits[method] = limit
+        return limit
+
+    @property
+    def adaptive_limits(self) -> typing.Dict[str, AdaptiveLimit]:
+        """ A new dictionary that maps each method to its adaptive limit. """
+        return dict(self._adaptive_limits)
+
+    def is_inline(self, method: str) -> bool:
+        """
+        Return True if a method can be called with :meth:`call_inline`.
+
+        The method's handler must be registered with ``inline=True``. Middleware is
+        async, so if any middleware is registered, or if the method has an adaptive
+        limit, then the handler is called in a task like any other handler.
+        """
+        return (
+            method in self._inline
+            and not self._middleware
+            and method not in self._adaptive_limits
+        )
+
+    def call_inline(self, request: JsonRpcRequest) -> typing.Any:
+        """
+        Call an inline handler synchronously and return the outcome, either a result or
+        an error.
+
+        The request is rejected if its deadline has already passed or the dispatch is
+        draining. The handler runs without a cancel scope, so it can't be cancelled.
+
+        :param request: A request for a method where :meth:`is_inline` is True.
+        """
+        if self._draining:
+            return JsonRpcServerShuttingDownError(
+                f'Rejected method "{request.method}": the server is shutting down.'
+            )
+        deadline = getattr(request, "deadline", None)
+        if deadline is not None and trio.current_time() >= deadline:
+            return JsonRpcDeadlineExceededError(
+                f'Deadline exceeded for method "{request.method}".'
+            )
+        fn = self._inline[request.method]
+        params = request.params
+        try:
+            if isinstance(params, list):
+                return self._run_inline(request.method, fn, params, {})
+            elif isinstance(params, dict):
+                return self._run_inline(request.method, fn, (), params)
+            else:
+                return self._run_inline(request.method, fn, (), {})
+        except JsonRpcException as jre:
+            return jre
+        except Exception:
+            logger.exception(
+                'An unhandled exception occurred in handler "%s"', request.method,
+            )
+            return JsonRpcInternalError("An unhandled exception occurred.")
+
+    def _wrap_inline(self, name: str, fn: typing.Callable) -> typing.Callable:
+        """ Wrap an inline handler so that it can also be called like an async one. """
+
+        @wraps(fn)
+        async def handler(*args, **kwargs):
+            return self._run_inline(name, fn, args, kwargs)
+
+        return handler
+
+    def _run_inline(
+        self, method: str, fn: typing.Callable, args: typing.Sequence, kwargs: dict
+    ) -> typing.Any:
+        """ Call an inline handler and flag it if it is slow. """
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            if elapsed > self.inline_threshold:
+                self.slow_inline.record(elapsed)
+                # Warn once per method, since a slow inline handler is usually slow on
+                # every call.
+                if method not in self._slow_inline_methods:
+                    self._slow_inline_methods.add(method)
+                    logger.warning(
+                        'Inline handler "%s" blocked the event loop for %0.3fs: it '
+                        "should be an async handler",
+                        method,
+                        elapsed,
+                    )
 
     async def execute(self, request: JsonRpcRequest) -> typing.Any:
         """
@@ -103,34 +385,241 @@ class Dispatch:
             raise result
         return result
 
+    @property
+    def draining(self) -> bool:
+        """ True if :meth:`drain` has been called. """
+        return self._draining
+
+    @property
+    def drained(self) -> bool:
+        """ True if the dispatch is draining and no requests are in flight. """
+        return self._drained.is_set()
+
+    @property
+    def in_flight(self) -> int:
+        """ The number of admitted requests that have not sent their results yet. """
+        return self._in_flight
+
+    def admit(self, request: JsonRpcRequest) -> None:
+        """
+        Count a request as in flight until :meth:`release` is called.
+
+        :meth:`handle_request` does this itself. An executor that queues requests, such
+        as :class:`~trio_jsonrpc.Scheduler`, calls this when a request is queued, so
+        that :meth:`drain` waits for queued requests, too.
+
+        :raises JsonRpcServerShuttingDownError: if the dispatch is draining.
+        """
+        if self._draining:
+            raise JsonRpcServerShuttingDownError(
+                f'Rejected method "{request.method}": the server is shutting down.'
+            )
+        self._in_flight += 1
+
+    def release(self) -> None:
+        """ Stop counting a request that was admitted with :meth:`admit`. """
+        self._in_flight -= 1
+        if self._draining and self._in_flight == 0:
+            self._set_drained()
+
+    async def drain(self, timeout: float = math.inf) -> bool:
+        """
+        Drain the dispatch before the server shuts down.
+
+        New requests are rejected with a :class:`JsonRpcServerShuttingDownError`,
+        which clients can safely retry. Requests that were already admitted, whether
+        running or queued, may finish until the timeout expires, and then they are
+        cancelled. Finally, every block running in :meth:`until_drained` is cancelled.
+
+        :param timeout: The number of seconds to wait for requests that are in flight.
+        :returns: True if every request finished in time, or False if some requests
+            were cancelled.
+        """
+        self._draining = True
+        if self._in_flight == 0:
+            self._set_drained()
+        with trio.move_on_after(timeout):
+            await self._drained.wait()
+            return True
+        logger.warning(
+            "Cancelling %d requests that did not finish draining", self._in_flight
+        )
+        self._drain_expired = True
+        for scope in self._handler_scopes:
+            scope.cancel()
+        await self._drained.wait()
+        return False
+
+    @contextmanager
+    def until_drained(self) -> typing.Iterator[None]:
+        """
+        Run a block, such as a loop that reads requests from a connection, until the
+        dispatch is drained, and then cancel it. Reading continues while draining, so
+        that new requests are rejected instead of left unanswered.
+        """
+        with trio.CancelScope() as cancel_scope:
+            if self.drained:
+                cancel_scope.cancel()
+            self._intake_scopes.add(cancel_scope)
+            try:
+                yield
+            finally:
+                self._intake_scopes.discard(cancel_scope)
+
+    def _set_drained(self) -> None:
+        self._drained.set()
+        for scope in self._intake_scopes:
+            scope.cancel()
+
     async def handle_request(
-        self, request: JsonRpcRequest, result_channel: trio.MemorySendChannel,
+        self,
+        request: JsonRpcRequest,
+        result_channel: trio.abc.SendChannel,
+        admitted: bool = False,
     ) -> None:
         """
         Dispatch a JSON-RPC request and send its result to the given channel.
 
+        If the request has a deadline (see :meth:`JsonRpcConnection.request`), then the
+        handler is skipped if the deadline has already passed, e.g. while the request
+        was queued, or else it runs inside a cancel scope with that deadline. In either
+        case, the result is a :class:`JsonRpcDeadlineExceededError` if the deadline
+        passes.
+
+        While the handler is running, it can be cancelled by :meth:`cancel_request`.
+        A :data:`~trio_jsonrpc.CANCEL_REQUEST_METHOD` notification is handled
+        internally by calling that method, and no result is sent for it.
+
+        While the dispatch is draining (see :meth:`drain`), the result is a
+        :class:`JsonRpcServerShuttingDownError` unless the request was already
+        admitted.
+
         :param request:
         :param result_channel:
+        :param admitted: True if the caller already called :meth:`admit` for this
+            request.
         :returns: The outcome of executing the JSON-RPC method, either a result or an
             error.
         """
+        if request.method == CANCEL_REQUEST_METHOD:
+            self.cancel_request(cancelled_request_id(request), result_channel)
+            return
+        if not admitted:
+            try:
+                self.admit(request)
+            except JsonRpcServerShuttingDownError as exc:
+                await result_channel.send((request, exc))
+                return
         try:
-            handler = self.get_handler(request.method)
-            params = request.params
-            if isinstance(params, list):
-                result = await handler(*params)
-            elif isinstance(params, dict):
-                result = await handler(**params)
+            with trio.CancelScope() as drain_scope:
+                if self._drain_expired:
+                    drain_scope.cancel()
+                self._handler_scopes.add(drain_scope)
+                try:
+                    if self._watchdog is None:
+                        result = await self._dispatch(request, result_channel)
+                    else:
+                        with self._watchdog.watch(request):
+                            result = await self._dispatch(request, result_channel)
+                finally:
+                    self._handler_scopes.discard(drain_scope)
+            if drain_scope.cancelled_caught:
+                result = JsonRpcRequestCancelledError(
+                    f'Request for method "{request.method}" was cancelled because '
+                    "the server is shutting down."
+                )
+            await result_channel.send((request, result))
+        finally:
+            self.release()
+
+    def cancel_request(
+        self,
+        request_id: typing.Any,
+        result_channel: typing.Optional[trio.abc.SendChannel] = None,
+    ) -> bool:
+        """
+        Cancel the handler that is running a request on the current connection.
+
+        Request IDs are only unique within a connection. The connection is identified
+        by its connection context, or if there is none, by its result channel.
+
+        :param request_id: The ID of the request to cancel.
+        :param result_channel: The connection's result channel, which is required if
+            no connection context is set.
+        :returns: True if a handler was cancelled, or False if no handler is running
+            that request, e.g. because it already finished.
+        """
+        connection = _connection_key(result_channel)
+        if connection is None or request_id is None:
+            return False
+        try:
+            scope = self._running[(connection, request_id)]
+        except (KeyError, TypeError):
+            return False
+        scope.cancel()
+        return True
+
+    async def _dispatch(
+        self, request: JsonRpcRequest, result_channel: trio.abc.SendChannel
+    ) -> typing.Any:
+        """
+        Run a request within its deadline, if any, and where it can be cancelled by
+        :meth:`cancel_request`, and return the outcome.
+        """
+        deadline = getattr(request, "deadline", None)
+        if deadline is None:
+            if request.is_notification:
+                return await self._call(request)
+            deadline = math.inf
+        if trio.current_time() < deadline:
+            with trio.CancelScope(deadline=deadline) as cancel_scope:
+                if request.is_notification:
+                    # Notifications can't be cancelled, because they don't have an ID.
+                    return await self._call(request)
+                key = (_connection_key(result_channel), request.id)
+                self._running[key] = cancel_scope
+                try:
+                    return await self._call(request)
+                finally:
+                    if self._running.get(key) is cancel_scope:
+                        del self._running[key]
+            if trio.current_time() < deadline:
+                return JsonRpcRequestCancelledError(
+                    f'Request for method "{request.method}" was cancelled.'
+                )
+        return JsonRpcDeadlineExceededError(
+            f'Deadline exceeded for method "{request.method}".'
+        )
+
+    async def _call(self, request: JsonRpcRequest) -> typing.Any:
+        """
+        Run a request through the middleware and handler, within the method's adaptive
+        limit if it has one, and return the outcome.
+        """
+        if self._adaptive_limits:
+            limit = self._adaptive_limits.get(request.method)
+            if limit is not None:
+                try:
+                    return await limit.run(self._invoke, request)
+                except JsonRpcException as jre:
+                    return jre
+        return await self._invoke(request)
+
+    async def _invoke(self, request: JsonRpcRequest) -> typing.Any:
+        """ Run a request through the middleware and handler and return the outcome. """
+        try:
+            if self._middleware:
+                result = await self._get_chain(request.method)(request)
             else:
-                result = await handler()
+                result = await _call_handler(self.get_handler(request.method), request)
         except JsonRpcException as jre:
             result = jre
         except Exception as exc:
             logger.exception(
-                'An unhandled exception occurred in handler "%s"', handler.__name__,
+                'An unhandled exception occurred in handler "%s"', request.method,
             )
             result = JsonRpcInternalError("An unhandled exception occurred.")
-        await result_channel.send((request, result))
+        return result
 
     def get_handler(self, method: str):
         """ Find the handler function for a given JSON-RPC method name. """
@@ -138,3 +627,67 @@ class Dispatch:
             return self._handlers[method]
         except KeyError:
             raise JsonRpcMethodNotFoundError(f'Method "{method}" not found.') from None
+
+    def get_priority(self, method: str) -> Priority:
+        """ Find the priority class for a given JSON-RPC method name. """
+        return self._priorities.get(method, Priority.NORMAL)
+
+    def _get_chain(self, method: str) -> typing.Callable:
+        """
+        Return the middleware chain for a given JSON-RPC method name.
+
+        The chain is composed once per method and cached, so that each request only
+        pays for the middleware calls themselves.
+        """
+        try:
+            return self._chains[method]
+        except KeyError:
+            pass
+        chain: typing.Callable = partial(_call_handler, self.get_handler(method))
+        for middleware in reversed(self._middleware):
+            chain = _compose(middleware, chain)
+        self._chains[method] = chain
+        return chain
+
+
+def cancelled_request_id(request: JsonRpcRequest) -> typing.Any:
+    """ Return the request ID from a cancellation notification, or None. """
+    params = request.params
+    if isinstance(params, dict):
+        return params.get("id")
+    elif isinstance(params, list) and params:
+        return params[0]
+    return None
+
+
+def _connection_key(
+    result_channel: typing.Optional[trio.abc.SendChannel],
+) -> typing.Hashable:
+    """
+    Identify the current connection by its connection context, if one is set, or else
+    by its result channel.
+    """
+    id_ = connection_id.get()
+    return result_channel if id_ is ContextNotSet else id_
+
+
+def _compose(middleware: Middleware, call_next: typing.Callable) -> typing.Callable:
+    """ Bind a middleware function to the next layer of the chain. """
+
+    def call(request: JsonRpcRequest) -> typing.Awaitable[typing.Any]:
+        return middleware(request, call_next)
+
+    return call
+
+
+async def _call_handler(
+    handler: typing.Callable, request: JsonRpcRequest
+) -> typing.Any:
+    """ Call a handler with the params from a request. """
+    params = request.params
+    if isinstance(params, list):
+        return await handler(*params)
+    elif isinstance(params, dict):
+        return await handler(**params)
+    else:
+        return await handler()
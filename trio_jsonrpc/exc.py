@@ -0,0 +1,64 @@
+"""
+This module contains JSON-RPC exceptions that are raised by this library (as opposed to
+the exceptions defined in ``sansio-jsonrpc``).
+
+The JSON-RPC specification reserves the codes from -32000 to -32099 for
+implementation-defined server errors, so most of these errors use codes in that range.
+The exception is :class:`JsonRpcRequestCancelledError`, which uses the same code as the
+Language Server Protocol. That code is outside of the reserved range, so it is an
+application error.
+"""
+from sansio_jsonrpc import JsonRpcApplicationError, JsonRpcReservedError
+
+
+class JsonRpcRateLimitError(JsonRpcReservedError):
+    """
+    The request was rejected because it exceeds a rate limit.
+
+    The error data contains a ``retry_after`` key: the number of seconds until the
+    request would be accepted.
+    """
+
+    ERROR_CODE = -32001
+    ERROR_MESSAGE = "Rate limit exceeded."
+
+
+class JsonRpcDeadlineExceededError(JsonRpcReservedError):
+    """
+    The request's deadline passed before the handler finished, so the handler was
+    skipped or cancelled.
+    """
+
+    ERROR_CODE = -32002
+    ERROR_MESSAGE = "Deadline exceeded."
+
+
+class JsonRpcServerShuttingDownError(JsonRpcReservedError):
+    """
+    The request was rejected because the server is draining before it shuts down.
+
+    The handler did not run, so the request can safely be retried, e.g. on a new
+    connection to another server.
+    """
+
+    ERROR_CODE = -32003
+    ERROR_MESSAGE = "Server is shutting down."
+
+
+class JsonRpcServerOverloadedError(JsonRpcReservedError):
+    """
+    The request was shed because the server is overloaded (see
+    :class:`~trio_jsonrpc.Scheduler`).
+
+    The handler did not run, so the request can be retried, preferably after a delay.
+    """
+
+    ERROR_CODE = -32004
+    ERROR_MESSAGE = "Server overloaded."
+
+
+class JsonRpcRequestCancelledError(JsonRpcApplicationError):
+    """ The client cancelled the request, so the handler was skipped or cancelled. """
+
+    ERROR_CODE = -32800
+    ERROR_MESSAGE = "Request cancelled."
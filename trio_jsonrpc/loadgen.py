@@ -0,0 +1,236 @@
+"""
+An open-loop load generator for JSON-RPC servers.
+
+Requests are issued at a fixed arrival rate regardless of how quickly the server
+responds, and each request's latency is measured from the time it *should* have been
+sent. This avoids the coordinated omission problem of closed-loop load generators,
+where a slow server also slows down the rate of requests and hides its own queueing
+delay.
+
+The request mix is read from a JSON file:
+
+.. code:: json
+
+    {
+        "setup": [{"method": "login", "params": ["john", 1234]}],
+        "mix": [
+            {"method": "get_balance", "params": [], "weight": 9},
+            {"method": "login", "params": ["john", 1234], "weight": 1}
+        ]
+    }
+
+The ``setup`` requests are sent once on each connection before the load starts. Each
+request in ``mix`` is chosen with probability proportional to its ``weight``. For
+example, to drive the example server at 500 requests per second:
+
+    $ python -m trio_jsonrpc.loadgen ws://localhost:8000 example/loadgen.json --rate 500
+"""
+from __future__ import annotations
+import argparse
+from collections import Counter
+from dataclasses import dataclass, field
+from itertools import accumulate, count
+import json
+import logging
+import random
+import typing
+
+import trio
+
+from . import JsonRpcConnection, JsonRpcException, open_jsonrpc_ws
+from .metrics import Histogram
+
+
+logger = logging.getLogger("trio_jsonrpc.loadgen")
+
+
+@dataclass
+class Call:
+    """ A method call in the request mix. """
+
+    method: str
+    params: typing.Union[dict, list, None] = None
+    weight: float = 1.0
+
+    @classmethod
+    def from_json_dict(cls, json_dict: dict) -> Call:
+        """ Create a call from a JSON dictionary. """
+        return cls(
+            method=json_dict["method"],
+            params=json_dict.get("params"),
+            weight=float(json_dict.get("weight", 1.0)),
+        )
+
+
+@dataclass
+class Mix:
+    """ A weighted mix of method calls, plus setup calls for each connection. """
+
+    calls: typing.List[Call]
+    setup: typing.List[Call] = field(default_factory=list)
+
+    def __post_init__(self):
+        if not self.calls:
+            raise ValueError("The request mix must contain at least one call.")
+        self._cum_weights = list(accumulate(call.weight for call in self.calls))
+
+    @classmethod
+    def load(cls, path: str) -> Mix:
+        """ Load a mix from a JSON file. """
+        with open(path) as file:
+            doc = json.load(file)
+        return cls(
+            calls=[Call.from_json_dict(c) for c in doc["mix"]],
+            setup=[Call.from_json_dict(c) for c in doc.get("setup", [])],
+        )
+
+    def choose(self, rng: random.Random) -> Call:
+        """ Choose a call at random according to the weights. """
+        return rng.choices(self.calls, cum_weights=self._cum_weights)[0]
+
+
+@dataclass
+class Report:
+    """ The results of a load test. """
+
+    rate: float
+    duration: float
+    sent: int = 0
+    succeeded: int = 0
+    timeouts: int = 0
+    errors: typing.Counter[str] = field(default_factory=Counter)
+    latency: Histogram = field(default_factory=Histogram)
+
+    def format(self) -> str:
+        """ Format the report for display. """
+        lines = [
+            f"Target rate:   {self.rate:,.1f} requests/s for {self.duration:,.1f}s",
+            f"Sent:          {self.sent:,d}",
+            f"Succeeded:     {self.succeeded:,d}",
+            f"Timed out:     {self.timeouts:,d}",
+        ]
+        for name, errors in sorted(self.errors.items()):
+            lines.append(f"Error:         {errors:,d} x {name}")
+        lines.append("")
+        lines.append("Latency (ms), measured from the intended send time:")
+        lines.append(self.latency.format_percentile_distribution(scale=1e3))
+        return "\n".join(lines)
+
+
+async def run_load(
+    connections: typing.Sequence[JsonRpcConnection],
+    mix: Mix,
+    rate: float,
+    duration: float,
+    timeout: float = 10.0,
+    seed: typing.Optional[int] = None,
+) -> Report:
+    """
+    Drive a server at a fixed arrival rate using the given connections.
+
+    Requests are assigned to connections round-robin. Each request runs in its own task,
+    so a slow response never delays the requests that follow it.
+
+    :param connections: One or more open client connections.
+    :param mix: The request mix.
+    :param rate: The number of requests per second.
+    :param duration: How long to generate load for, in seconds.
+    :param timeout: Requests that take longer than this many seconds are abandoned and
+        counted as timeouts.
+    :param seed: A seed for choosing calls from the mix.
+    """
+    report = Report(rate=rate, duration=duration)
+    rng = random.Random(seed)
+    interval = 1.0 / rate
+
+    async def issue(conn, call, intended_start):
+        with trio.move_on_at(intended_start + timeout) as cancel_scope:
+            try:
+                await conn.request(call.method, call.params)
+                report.succeeded += 1
+            except JsonRpcException as jre:
+                report.errors[type(jre).__name__] += 1
+            except Exception as exc:
+                logger.debug("Request failed", exc_info=True)
+                report.errors[type(exc).__name__] += 1
+        if cancel_scope.cancelled_caught:
+            report.timeouts += 1
+        else:
+            report.latency.record(trio.current_time() - intended_start)
+
+    async with trio.open_nursery() as nursery:
+        start = trio.current_time()
+        for n in count():
+            intended_start = start + n * interval
+            if intended_start - start >= duration:
+                break
+            await trio.sleep_until(intended_start)
+            conn = connections[n % len(connections)]
+            nursery.start_soon(issue, conn, mix.choose(rng), intended_start)
+            report.sent += 1
+    return report
+
+
+async def main(args):
+    mix = Mix.load(args.mix)
+    report = None
+
+    async def connect(n, task_status=trio.TASK_STATUS_IGNORED):
+        async with open_jsonrpc_ws(args.url) as conn:
+            for call in mix.setup:
+                await conn.request(call.method, call.params)
+            logger.info("Connection #%d is ready", n)
+            task_status.started(conn)
+            await done.wait()
+
+    done = trio.Event()
+    async with trio.open_nursery() as nursery:
+        connections = list()
+        for n in range(args.connections):
+            connections.append(await nursery.start(connect, n))
+        logger.info(
+            "Sending %.1f requests/s for %.1fs on %d connection(s)",
+            args.rate,
+            args.duration,
+            args.connections,
+        )
+        report = await run_load(
+            connections, mix, args.rate, args.duration, args.timeout, args.seed
+        )
+        done.set()
+    print(report.format())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Trio JSON-RPC Load Generator")
+    parser.add_argument("url", help="The server's WebSocket URL")
+    parser.add_argument("mix", help="A JSON file describing the request mix")
+    parser.add_argument(
+        "--rate", type=float, default=100.0, help="Requests per second (default: 100)"
+    )
+    parser.add_argument(
+        "--duration", type=float, default=10.0, help="Seconds to run (default: 10)"
+    )
+    parser.add_argument(
+        "--connections",
+        type=int,
+        default=1,
+        help="Number of concurrent connections (default: 1)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=10.0,
+        help="Abandon requests after this many seconds (default: 10)",
+    )
+    parser.add_argument("--seed", type=int, help="Random seed for the request mix")
+    parser.add_argument(
+        "--log-level",
+        default="info",
+        metavar="LEVEL",
+        choices=["debug", "info", "warning", "error", "critical"],
+        help="Set logging verbosity (default: info)",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+    trio.run(main, args)
@@ -1,27 +1,268 @@
+from collections import OrderedDict
 from contextlib import asynccontextmanager
+from dataclasses import dataclass
 import enum
 import json
 import logging
+import math
 import ssl
 import typing
 
 from sansio_jsonrpc import (
     JsonRpcException,
     JsonRpcInternalError,
+    JsonRpcParseError,
     JsonRpcPeer,
     JsonRpcRequest,
     JsonRpcResponse,
 )
+from sansio_jsonrpc.main import MissingId
 import trio
 import trio_websocket
 
+from .cache import ResponseCache
+from .metrics import Histogram
 from .transport import BaseTransport, TransportClosed
-from .transport.memory import MemoryTransport
+from .transport.memory import MemoryTransport, ObjectMemoryTransport
+from .transport.shm import SharedMemoryTransport
 from .transport.ws import WebSocketTransport
 
+if typing.TYPE_CHECKING:
+    from .dispatch import Dispatch
 
 logger = logging.getLogger("trio_jsonrpc")
 
+#: The method name of the notification that a client sends when it cancels a request.
+CANCEL_REQUEST_METHOD = "$/cancelRequest"
+# How long a cancelled request waits to send the cancellation notification.
+CANCEL_REQUEST_TIMEOUT = 1.0
+# How many cancelled requests to remember, so that their late responses are discarded.
+MAX_CANCELLED_REQUESTS = 1024
+#: The method name of the notification that a server sends to invalidate results in the
+#: client's response cache.
+CACHE_INVALIDATE_METHOD = "$/invalidateCache"
+
+
+@dataclass
+class JsonRpcRequestWithDeadline(JsonRpcRequest):
+    """
+    A request that may have a deadline, i.e. a time after which the client is no longer
+    waiting for the response.
+
+    The deadline is sent as a ``timeout`` member of the request object, which contains
+    the number of seconds that the client is willing to wait. A relative time is used
+    because the client and server clocks are not synchronized. On receipt, it is
+    converted into an absolute deadline on the receiver's Trio clock.
+    """
+
+    deadline: typing.Optional[float] = None
+
+
+class RawJson:
+    """
+    A handler result that is already serialized as JSON, e.g. a blob that was read from
+    a cache or a database.
+
+    When a server responds with this result, the bytes are spliced into the response
+    as they are, without decoding and encoding them again. They must contain a single
+    JSON value encoded as UTF-8, which is not validated.
+    """
+
+    __slots__ = ("data",)
+
+    def __init__(self, data: typing.Union[bytes, str]):
+        """
+        Constructor.
+
+        :param data: The serialized JSON value. A string is encoded as UTF-8.
+        """
+        if isinstance(data, str):
+            data = data.encode("utf8")
+        #: The serialized JSON value.
+        self.data: bytes = data
+
+    def __repr__(self) -> str:
+        return f"RawJson({self.data[:40]!r}{'...' if len(self.data) > 40 else ''})"
+
+    def loads(self) -> typing.Any:
+        """ Decode the JSON value. """
+        return json.loads(self.data)
+
+
+class _JsonRpcPeer(JsonRpcPeer):
+    """ Extends the sans I/O peer with support for request deadlines. """
+
+    def request(
+        self,
+        method: str,
+        params: typing.Union[dict, list, None] = None,
+        timeout: typing.Optional[float] = None,
+    ) -> typing.Tuple[typing.Any, bytes]:
+        """
+        Create a new request.
+
+        :param timeout: If set, the request includes a timeout member.
+        """
+        request_id, bytes_to_send = super().request(method, params)
+        if timeout is not None:
+            # Splice the member into the end of the JSON object instead of serializing
+            # the request a second time.
+            timeout_member = ',"timeout":{}}}'.format(max(0.0, timeout))
+            bytes_to_send = bytes_to_send[:-1] + timeout_member.encode("ascii")
+        return request_id, bytes_to_send
+
+    def respond_with_result(self, request: JsonRpcRequest, result: typing.Any) -> bytes:
+        """
+        Create a success response to a request.
+
+        A :class:`RawJson` result is spliced into the response without re-encoding it.
+        """
+        if isinstance(result, RawJson):
+            # Use the same layout as json.dumps() of JsonRpcResponse.to_json_dict().
+            return b"".join(
+                (
+                    b'{"id": ',
+                    json.dumps(request.id).encode("utf8"),
+                    b', "jsonrpc": "2.0", "result": ',
+                    result.data,
+                    b"}",
+                )
+            )
+        return super().respond_with_result(request, result)
+
+    def parse(
+        self, recv_bytes: bytes
+    ) -> typing.Iterable[typing.Union[JsonRpcRequest, JsonRpcResponse]]:
+        """
+        Parse a network representation.
+
+        This is the same as the sans I/O implementation, except that requests are parsed
+        into :class:`JsonRpcRequestWithDeadline`, and a batch (i.e. an array of requests
+        or responses) is parsed into its individual messages.
+        """
+        try:
+            recv_str = recv_bytes.decode("utf8")
+        except Exception:
+            raise JsonRpcParseError("Invalid ASCII encoding")
+        try:
+            recv_json = json.loads(recv_str)
+        except ValueError:
+            raise JsonRpcParseError("Invalid JSON format")
+        if isinstance(recv_json, list):
+            if not recv_json:
+                raise JsonRpcParseError("Expected a non-empty batch")
+            return [self._parse_object(item, recv_str) for item in recv_json]
+        return (self._parse_object(recv_json, recv_str),)
+
+    def _parse_object(
+        self, recv_dict: typing.Any, recv_str: str
+    ) -> typing.Union[JsonRpcRequest, JsonRpcResponse]:
+        """ Parse a single request or response object. """
+        if not isinstance(recv_dict, dict):
+            raise JsonRpcParseError("Expected a JSON object")
+        if "method" in recv_dict:
+            request = JsonRpcRequestWithDeadline.from_json_dict(recv_dict)
+            timeout = recv_dict.get("timeout")
+            # Ignore a timeout that isn't a finite, non-negative number, e.g. NaN.
+            if (
+                isinstance(timeout, (int, float))
+                and not isinstance(timeout, bool)
+                and math.isfinite(timeout)
+                and timeout >= 0
+            ):
+                request.deadline = trio.current_time() + timeout
+            return request
+        elif "result" in recv_dict or "error" in recv_dict:
+            return JsonRpcResponse.from_json_dict(recv_dict)
+        else:
+            msg = "Could parse a request or a response: "
+            example = recv_str[:100] + ("..." if len(recv_str) > 100 else "")
+            raise JsonRpcParseError(msg + example)
+
+
+class _ObjectPeer(_JsonRpcPeer):
+    """
+    A peer for transports that pass message objects, which skips JSON serialization.
+
+    It has the same interface as :class:`_JsonRpcPeer`, but where that class returns
+    bytes, this one returns the message object itself.
+    """
+
+    def request(self, method, params=None, timeout=None):
+        request_id = next(self._id_gen)
+        deadline = None if timeout is None else trio.current_time() + timeout
+        request = JsonRpcRequestWithDeadline(
+            id=request_id, method=method, params=params, deadline=deadline
+        )
+        return request_id, request
+
+    def notify(self, method, params=None):
+        return JsonRpcRequestWithDeadline(id=MissingId(), method=method, params=params)
+
+    def respond_with_result(self, request, result):
+        if isinstance(result, RawJson):
+            # The client expects an object, so the JSON has to be decoded after all.
+            result = result.loads()
+        return JsonRpcResponse(id=request.id, result=result)
+
+    def respond_with_error(self, request, error):
+        return JsonRpcResponse(id=None if request is None else request.id, error=error)
+
+    def parse(self, message):
+        return (message,)
+
+
+class _Batch:
+    """ Outbound messages that are waiting to be sent together. """
+
+    __slots__ = ("messages", "sent", "closed")
+
+    def __init__(self):
+        self.messages: typing.List[bytes] = list()
+        self.sent = trio.Event()
+        self.closed = False
+
+
+class _Responder(trio.abc.SendChannel):
+    """
+    A stand-in for the result channel of :meth:`Dispatch.handle_request
+    <trio_jsonrpc.Dispatch.handle_request>` that sends each result straight back to the
+    peer.
+    """
+
+    __slots__ = ("_connection",)
+
+    def __init__(self, connection: "JsonRpcConnection"):
+        self._connection = connection
+
+    async def aclose(self) -> None:
+        """ The connection owns the transport, so there is nothing to close. """
+        await trio.lowlevel.checkpoint()
+
+    async def send(self, item: typing.Tuple[JsonRpcRequest, typing.Any]) -> None:
+        request, result = item
+        if request.is_notification:
+            return
+        try:
+            if isinstance(result, JsonRpcException):
+                await self._connection.respond_with_error(request, result.get_error())
+                return
+            try:
+                await self._connection.respond_with_result(request, result)
+            except (JsonRpcException, TypeError, ValueError):
+                # The result can't be encoded, e.g. a handler returned None. Raising
+                # would stop the caller, which may be an executor that every connection
+                # shares, so respond with an error instead.
+                logger.exception(
+                    'Cannot encode the result of method "%s"', request.method
+                )
+                error = JsonRpcInternalError("The result could not be encoded.")
+                await self._connection.respond_with_error(request, error.get_error())
+        except TransportClosed:
+            logger.debug(
+                "Cannot respond to request.id=%s: the transport is closed", request.id
+            )
+
 
 class JsonRpcConnectionType(enum.Enum):
     """
@@ -35,13 +276,81 @@ class JsonRpcConnectionType(enum.Enum):
 class JsonRpcConnection:
     """ A JSON-RPC client. """
 
-    def __init__(self, transport, peer_type):
-        """ Constructor. """
+    def __init__(
+        self,
+        transport,
+        peer_type,
+        cache: typing.Optional[ResponseCache] = None,
+        batch_delay: typing.Optional[float] = None,
+        batch_size: int = 100,
+        max_in_flight: typing.Optional[int] = None,
+        in_flight_fail_fast: bool = False,
+        dispatch: typing.Optional["Dispatch"] = None,
+        context: typing.Any = None,
+        executor: typing.Any = None,
+    ):
+        """
+        Constructor.
+
+        :param cache: If set, the results of requests are cached according to the
+            cache's policies. This can also be set later with the ``cache`` attribute.
+        :param batch_delay: If set, outbound requests and notifications are collected
+            for up to this many seconds and sent together as one JSON-RPC batch. This
+            has no effect on transports that pass message objects.
+        :param batch_size: The maximum number of messages in a batch. A full batch is
+            sent without waiting for ``batch_delay``.
+        :param max_in_flight: If set, at most this many requests may wait for a
+            response at once. Further requests wait for capacity, which counts towards
+            their deadlines.
+        :param in_flight_fail_fast: If True, a request that exceeds ``max_in_flight``
+            raises :exc:`trio.WouldBlock` instead of waiting.
+        :param dispatch: If set, the background task checks each inbound request
+            against the dispatch's rate limits, starts its handler directly, and sends
+            the result back, so :meth:`iter_requests` is not used.
+        :param context: The connection context for ``dispatch`` (see
+            :meth:`Dispatch.connection_context
+            <trio_jsonrpc.Dispatch.connection_context>`). If it is None and the
+            background task isn't already running in a connection context, the
+            connection gets a context of None, so that requests can only be cancelled
+            from the connection that sent them.
+        :param executor: If set along with ``dispatch``, requests are passed to this
+            executor's ``submit()`` method, e.g. a :class:`~trio_jsonrpc.Scheduler` or
+            :class:`~trio_jsonrpc.WorkerPool`, instead of each starting a new task.
+        """
         self._transport = transport
         self._peer_type = peer_type
-        self._sansio_peer = JsonRpcPeer()
+        self.cache = cache
+        if getattr(transport, "passes_objects", False):
+            self._sansio_peer: _JsonRpcPeer = _ObjectPeer()
+            batch_delay = None
+        else:
+            self._sansio_peer = _JsonRpcPeer()
+        self._batch_delay = batch_delay
+        self._batch_size = batch_size
+        self._batch = _Batch()
+        self._batch_wakeup = trio.Event()
+        self._in_flight = 0
+        self.max_in_flight = max_in_flight
+        self._in_flight_limit = (
+            trio.Semaphore(max_in_flight) if max_in_flight is not None else None
+        )
+        self._in_flight_fail_fast = in_flight_fail_fast
+        #: How long each request waited for ``max_in_flight`` capacity, in seconds.
+        self.in_flight_wait = Histogram()
+        #: The Trio time when a message was last received or a response was sent.
+        self.last_activity = trio.current_time()
+        self._dispatch = dispatch
+        self._context = context
+        self._executor = executor
+        self._handler_nursery: typing.Optional[trio.Nursery] = None
+        self._responder = _Responder(self)
         self._bg_task_running = False
-        self._outbound_requests = dict()
+        # Maps request ID to the channel that delivers the response.
+        self._outbound_requests: typing.Dict[
+            typing.Any, trio.MemorySendChannel
+        ] = dict()
+        # The IDs of requests that were cancelled after they were sent.
+        self._cancelled_requests: "OrderedDict[typing.Any, None]" = OrderedDict()
         irsend, irrecv = trio.open_memory_channel(0)
         self._inbound_requests_send = irsend
         self._inbound_requests_recv = irrecv
@@ -57,27 +366,136 @@ class JsonRpcConnection:
         return self._peer_type == JsonRpcConnectionType.CLIENT
 
     async def request(
-        self, method: str, params: typing.Union[dict, list] = None
+        self,
+        method: str,
+        params: typing.Union[dict, list] = None,
+        *,
+        deadline: typing.Optional[float] = None,
     ) -> typing.Any:
         """
         Send a request to the server and return its result.
 
+        If the calling task is cancelled after the request is sent, then it notifies the
+        server (see :data:`CANCEL_REQUEST_METHOD`) so that the server can cancel the
+        handler.
+
+        If the connection has a :class:`~trio_jsonrpc.ResponseCache` with a policy for
+        this method, then a cached result is returned without contacting the server,
+        and a new result is added to the cache. A cached result is shared between
+        callers, so it must not be mutated.
+
+        :param deadline: An absolute time on the Trio clock (see
+            :func:`trio.current_time`) after which the caller no longer needs a
+            response. The remaining time is sent to the server, so that it can skip or
+            cancel the handler, and the request raises :exc:`trio.TooSlowError` if the
+            response does not arrive in time.
         :returns: a response from the server
         :raises: a subclass of class:`JsonRpcException` if the server returns an error
         """
-        request_id, bytes_to_send = self._sansio_peer.request(
-            method=method, params=params
-        )
-        # The background task provides a response to this task using a one-time channel.
-        response_send, response_recv = trio.open_memory_channel(0)
-        self._outbound_requests[request_id] = response_send
-        await self._transport.send(bytes_to_send)
-        response = await response_recv.receive()
+        cache = self.cache
+        if cache is None or not cache.is_cached(method):
+            return await self._request_by(method, params, deadline)
+        hit, result = cache.get(method, params)
+        if hit:
+            await trio.lowlevel.checkpoint()
+            return result
+        generation = cache.generation
+        result = await self._request_by(method, params, deadline)
+        cache.put(method, params, result, generation)
+        return result
+
+    async def _request_by(
+        self,
+        method: str,
+        params: typing.Union[dict, list, None],
+        deadline: typing.Optional[float],
+    ) -> typing.Any:
+        """ Send a request and wait for its result until a deadline, if any. """
+        if deadline is None or math.isinf(deadline):
+            return await self._request(method, params)
+        with trio.fail_at(deadline):
+            return await self._request(method, params, deadline)
+
+    async def _request(
+        self,
+        method: str,
+        params: typing.Union[dict, list, None],
+        deadline: typing.Optional[float] = None,
+    ) -> typing.Any:
+        limit = self._in_flight_limit
+        if limit is not None:
+            if self._in_flight_fail_fast:
+                limit.acquire_nowait()
+            else:
+                start = trio.current_time()
+                await limit.acquire()
+                self.in_flight_wait.record(trio.current_time() - start)
+        self._in_flight += 1
+        try:
+            # The timeout is computed after waiting for capacity, so that the server
+            # sees the time that is actually remaining.
+            timeout = None if deadline is None else deadline - trio.current_time()
+            request_id, bytes_to_send = self._sansio_peer.request(
+                method=method, params=params, timeout=timeout
+            )
+            # The background task provides a response to this task using a one-time
+            # channel. The channel is buffered so that the background task never blocks
+            # waiting for this task, e.g. if this task is still blocked in send() when
+            # the response arrives.
+            response_send, response_recv = trio.open_memory_channel(1)
+            self._outbound_requests[request_id] = response_send
+            sent = False
+            try:
+                await self._send(bytes_to_send)
+                sent = True
+                response = await response_recv.receive()
+            except trio.Cancelled:
+                if sent:
+                    await self._send_cancel_request(request_id)
+                raise
+            finally:
+                # Forget the request unless its response has arrived. If it was sent,
+                # the server may still respond, or it may never respond, e.g. if it
+                # doesn't support cancellation, so remember that the request was
+                # cancelled and let the background task discard a late response.
+                if self._outbound_requests.pop(request_id, None) is not None and sent:
+                    cancelled = self._cancelled_requests
+                    cancelled[request_id] = None
+                    if len(cancelled) > MAX_CANCELLED_REQUESTS:
+                        cancelled.popitem(last=False)
+                response_recv.close()
+        finally:
+            self._in_flight -= 1
+            if limit is not None:
+                limit.release()
         if response.success:
             return response.result
         else:
             raise JsonRpcException.exc_from_error(response.error)
 
+    @property
+    def in_flight(self) -> int:
+        """ The number of requests that are waiting for a response. """
+        return self._in_flight
+
+    @property
+    def in_flight_waiting(self) -> int:
+        """ The number of requests that are waiting for ``max_in_flight`` capacity. """
+        if self._in_flight_limit is None:
+            return 0
+        return self._in_flight_limit.statistics().tasks_waiting
+
+    async def _send_cancel_request(self, request_id) -> None:
+        """ Tell the server that a request was cancelled. """
+        # This task has been cancelled, so the notification must be shielded, but it
+        # shouldn't wait indefinitely for a slow transport.
+        deadline = trio.current_time() + CANCEL_REQUEST_TIMEOUT
+        with trio.CancelScope(deadline=deadline, shield=True):
+            try:
+                await self.notify(CANCEL_REQUEST_METHOD, {"id": request_id})
+            except TransportClosed:
+                pass
+
     async def notify(
         self, method: str, params: typing.Union[dict, list] = None
     ) -> None:
@@ -87,7 +505,90 @@ class JsonRpcConnection:
         This does expect or wait for any response.
         """
         bytes_to_send = self._sansio_peer.notify(method, params)
-        await self._transport.send(bytes_to_send)
+        await self._send(bytes_to_send)
+
+    async def _send(self, data: bytes) -> None:
+        """
+        Send a request or notification, possibly in a batch with other messages.
+
+        If batching is enabled, this returns when the batch is sent.
+        """
+        if self._batch_delay is None:
+            await self._transport.send(data)
+            return
+        while len(self._batch.messages) >= self._batch_size:
+            # Apply backpressure while the next batch is already full.
+            await self._batch.sent.wait()
+        batch = self._batch
+        if batch.closed:
+            raise TransportClosed()
+        batch.messages.append(data)
+        if len(batch.messages) == 1 or len(batch.messages) >= self._batch_size:
+            self._batch_wakeup.set()
+        try:
+            await batch.sent.wait()
+        except trio.Cancelled:
+            if batch is self._batch:
+                # The batch hasn't been sent yet, so this message can be withdrawn.
+                batch.messages.remove(data)
+            raise
+        if batch.closed:
+            raise TransportClosed()
+
+    async def _batch_task(self) -> None:
+        """ Send each batch when it is full or when its delay expires. """
+        batch_delay = self._batch_delay
+        assert batch_delay is not None
+        try:
+            while True:
+                await self._batch_wakeup.wait()
+                self._batch_wakeup = trio.Event()
+                if len(self._batch.messages) < self._batch_size:
+                    with trio.move_on_after(batch_delay):
+                        await self._batch_wakeup.wait()
+                    self._batch_wakeup = trio.Event()
+                batch = self._batch
+                self._batch = _Batch()
+                messages = batch.messages
+                sent = False
+                try:
+                    if len(messages) == 1:
+                        await self._transport.send(messages[0])
+                    elif messages:
+                        await self._transport.send(b"[" + b",".join(messages) + b"]")
+                    sent = True
+                except TransportClosed:
+                    pass
+                finally:
+                    batch.closed = not sent
+                    batch.sent.set()
+        finally:
+            # Fail the current batch and any future sends, because nothing will send
+            # them.
+            self._batch.closed = True
+            self._batch.sent.set()
+
+    async def invalidate_cache(
+        self,
+        method: typing.Optional[str] = None,
+        params: typing.Union[dict, list, None] = None,
+        tags: typing.Optional[typing.Iterable[str]] = None,
+    ) -> None:
+        """
+        Tell the peer to discard results from its response cache.
+
+        This sends a :data:`CACHE_INVALIDATE_METHOD` notification, which the peer
+        applies in its background task. See :meth:`ResponseCache.invalidate
+        <trio_jsonrpc.ResponseCache.invalidate>` for the meaning of the arguments.
+        """
+        invalidation: typing.Dict[str, typing.Any] = dict()
+        if method is not None:
+            invalidation["method"] = method
+            if params is not None:
+                invalidation["params"] = params
+        if tags is not None:
+            invalidation["tags"] = list(tags)
+        await self.notify(CACHE_INVALIDATE_METHOD, invalidation)
 
     async def iter_requests(self):
         """
@@ -102,34 +603,105 @@ class JsonRpcConnection:
 
     async def respond_with_result(self, request, result):
         bytes_to_send = self._sansio_peer.respond_with_result(request, result)
+        self.last_activity = trio.current_time()
         await self._transport.send(bytes_to_send)
 
     async def respond_with_error(self, request, error):
         bytes_to_send = self._sansio_peer.respond_with_error(request, error)
+        self.last_activity = trio.current_time()
         await self._transport.send(bytes_to_send)
 
+    async def ping(self) -> None:
+        """
+        Check that the peer is alive using the transport's ping, if it has one, and
+        return when the peer answers.
+
+        :raises TransportClosed: if the transport is closed.
+        """
+        await self._transport.ping()
+
     async def _background_task(self):
         """
-        The background task handles incoming messages.
+        The background task handles incoming messages. If batching is enabled, it also
+        sends outbound batches, and if a dispatch is bound, it runs the handlers.
+        """
+        if self._batch_delay is None and self._dispatch is None:
+            await self._receive_messages()
+            return
+        async with trio.open_nursery() as nursery:
+            if self._batch_delay is not None:
+                nursery.start_soon(self._batch_task)
+            if self._dispatch is None:
+                await self._receive_messages()
+            else:
+                await self._receive_and_dispatch()
+            nursery.cancel_scope.cancel()
+
+    async def _receive_and_dispatch(self) -> None:
+        """
+        Handle incoming messages in the connection context, and wait for the handlers
+        that are still running when the transport closes.
         """
+        dispatch = self._dispatch
+        assert dispatch is not None
+        try:
+            dispatch.ctx
+            in_context = True
+        except RuntimeError:
+            in_context = False
+        if in_context and self._context is None:
+            await self._run_handlers()
+        else:
+            async with dispatch.connection_context(self._context):
+                await self._run_handlers()
+
+    async def _run_handlers(self) -> None:
+        async with trio.open_nursery() as nursery:
+            self._handler_nursery = nursery
+            try:
+                await self._receive_messages()
+            finally:
+                self._handler_nursery = None
+
+    async def _receive_messages(self):
+        """ Handle incoming messages until the transport is closed. """
         self._bg_task_running = True
 
         while self._bg_task_running:
             try:
                 bytes_received = await self._transport.recv()
+                self.last_activity = trio.current_time()
                 messages = self._sansio_peer.parse(bytes_received)
                 for message in messages:
                     # sansio-jsonrpc guarantees that each message is either a request
                     # or a response.
                     if isinstance(message, JsonRpcRequest):
-                        await self._inbound_requests_send.send(message)
+                        if message.method == CACHE_INVALIDATE_METHOD:
+                            self._invalidate_cache(message.params)
+                        elif self._handler_nursery is not None:
+                            await self._start_handler(message)
+                        else:
+                            await self._inbound_requests_send.send(message)
                     else:
                         assert isinstance(message, JsonRpcResponse)
                         try:
                             response_send = self._outbound_requests.pop(message.id)
-                            await response_send.send(message)
+                            response_send.send_nowait(message)
+                        except trio.BrokenResourceError:
+                            logger.debug(
+                                "Discarding response.id=%s: the request was cancelled",
+                                message.id,
+                            )
                         except KeyError:
                             id_ = message.id
+                            if id_ in self._cancelled_requests:
+                                del self._cancelled_requests[id_]
+                                logger.debug(
+                                    "Discarding response.id=%s: the request was "
+                                    "cancelled",
+                                    id_,
+                                )
+                                continue
                             msg = f"No in-flight request matches response.id={id_}"
                             logger.error(msg)
                             await self._background_send_error(JsonRpcInternalError(msg))
@@ -162,6 +734,42 @@ class JsonRpcConnection:
 
         self._bg_task_running = False
 
+    async def _start_handler(self, request: JsonRpcRequest) -> None:
+        """
+        Start a task, or submit a job to the executor, that runs a request on the bound
+        dispatch and responds. An inline handler is called right here instead.
+        """
+        dispatch = self._dispatch
+        assert dispatch is not None
+        try:
+            dispatch.check_rate_limit(request)
+        except JsonRpcException as exc:
+            if not request.is_notification:
+                await self.respond_with_error(request, exc.get_error())
+            return
+        if dispatch.is_inline(request.method):
+            result = dispatch.call_inline(request)
+            await self._responder.send((request, result))
+        elif self._executor is not None:
+            await self._executor.submit(request, self._responder)
+        else:
+            nursery = self._handler_nursery
+            assert nursery is not None
+            nursery.start_soon(dispatch.handle_request, request, self._responder)
+
+    def _invalidate_cache(self, invalidation: typing.Any) -> None:
+        """ Apply a cache invalidation notification from the peer. """
+        if self.cache is None:
+            return
+        if not isinstance(invalidation, dict):
+            logger.error("Invalid cache invalidation params: %r", invalidation)
+            return
+        self.cache.invalidate(
+            invalidation.get("method"),
+            invalidation.get("params"),
+            invalidation.get("tags"),
+        )
+
     async def _background_send_error(self, exc, request=None):
         try:
             bytes_to_send = self._sansio_peer.respond_with_error(
@@ -178,65 +786,170 @@ class JsonRpcConnection:
 
 
 def jsonrpc_client(
-    transport: BaseTransport, nursery: trio.Nursery,
+    transport: BaseTransport, nursery: trio.Nursery, **kwargs,
 ) -> JsonRpcConnection:
-    """ Create a JSON-RPC peer instance using the specified transport. """
-    peer = JsonRpcConnection(transport, JsonRpcConnectionType.CLIENT)
+    """
+    Create a JSON-RPC peer instance using the specified transport.
+
+    Keyword arguments are passed to :class:`JsonRpcConnection`.
+    """
+    peer = JsonRpcConnection(transport, JsonRpcConnectionType.CLIENT, **kwargs)
     nursery.start_soon(peer._background_task)
     return peer
 
 
 def jsonrpc_server(
-    transport: BaseTransport, nursery: trio.Nursery, request_buffer_len: int = 1,
+    transport: BaseTransport,
+    nursery: trio.Nursery,
+    request_buffer_len: int = 1,
+    **kwargs,
 ) -> JsonRpcConnection:
-    """ Create a JSON-RPC peer instance using the specified transport. """
+    """
+    Create a JSON-RPC peer instance using the specified transport.
+
+    Keyword arguments are passed to :class:`JsonRpcConnection`, e.g. ``dispatch``.
+    """
     request_buffer_send, request_buffer_recv = trio.open_memory_channel(
         request_buffer_len
     )
 
-    peer = JsonRpcConnection(transport, JsonRpcConnectionType.SERVER)
+    peer = JsonRpcConnection(transport, JsonRpcConnectionType.SERVER, **kwargs)
     nursery.start_soon(peer._background_task)
     return peer
 
 
 @asynccontextmanager
 async def open_jsonrpc_memory(
-    send_channel: trio.abc.SendChannel, recv_channel: trio.abc.ReceiveChannel,
+    send_channel: trio.abc.SendChannel, recv_channel: trio.abc.ReceiveChannel, **kwargs,
 ) -> typing.AsyncIterator[JsonRpcConnection]:
     """
     Open a JSON-RPC connection using Trio channels as transport.
 
     This is mainly intended for testing, since the client and server must be running
-    inside the same process.
+    inside the same process. Keyword arguments are passed to
+    :class:`~trio_jsonrpc.main.JsonRpcConnection`.
     """
     async with trio.open_nursery() as nursery:
         transport = MemoryTransport(send_channel, recv_channel)
-        yield jsonrpc_client(transport, nursery)
+        yield jsonrpc_client(transport, nursery, **kwargs)
         nursery.cancel_scope.cancel()
 
 
 @asynccontextmanager
 async def serve_jsonrpc_memory(
-    send_channel: trio.abc.SendChannel, recv_channel: trio.abc.ReceiveChannel,
+    send_channel: trio.abc.SendChannel, recv_channel: trio.abc.ReceiveChannel, **kwargs,
 ):
     """
     Serve a JSON-RPC connection using Trio channels as transport.
 
     This is mainly intended for testing, since the client and server must be running
     inside the same process. Note that this only accepts 1 "connection": the one passed
-    to this function.
+    to this function. Keyword arguments are passed to
+    :class:`~trio_jsonrpc.main.JsonRpcConnection`.
     """
     async with trio.open_nursery() as nursery:
         transport = MemoryTransport(send_channel, recv_channel)
-        yield jsonrpc_server(transport, nursery)
+        yield jsonrpc_server(transport, nursery, **kwargs)
+        nursery.cancel_scope.cancel()
+
+
+@asynccontextmanager
+async def open_jsonrpc_inprocess(
+    dispatch, context: typing.Any = None, copy: bool = False, channel_size: int = 0,
+) -> typing.AsyncIterator[JsonRpcConnection]:
+    """
+    Open a JSON-RPC connection to a :class:`~trio_jsonrpc.Dispatch` server in the same
+    process.
+
+    Request and response objects are passed directly between the client and the
+    server, skipping JSON serialization, which makes this much faster than
+    :func:`open_jsonrpc_memory`. The trade-off is that params and results are shared
+    between the client and the handlers, so neither side may mutate them after sending
+    them, unless ``copy`` is True.
+
+    :param dispatch: The dispatch that handles the requests.
+    :param context: If set, the server runs inside this connection context (see
+        :meth:`Dispatch.connection_context`).
+    :param copy: If True, messages are deep-copied when they are sent.
+    :param channel_size: The buffer size of the channels between client and server.
+    """
+    client_send, server_recv = trio.open_memory_channel(channel_size)
+    server_send, client_recv = trio.open_memory_channel(channel_size)
+    async with trio.open_nursery() as nursery:
+        server_transport = ObjectMemoryTransport(server_send, server_recv, copy)
+        server = JsonRpcConnection(
+            server_transport,
+            JsonRpcConnectionType.SERVER,
+            dispatch=dispatch,
+            context=context,
+        )
+        nursery.start_soon(server._background_task)
+        client_transport = ObjectMemoryTransport(client_send, client_recv, copy)
+        yield jsonrpc_client(client_transport, nursery)
         nursery.cancel_scope.cancel()
 
 
 @asynccontextmanager
-async def open_jsonrpc_ws(url: str) -> typing.AsyncIterator[JsonRpcConnection]:
-    """ Open a JSON-RPC connection using WebSocket transport. """
+async def open_jsonrpc_shm(
+    path: str, **kwargs
+) -> typing.AsyncIterator[JsonRpcConnection]:
+    """
+    Open a JSON-RPC connection to a server in another process on the same host, using
+    shared memory as transport. The server must already have called
+    :func:`serve_jsonrpc_shm` with the same path.
+
+    Keyword arguments are passed to :class:`~trio_jsonrpc.main.JsonRpcConnection`.
+    """
+    transport = SharedMemoryTransport.connect(path)
+    try:
+        async with trio.open_nursery() as nursery:
+            yield jsonrpc_client(transport, nursery, **kwargs)
+            nursery.cancel_scope.cancel()
+    finally:
+        transport.close()
+
+
+@asynccontextmanager
+async def serve_jsonrpc_shm(
+    path: str, capacity: int = 4 * 1024 * 1024, **kwargs
+) -> typing.AsyncIterator[JsonRpcConnection]:
+    """
+    Serve a JSON-RPC connection to a client in another process on the same host, using
+    shared memory as transport.
+
+    This creates the files for the shared memory and removes them on exit. Note that
+    this only accepts 1 "connection": the client that calls :func:`open_jsonrpc_shm`
+    with the same path.
+
+    :param path: The path prefix for the shared memory files, preferably on a
+        ``tmpfs`` such as ``/dev/shm``.
+    :param capacity: The size of the ring buffer in each direction, which limits the
+        size of a message.
+
+    Other keyword arguments are passed to :class:`~trio_jsonrpc.main.JsonRpcConnection`.
+    """
+    transport = SharedMemoryTransport.create(path, capacity)
+    try:
+        async with trio.open_nursery() as nursery:
+            yield jsonrpc_server(transport, nursery, **kwargs)
+            nursery.cancel_scope.cancel()
+    finally:
+        transport.close()
+        transport.unlink()
+
+
+@asynccontextmanager
+async def open_jsonrpc_ws(
+    url: str, **kwargs
+) -> typing.AsyncIterator[JsonRpcConnection]:
+    """
+    Open a JSON-RPC connection using WebSocket transport.
+
+    Keyword arguments are passed to :class:`~trio_jsonrpc.main.JsonRpcConnection`,
+    e.g. ``batch_delay``.
+    """
     async with trio_websocket.open_websocket_url(url) as ws:
         async with trio.open_nursery() as nursery:
             transport = WebSocketTransport(ws)
-            yield jsonrpc_client(transport, nursery)
+            yield jsonrpc_client(transport, nursery, **kwargs)
             nursery.cancel_scope.cancel()
@@ -0,0 +1,189 @@
+"""
+This module contains lightweight metrics primitives that are used by other parts of the
+library to report performance data.
+"""
+import math
+import typing
+
+
+class Histogram:
+    """
+    A histogram of non-negative values (typically latencies in seconds) with bounded
+    relative error, in the style of HdrHistogram.
+
+    Values are counted in logarithmic buckets, so memory usage depends on the dynamic
+    range of the values rather than the number of values recorded. Every value reported
+    by :meth:`percentile` is within ``precision`` (relative) of a recorded value.
+    """
+
+    def __init__(self, precision: float = 0.01, lowest: float = 1e-6):
+        """
+        Constructor.
+
+        :param precision: The maximum relative error of reported values, e.g. 0.01 is
+            1%.
+        :param lowest: The smallest value that can be distinguished from zero. Smaller
+            values are counted in the lowest bucket.
+        """
+        self._lowest = lowest
+        self._log_base = math.log1p(precision)
+        self._buckets: typing.Dict[int, int] = dict()
+        self._count = 0
+        self._total = 0.0
+        self._total_squares = 0.0
+        self._min = math.inf
+        self._max = 0.0
+
+    @property
+    def count(self) -> int:
+        """ The number of values recorded. """
+        return self._count
+
+    @property
+    def min(self) -> float:
+        """ The smallest value recorded, or 0 if the histogram is empty. """
+        return self._min if self._count else 0.0
+
+    @property
+    def max(self) -> float:
+        """ The largest value recorded. """
+        return self._max
+
+    @property
+    def mean(self) -> float:
+        """ The mean of all values recorded. """
+        return self._total / self._count if self._count else 0.0
+
+    @property
+    def stdev(self) -> float:
+        """ The population standard deviation of all values recorded. """
+        if not self._count:
+            return 0.0
+        mean = self.mean
+        return math.sqrt(max(0.0, self._total_squares / self._count - mean * mean))
+
+    def record(self, value: float, count: int = 1) -> None:
+        """ Record a value (or ``count`` occurrences of a value). """
+        if value <= self._lowest:
+            index = 0
+        else:
+            index = int(math.log(value / self._lowest) / self._log_base) + 1
+        self._buckets[index] = self._buckets.get(index, 0) + count
+        self._count += count
+        self._total += value * count
+        self._total_squares += value * value * count
+        if value < self._min:
+            self._min = value
+        if value > self._max:
+            self._max = value
+
+    def merge(self, other: "Histogram") -> None:
+        """ Add all of the values from another histogram with the same settings. """
+        if (other._lowest, other._log_base) != (self._lowest, self._log_base):
+            raise ValueError("Cannot merge histograms with different settings.")
+        for index, count in other._buckets.items():
+            self._buckets[index] = self._buckets.get(index, 0) + count
+        self._count += other._count
+        self._total += other._total
+        self._total_squares += other._total_squares
+        self._min = min(self._min, other._min)
+        self._max = max(self._max, other._max)
+
+    def reset(self) -> None:
+        """ Discard all recorded values. """
+        self._buckets.clear()
+        self._count = 0
+        self._total = 0.0
+        self._total_squares = 0.0
+        self._min = math.inf
+        self._max = 0.0
+
+    def percentile(self, q: float) -> float:
+        """
+        Return the value at percentile ``q``, where ``q`` is in the range [0, 100].
+
+        As in HdrHistogram, the value reported is the highest value that is equivalent
+        to the recorded value, except that it is clamped to the recorded maximum.
+        """
+        if not self._count:
+            return 0.0
+        target = max(1, math.ceil(q / 100 * self._count))
+        seen = 0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if seen >= target:
+                return min(self._bucket_value(index), self._max)
+        return self._max
+
+    def iter_percentiles(
+        self, ticks_per_half_distance: int = 5
+    ) -> typing.Iterator[typing.Tuple[float, float, int]]:
+        """
+        Iterate over the percentile distribution, yielding tuples of ``(value,
+        percentile, total_count)``.
+
+        Like HdrHistogram, the reporting steps get finer as they approach 100%: each
+        halving of the distance to 100% is divided into ``ticks_per_half_distance``
+        steps.
+        """
+        if not self._count:
+            return
+        seen = 0
+        percentile_to_report = 0.0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if seen == self._count:
+                # The ticks approach 100% without ever reaching it, so the last bucket
+                # is reported once, below.
+                break
+            value = min(self._bucket_value(index), self._max)
+            current = 100.0 * seen / self._count
+            while percentile_to_report <= current and percentile_to_report < 100.0:
+                yield value, percentile_to_report, seen
+                halvings = int(math.log2(100.0 / (100.0 - percentile_to_report))) + 1
+                step = 100.0 / (ticks_per_half_distance * 2 ** halvings)
+                percentile_to_report += step
+        yield self._max, 100.0, self._count
+
+    def format_percentile_distribution(
+        self, scale: float = 1e3, ticks_per_half_distance: int = 5
+    ) -> str:
+        """
+        Format the percentile distribution as a table in the same layout as
+        HdrHistogram's ``outputPercentileDistribution()``.
+
+        :param scale: Values are multiplied by this number before being printed, e.g.
+            the default converts seconds to milliseconds.
+        """
+        lines = [
+            "{:>12} {:>14} {:>10} {:>14}".format(
+                "Value", "Percentile", "TotalCount", "1/(1-Percentile)"
+            ),
+            "",
+        ]
+        for value, percentile, total in self.iter_percentiles(ticks_per_half_distance):
+            fraction = percentile / 100
+            if fraction < 1:
+                inverse = "{:>14.2f}".format(1 / (1 - fraction))
+            else:
+                inverse = ""
+            lines.append(
+                "{:>12.3f} {:>14.12f} {:>10d} {}".format(
+                    value * scale, fraction, total, inverse
+                ).rstrip()
+            )
+        lines.append(
+            "#[Mean    = {:>12.3f}, StdDeviation   = {:>12.3f}]".format(
+                self.mean * scale, self.stdev * scale
+            )
+        )
+        lines.append(
+            "#[Max     = {:>12.3f}, Total count    = {:>12d}]".format(
+                self.max * scale, self.count
+            )
+        )
+        return "\n".join(lines)
+
+    def _bucket_value(self, index: int) -> float:
+        """ Return the highest value that is counted in the given bucket. """
+        return self._lowest * math.exp(self._log_base * index)
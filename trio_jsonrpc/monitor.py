@@ -0,0 +1,180 @@
+"""
+This module contains a monitor that reaps dead, idle, and long-lived server connections.
+
+A server holds a task, a nursery, and a connection context for every open connection.
+If a client disappears without closing its connection, e.g. because its host lost
+power, then the server may never notice, and these resources are held forever. The
+:class:`ConnectionMonitor` closes such connections by cancelling their handlers:
+
+* Heartbeats: a connection that has been quiet for a while is pinged at the transport
+  level (e.g. a WebSocket ping), and it is closed if the peer doesn't answer in time.
+* Idle timeout: a connection that hasn't sent or received a message for too long is
+  closed, even if the peer is still alive.
+* Maximum lifetime: a connection is closed after a fixed amount of time, so that
+  clients periodically reconnect, e.g. to rebalance across servers.
+"""
+from contextlib import contextmanager
+import logging
+import typing
+
+import trio
+
+from .main import JsonRpcConnection
+from .transport import TransportClosed
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Watched:
+    """ A connection that is being monitored. """
+
+    __slots__ = ("connection", "cancel_scope", "opened", "last_heartbeat", "pinging")
+
+    def __init__(self, connection, cancel_scope, opened):
+        self.connection: JsonRpcConnection = connection
+        self.cancel_scope: trio.CancelScope = cancel_scope
+        self.opened: float = opened
+        self.last_heartbeat: float = opened
+        self.pinging = False
+
+
+class ConnectionMonitor:
+    """
+    Closes server connections that fail heartbeats, are idle for too long, or exceed a
+    maximum lifetime.
+
+    .. code:: python3
+
+        monitor = ConnectionMonitor(heartbeat_interval=30, idle_timeout=600)
+
+        async def connection_handler(ws_request):
+            ws = await ws_request.accept()
+            rpc_conn = JsonRpcConnection(
+                WebSocketTransport(ws), JsonRpcConnectionType.SERVER
+            )
+            with monitor.watch(rpc_conn):
+                ...  # Serve the connection.
+
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(monitor.run)
+            await trio_websocket.serve_websocket(connection_handler, ...)
+
+    When a connection is reaped, the body of its :meth:`watch` block is cancelled, and
+    the block exits normally.
+    """
+
+    def __init__(
+        self,
+        heartbeat_interval: typing.Optional[float] = None,
+        heartbeat_timeout: float = 10.0,
+        idle_timeout: typing.Optional[float] = None,
+        max_lifetime: typing.Optional[float] = None,
+        idle_threshold: float = 60.0,
+        check_interval: float = 1.0,
+    ):
+        """
+        Constructor.
+
+        :param heartbeat_interval: If set, ping a connection that has been quiet for
+            this many seconds.
+        :param heartbeat_timeout: Close a connection if a ping isn't answered within
+            this many seconds.
+        :param idle_timeout: If set, close a connection that hasn't sent or received a
+            message for this many seconds. This should be longer than the slowest
+            handler, because a handler that is running doesn't count as activity.
+        :param max_lifetime: If set, close a connection after this many seconds.
+        :param idle_threshold: A connection that has been quiet for this many seconds is
+            counted in :attr:`idle`.
+        :param check_interval: How often to check connections, in seconds.
+        """
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.idle_threshold = idle_threshold
+        self.check_interval = check_interval
+        self._watched: typing.Set[_Watched] = set()
+        #: The number of connections reaped for each reason: ``"heartbeat"``,
+        #: ``"idle"``, or ``"lifetime"``.
+        self.reaped: typing.Dict[str, int] = {"heartbeat": 0, "idle": 0, "lifetime": 0}
+
+    @property
+    def open(self) -> int:
+        """ The number of connections that are being monitored. """
+        return len(self._watched)
+
+    @property
+    def idle(self) -> int:
+        """ The number of connections that have been quiet for ``idle_threshold``. """
+        quiet_since = trio.current_time() - self.idle_threshold
+        return sum(
+            1 for w in self._watched if w.connection.last_activity <= quiet_since
+        )
+
+    @contextmanager
+    def watch(self, connection: JsonRpcConnection) -> typing.Iterator[None]:
+        """
+        Monitor a connection while the block runs, and cancel the block if the
+        connection is reaped.
+        """
+        with trio.CancelScope() as cancel_scope:
+            watched = _Watched(connection, cancel_scope, trio.current_time())
+            self._watched.add(watched)
+            try:
+                yield
+            finally:
+                self._watched.discard(watched)
+
+    async def run(self, *, task_status=trio.TASK_STATUS_IGNORED) -> None:
+        """ Check connections periodically, until cancelled. """
+        async with trio.open_nursery() as nursery:
+            task_status.started()
+            while True:
+                self._check(nursery)
+                await trio.sleep(self.check_interval)
+
+    def _check(self, nursery: trio.Nursery) -> None:
+        """ Reap each connection or start a heartbeat in the nursery, as needed. """
+        now = trio.current_time()
+        for watched in list(self._watched):
+            last_activity = watched.connection.last_activity
+            if (
+                self.max_lifetime is not None
+                and now - watched.opened >= self.max_lifetime
+            ):
+                self._reap(watched, "lifetime")
+            elif (
+                self.idle_timeout is not None
+                and now - last_activity >= self.idle_timeout
+            ):
+                self._reap(watched, "idle")
+            elif (
+                self.heartbeat_interval is not None
+                and not watched.pinging
+                and now - max(last_activity, watched.last_heartbeat)
+                >= self.heartbeat_interval
+            ):
+                watched.pinging = True
+                nursery.start_soon(self._heartbeat, watched)
+
+    async def _heartbeat(self, watched: _Watched) -> None:
+        """ Ping a connection and reap it if it doesn't answer. """
+        alive = False
+        with trio.move_on_after(self.heartbeat_timeout):
+            try:
+                await watched.connection.ping()
+                alive = True
+            except TransportClosed:
+                pass
+        watched.pinging = False
+        if alive:
+            watched.last_heartbeat = trio.current_time()
+        elif watched in self._watched:
+            self._reap(watched, "heartbeat")
+
+    def _reap(self, watched: _Watched, reason: str) -> None:
+        logger.info("Closing connection (reason=%s)", reason)
+        self.reaped[reason] += 1
+        self._watched.discard(watched)
+        watched.cancel_scope.cancel()
@@ -0,0 +1,82 @@
+"""
+This module contains token-bucket rate limits that are used by
+:meth:`~trio_jsonrpc.Dispatch.rate_limit`.
+"""
+from collections import OrderedDict
+import typing
+
+
+class TokenBucket:
+    """
+    A token bucket that refills continuously at a fixed rate, up to a maximum burst.
+
+    The bucket is refilled lazily when it is checked, so each check is O(1) and an idle
+    bucket costs nothing.
+    """
+
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, now: float):
+        """
+        Constructor.
+
+        :param tokens: The initial number of tokens.
+        :param now: The current time.
+        """
+        self.tokens = tokens
+        self.updated = now
+
+    def refill(self, rate: float, burst: float, now: float) -> float:
+        """ Add the tokens that accrued since the last refill and return the total. """
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        return self.tokens
+
+
+class RateLimit:
+    """
+    A rate limit with one token bucket per key.
+
+    If ``key`` is None, then all requests share one bucket. Otherwise, ``key`` is
+    called with the connection context and requests are limited separately for each
+    distinct return value. To bound memory usage, at most ``max_keys`` buckets are kept,
+    and the least recently used bucket is discarded when that limit is reached. (A
+    discarded bucket starts over with a full burst the next time its key is seen.)
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: typing.Optional[float] = None,
+        key: typing.Optional[typing.Callable[[typing.Any], typing.Hashable]] = None,
+        max_keys: int = 10_000,
+    ):
+        """
+        Constructor.
+
+        :param rate: The number of requests per second.
+        :param burst: The number of requests that can be made at once after a period of
+            inactivity. Defaults to ``rate`` (i.e. one second's worth of requests).
+        :param key: A function that maps a connection context to a bucket key.
+        :param max_keys: The maximum number of buckets to keep.
+        """
+        if rate <= 0:
+            raise ValueError("The rate must be positive.")
+        self.rate = rate
+        self.burst = max(1.0, burst if burst is not None else rate)
+        self.key = key
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[typing.Hashable, TokenBucket]" = OrderedDict()
+
+    def get_bucket(self, ctx: typing.Any, now: float) -> TokenBucket:
+        """ Find the bucket for the given connection context, creating it if needed. """
+        key = self.key(ctx) if self.key is not None else None
+        buckets = self._buckets
+        try:
+            bucket = buckets[key]
+            buckets.move_to_end(key)
+        except KeyError:
+            if len(buckets) >= self.max_keys:
+                buckets.popitem(last=False)
+            bucket = buckets[key] = TokenBucket(self.burst, now)
+        return bucket
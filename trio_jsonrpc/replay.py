@@ -0,0 +1,380 @@
+"""
+Replay captured traffic (see :mod:`trio_jsonrpc.transport.capture`) against a server,
+and compare the latency of each method to the original traffic or to an earlier replay.
+
+Each connection in the capture is replayed on its own client connection, and each
+request is sent at the same offset from the start of the capture as it was originally,
+divided by ``--speed``. Like the load generator, replay is open-loop: a request is sent
+on time even if earlier requests have not finished, and its latency is measured from
+the time when it should have been sent. If the capture also contains the responses,
+then the report compares each method's latency to the original latency.
+
+To replay a capture against a live server at twice the original speed:
+
+    $ python -m trio_jsonrpc.replay traffic.cap --url ws://localhost:8000 --speed 2
+
+To replay it into a ``Dispatch`` in the same process, where each connection gets a new
+connection context from a factory, and save the results as a baseline:
+
+    $ python -m trio_jsonrpc.replay traffic.cap --dispatch example.server:dispatch \\
+        --context example.server:ConnectionContext --save baseline.json
+
+Then compare a later run to the baseline with ``--compare baseline.json``.
+
+Cancellation notifications refer to request IDs from the original traffic, so they are
+not replayed.
+"""
+from __future__ import annotations
+import argparse
+from collections import Counter
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from functools import partial
+import importlib
+import json
+import logging
+import typing
+
+import trio
+
+from . import (
+    CANCEL_REQUEST_METHOD,
+    JsonRpcConnection,
+    JsonRpcException,
+    open_jsonrpc_memory,
+    open_jsonrpc_ws,
+    serve_jsonrpc_memory,
+)
+from .metrics import Histogram
+from .transport.capture import Frame, RecordKind, read_capture
+
+
+logger = logging.getLogger("trio_jsonrpc.replay")
+Connect = typing.Callable[[], typing.AsyncContextManager[JsonRpcConnection]]
+
+
+@dataclass
+class CapturedRequest:
+    """ A request read from a capture. """
+
+    #: The time when the request was originally sent, relative to the first frame.
+    time: float
+    connection: int
+    method: str
+    params: typing.Union[dict, list, None] = None
+    is_notification: bool = False
+    #: The request's timeout member, if the client set a deadline.
+    timeout: typing.Optional[float] = None
+    #: The original latency, if the response was captured.
+    latency: typing.Optional[float] = None
+
+
+def load_requests(frames: typing.Iterable[Frame]) -> typing.List[CapturedRequest]:
+    """
+    Extract the requests from the frames of a capture, and match them to their
+    responses to find the original latency.
+    """
+    requests = list()
+    # Maps connection number to True if the requests are the frames that it sent.
+    sends_requests: typing.Dict[int, bool] = dict()
+    pending: typing.Dict[tuple, CapturedRequest] = dict()
+    start = None
+    for frame in frames:
+        if start is None:
+            start = frame.time
+        if frame.kind in (RecordKind.OPEN_CLIENT, RecordKind.OPEN_SERVER):
+            sends_requests[frame.connection] = frame.kind == RecordKind.OPEN_CLIENT
+            continue
+        try:
+            doc = json.loads(frame.data)
+        except ValueError:
+            logger.debug("Skipping a frame that is not JSON on #%d", frame.connection)
+            continue
+        messages = doc if isinstance(doc, list) else [doc]
+        is_request = (frame.kind == RecordKind.SEND) == sends_requests.get(
+            frame.connection, False
+        )
+        for message in messages:
+            if not isinstance(message, dict):
+                continue
+            if is_request and "method" in message:
+                if message["method"] == CANCEL_REQUEST_METHOD:
+                    continue
+                timeout = message.get("timeout")
+                request = CapturedRequest(
+                    time=frame.time - start,
+                    connection=frame.connection,
+                    method=message["method"],
+                    params=message.get("params"),
+                    is_notification="id" not in message,
+                    timeout=timeout if isinstance(timeout, (int, float)) else None,
+                )
+                requests.append(request)
+                if not request.is_notification:
+                    pending[(frame.connection, message["id"])] = request
+            elif not is_request and ("result" in message or "error" in message):
+                try:
+                    request = pending.pop((frame.connection, message.get("id")))
+                except (KeyError, TypeError):
+                    continue
+                request.latency = frame.time - start - request.time
+    return requests
+
+
+@dataclass
+class MethodReport:
+    """ The results for one method. """
+
+    sent: int = 0
+    timeouts: int = 0
+    errors: typing.Counter[str] = field(default_factory=Counter)
+    #: The original latency of the requests whose responses were captured.
+    original: Histogram = field(default_factory=Histogram)
+    #: The latency during the replay, measured from the intended send time.
+    latency: Histogram = field(default_factory=Histogram)
+
+    def to_json_dict(self) -> dict:
+        """ Summarize the results as a JSON dictionary. """
+        return {
+            "sent": self.sent,
+            "timeouts": self.timeouts,
+            "errors": dict(self.errors),
+            "p50": self.latency.percentile(50),
+            "p90": self.latency.percentile(90),
+            "p99": self.latency.percentile(99),
+            "max": self.latency.max,
+        }
+
+
+@dataclass
+class Report:
+    """ The results of a replay. """
+
+    speed: float
+    methods: typing.Dict[str, MethodReport] = field(default_factory=dict)
+
+    def to_json_dict(self) -> dict:
+        """ Summarize the results as a JSON dictionary. """
+        return {
+            "speed": self.speed,
+            "methods": {
+                method: report.to_json_dict()
+                for method, report in sorted(self.methods.items())
+            },
+        }
+
+    def format(self, baseline: typing.Optional[dict] = None) -> str:
+        """
+        Format the report for display.
+
+        :param baseline: If set, latency is compared to this report, which was saved by
+            an earlier replay with :meth:`to_json_dict`. Otherwise, it is compared to
+            the original latency in the capture.
+        """
+        against = "baseline" if baseline is not None else "original"
+        lines = [
+            f"Replayed at {self.speed:g}x speed. Latency (ms) compared to {against}:",
+            "{:<24} {:>7} {:>8} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+                "method", "sent", "failed", "p50", "was", "p99", "was", "change"
+            ),
+        ]
+        for method, report in sorted(self.methods.items()):
+            if baseline is not None:
+                base = baseline["methods"].get(method)
+                was_p50 = base["p50"] if base else None
+                was_p99 = base["p99"] if base else None
+            elif report.original.count:
+                was_p50 = report.original.percentile(50)
+                was_p99 = report.original.percentile(99)
+            else:
+                was_p50 = was_p99 = None
+            p50 = report.latency.percentile(50)
+            p99 = report.latency.percentile(99)
+            if was_p99:
+                change = "{:>+9.1%}".format(p99 / was_p99 - 1)
+            else:
+                change = "{:>9}".format("-")
+            lines.append(
+                "{:<24} {:>7,d} {:>8,d} {:>9.3f} {} {:>9.3f} {} {}".format(
+                    method,
+                    report.sent,
+                    report.timeouts + sum(report.errors.values()),
+                    p50 * 1e3,
+                    _format_ms(was_p50),
+                    p99 * 1e3,
+                    _format_ms(was_p99),
+                    change,
+                )
+            )
+        return "\n".join(lines)
+
+
+def _format_ms(value: typing.Optional[float]) -> str:
+    return "{:>9}".format("-") if value is None else "{:>9.3f}".format(value * 1e3)
+
+
+async def replay(
+    requests: typing.Sequence[CapturedRequest],
+    connect: Connect,
+    speed: float = 1.0,
+    timeout: float = 10.0,
+) -> Report:
+    """
+    Replay requests against a server.
+
+    :param requests: The requests to replay, e.g. from :func:`load_requests`.
+    :param connect: A function that returns an async context manager for a new client
+        connection. It is called once for each connection in the capture.
+    :param speed: A speed factor, e.g. 2 sends requests twice as fast as the original
+        traffic.
+    :param timeout: Requests that take longer than this many seconds are abandoned and
+        counted as timeouts.
+    """
+    if speed <= 0:
+        raise ValueError("The speed must be positive.")
+    report = Report(speed=speed)
+    for request in requests:
+        method_report = report.methods.setdefault(request.method, MethodReport())
+        if request.latency is not None:
+            method_report.original.record(request.latency)
+
+    async def issue(conn, request, intended_start):
+        method_report = report.methods[request.method]
+        method_report.sent += 1
+        if request.is_notification:
+            await conn.notify(request.method, request.params)
+            return
+        deadline = None
+        if request.timeout is not None:
+            deadline = intended_start + request.timeout
+        with trio.move_on_at(intended_start + timeout) as cancel_scope:
+            try:
+                await conn.request(request.method, request.params, deadline=deadline)
+            except JsonRpcException as jre:
+                method_report.errors[type(jre).__name__] += 1
+            except Exception as exc:
+                logger.debug("Request failed", exc_info=True)
+                method_report.errors[type(exc).__name__] += 1
+        if cancel_scope.cancelled_caught:
+            method_report.timeouts += 1
+        else:
+            method_report.latency.record(trio.current_time() - intended_start)
+
+    async def open_connection(task_status=trio.TASK_STATUS_IGNORED):
+        async with connect() as conn:
+            task_status.started(conn)
+            await done.wait()
+
+    done = trio.Event()
+    async with trio.open_nursery() as nursery:
+        connections = dict()
+        for request in requests:
+            if request.connection not in connections:
+                connections[request.connection] = await nursery.start(open_connection)
+        async with trio.open_nursery() as requests_nursery:
+            start = trio.current_time()
+            for request in sorted(requests, key=lambda r: r.time):
+                intended_start = start + request.time / speed
+                await trio.sleep_until(intended_start)
+                conn = connections[request.connection]
+                requests_nursery.start_soon(issue, conn, request, intended_start)
+        done.set()
+    return report
+
+
+def dispatch_target(
+    dispatch, context_factory: typing.Optional[typing.Callable] = None
+) -> Connect:
+    """
+    Return a ``connect`` function for :func:`replay` that serves each connection with a
+    :class:`~trio_jsonrpc.Dispatch` in the same process. Messages are still encoded as
+    JSON, as they would be on a network.
+
+    :param dispatch: The dispatch that handles the requests.
+    :param context_factory: If set, it is called for each connection, and the result
+        is the connection context.
+    """
+
+    @asynccontextmanager
+    async def connect() -> typing.AsyncIterator[JsonRpcConnection]:
+        client_send, server_recv = trio.open_memory_channel(0)
+        server_send, client_recv = trio.open_memory_channel(0)
+        context = context_factory() if context_factory is not None else None
+        async with serve_jsonrpc_memory(
+            server_send, server_recv, dispatch=dispatch, context=context
+        ):
+            async with open_jsonrpc_memory(client_send, client_recv) as client:
+                yield client
+
+    return connect
+
+
+def _import(name: str) -> typing.Any:
+    """ Import an object given as ``module:attribute``. """
+    module_name, _, attribute = name.partition(":")
+    return getattr(importlib.import_module(module_name), attribute)
+
+
+async def main(args):
+    requests = load_requests(read_capture(args.capture))
+    connections = len({request.connection for request in requests})
+    logger.info(
+        "Replaying %d requests on %d connection(s)", len(requests), connections
+    )
+    if args.url is not None:
+        connect = partial(open_jsonrpc_ws, args.url)
+    else:
+        context = _import(args.context) if args.context else None
+        connect = dispatch_target(_import(args.dispatch), context)
+    report = await replay(requests, connect, args.speed, args.timeout)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    print(report.format(baseline))
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(report.to_json_dict(), file, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Trio JSON-RPC Traffic Replay")
+    parser.add_argument("capture", help="A capture file")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--url", help="Replay against the server at this WebSocket URL")
+    target.add_argument(
+        "--dispatch",
+        metavar="MODULE:NAME",
+        help="Replay into this Dispatch in the same process",
+    )
+    parser.add_argument(
+        "--context",
+        metavar="MODULE:NAME",
+        help="With --dispatch, call this to create each connection context",
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="Speed relative to the original traffic (default: 1)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=10.0,
+        help="Abandon requests after this many seconds (default: 10)",
+    )
+    parser.add_argument("--save", metavar="PATH", help="Save the results as JSON")
+    parser.add_argument(
+        "--compare", metavar="PATH", help="Compare latency to saved results"
+    )
+    parser.add_argument(
+        "--log-level",
+        default="info",
+        metavar="LEVEL",
+        choices=["debug", "info", "warning", "error", "critical"],
+        help="Set logging verbosity (default: info)",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+    trio.run(main, args)
@@ -0,0 +1,389 @@
+"""
+This module contains a bounded, priority-aware executor for dispatching requests.
+
+The simplest way to dispatch requests is to start a new task for each one, but then
+there is no limit on the number of handlers that run at once, and a burst of bulk
+requests delays everything that arrives after it, including health checks. The
+:class:`Scheduler` limits the number of concurrent handlers and, when requests are
+waiting for capacity, starts the ones with the highest priority first. Within a
+priority class, capacity is shared fairly between connections, so a connection that
+pipelines thousands of requests cannot starve the others.
+
+When the server is overloaded, the scheduler can also shed load, in the style of the
+CoDel queue management algorithm: it measures how long each request waits, and if that
+delay stays above a target for a whole interval, requests that have waited too long are
+rejected instead of started. A fixed queue limit sheds too late, when every queued
+request is already stale, or too early, during a short burst that the server would
+absorb. Queue delay over time distinguishes a standing queue from a burst.
+"""
+from collections import OrderedDict, deque
+import contextvars
+import logging
+import typing
+
+from sansio_jsonrpc import JsonRpcRequest
+import trio
+
+from .dispatch import ContextNotSet, Priority, cancelled_request_id, connection_id
+from .exc import (
+    JsonRpcRequestCancelledError,
+    JsonRpcServerOverloadedError,
+    JsonRpcServerShuttingDownError,
+)
+from .main import CANCEL_REQUEST_METHOD
+from .metrics import Histogram
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Job:
+    """ A request that is waiting for handler capacity. """
+
+    __slots__ = (
+        "request",
+        "result_channel",
+        "context",
+        "priority",
+        "submitted",
+        "enqueued",
+        "started",
+        "cancelled",
+    )
+
+    def __init__(self, request, result_channel, context, priority, submitted, enqueued):
+        self.request: JsonRpcRequest = request
+        self.result_channel: trio.abc.SendChannel = result_channel
+        self.context: contextvars.Context = context
+        self.priority: Priority = priority
+        self.submitted: float = submitted
+        self.enqueued: float = enqueued
+        self.started = False
+        self.cancelled = False
+
+
+class _Flow:
+    """ The jobs that one connection has queued in one priority class. """
+
+    __slots__ = ("jobs", "weight", "deficit")
+
+    def __init__(self, weight: float):
+        self.jobs: typing.Deque[_Job] = deque()
+        self.weight = weight
+        self.deficit = 0.0
+
+
+class _PriorityClass:
+    """
+    The jobs queued in one priority class.
+
+    Jobs are kept in one flow per connection, and the flows are served by deficit round
+    robin: each time a flow reaches the front of the line, it earns ``weight`` credits,
+    and each job that it starts costs one credit. A separate FIFO of all jobs tracks the
+    age of the oldest job, for starvation protection.
+    """
+
+    def __init__(self):
+        self.flows: "OrderedDict[typing.Hashable, _Flow]" = OrderedDict()
+        self.fifo: typing.Deque[_Job] = deque()
+        self.size = 0
+        # Load shedding state: when the queue delay first went above the target, and
+        # whether the class is shedding load.
+        self.above_since: typing.Optional[float] = None
+        self.shedding = False
+
+    def oldest(self) -> typing.Optional[_Job]:
+        """ Return the job that has waited the longest. """
+        fifo = self.fifo
+        while fifo and fifo[0].started:
+            fifo.popleft()
+        return fifo[0] if fifo else None
+
+    def push(self, key: typing.Hashable, weight: float, job: _Job) -> None:
+        try:
+            flow = self.flows[key]
+        except KeyError:
+            flow = self.flows[key] = _Flow(weight)
+        flow.jobs.append(job)
+        self.fifo.append(job)
+        self.size += 1
+
+    def pop(self) -> _Job:
+        """ Remove the next job in deficit round robin order. """
+        flows = self.flows
+        while True:
+            key, flow = next(iter(flows.items()))
+            if flow.deficit >= 1:
+                break
+            flow.deficit += flow.weight
+            if flow.deficit >= 1:
+                break
+            flows.move_to_end(key)
+        job = flow.jobs.popleft()
+        job.started = True
+        flow.deficit -= 1
+        self.size -= 1
+        if not flow.jobs:
+            # An idle flow does not keep its credits.
+            del flows[key]
+        elif flow.deficit < 1:
+            flows.move_to_end(key)
+        return job
+
+
+class Scheduler:
+    """
+    A bounded executor that runs handlers in priority order, fairly across connections.
+
+    Requests are queued by :meth:`submit` and started by :meth:`run` whenever fewer than
+    ``max_concurrent`` handlers are running. The highest priority class is served
+    first, except that if a request has waited for more than ``max_wait`` seconds, its
+    class is served ahead of higher priority classes, so that lower priority classes are
+    not starved.
+
+    Within a class, connections take turns: each connection may start ``weight``
+    requests per turn (deficit round robin), where ``weight`` is computed from the
+    connection context. By default, every connection has the same weight.
+
+    If ``shed_target`` is set, then each priority class sheds load when its queue delay
+    (the time from :meth:`submit` until the handler starts) stays at or above
+    ``shed_target`` for ``shed_interval`` seconds. While a class is shedding, each
+    request that has waited at least ``shed_target`` is rejected with a
+    :class:`~trio_jsonrpc.JsonRpcServerOverloadedError`, and the class stops shedding
+    as soon as a request has waited less than that, or its queue is empty. Higher
+    priority classes are served first, so their queue delay rises last, and lower
+    priority classes are shed first.
+
+    .. code:: python3
+
+        scheduler = Scheduler(dispatch, max_concurrent=64)
+
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(scheduler.run)
+            ...
+            async for request in rpc_conn.iter_requests():
+                await scheduler.submit(request, result_send)
+    """
+
+    def __init__(
+        self,
+        dispatch,
+        max_concurrent: int = 64,
+        max_queued: int = 1024,
+        max_wait: float = 1.0,
+        weight: typing.Optional[typing.Callable[[typing.Any], float]] = None,
+        shed_target: typing.Optional[float] = None,
+        shed_interval: float = 0.1,
+    ):
+        """
+        Constructor.
+
+        :param dispatch: The :class:`~trio_jsonrpc.Dispatch` that handles requests.
+        :param max_concurrent: The maximum number of handlers that run at once.
+        :param max_queued: The maximum number of requests that wait for capacity.
+            :meth:`submit` blocks while the queue is full.
+        :param max_wait: A request that has waited this many seconds is started ahead
+            of higher priority requests.
+        :param weight: A function that is called with the connection context (see
+            :attr:`Dispatch.ctx`) and returns that connection's share of capacity
+            relative to other connections, e.g. ``lambda ctx: 4 if ctx.premium else
+            1``. The weight must be positive, or :meth:`submit` raises
+            ``ValueError``.
+        :param shed_target: If set, the queue delay in seconds that is acceptable for a
+            standing queue. Load is shed when it is exceeded for ``shed_interval``.
+        :param shed_interval: How long, in seconds, the queue delay must stay above
+            ``shed_target`` before load is shed. This should be long enough to absorb
+            a normal burst of requests.
+        """
+        self._dispatch = dispatch
+        self.max_wait = max_wait
+        self._weight = weight
+        self.shed_target = shed_target
+        self.shed_interval = shed_interval
+        #: The number of requests shed in each priority class.
+        self.shed: typing.Dict[Priority, int] = {priority: 0 for priority in Priority}
+        #: How long each started request waited between :meth:`submit` and the start
+        #: of its handler, in seconds.
+        self.queue_delay = Histogram()
+        self._classes = [_PriorityClass() for _ in Priority]
+        self._queued = trio.Semaphore(0)
+        self._space = trio.Semaphore(max_queued)
+        self._capacity = trio.Semaphore(max_concurrent)
+
+    @property
+    def queued(self) -> int:
+        """ The number of requests waiting for capacity. """
+        return sum(class_.size for class_ in self._classes)
+
+    async def submit(
+        self, request: JsonRpcRequest, result_channel: trio.abc.SendChannel
+    ) -> None:
+        """
+        Queue a request to be handled.
+
+        The handler runs with a copy of the caller's context variables, so that it sees
+        the caller's connection context. The result is sent to ``result_channel`` in the
+        same way as :meth:`Dispatch.handle_request`.
+
+        A :data:`~trio_jsonrpc.CANCEL_REQUEST_METHOD` notification is not queued.
+        Instead, it immediately cancels the matching request on the same connection,
+        whether that request is running or still queued.
+
+        While the dispatch is draining, new requests are not queued, and their result is
+        a :class:`~trio_jsonrpc.JsonRpcServerShuttingDownError`.
+        """
+        if request.method == CANCEL_REQUEST_METHOD:
+            self._cancel(cancelled_request_id(request), result_channel)
+            return
+        key = connection_id.get()
+        if self._weight is not None and key is not ContextNotSet:
+            weight = self._weight(self._dispatch.ctx)
+            if not weight > 0:
+                raise ValueError(f"The weight must be positive, got {weight!r}.")
+        else:
+            weight = 1.0
+        submitted = trio.current_time()
+        await self._space.acquire()
+        try:
+            self._dispatch.admit(request)
+        except JsonRpcServerShuttingDownError as exc:
+            self._space.release()
+            await result_channel.send((request, exc))
+            return
+        priority = self._dispatch.get_priority(request.method)
+        job = _Job(
+            request,
+            result_channel,
+            contextvars.copy_context(),
+            priority,
+            submitted,
+            trio.current_time(),
+        )
+        self._classes[priority].push(key, weight, job)
+        self._queued.release()
+
+    async def run(self, *, task_status=trio.TASK_STATUS_IGNORED) -> None:
+        """ Start queued requests as capacity becomes available, until cancelled. """
+        async with trio.open_nursery() as nursery:
+            task_status.started()
+            while True:
+                await self._capacity.acquire()
+                while True:
+                    await self._queued.acquire()
+                    job = self._next_job()
+                    self._space.release()
+                    if not self._should_shed(job):
+                        break
+                    # Shedding doesn't need handler capacity, so keep dequeuing.
+                    self.shed[job.priority] += 1
+                    request = job.request
+                    error = JsonRpcServerOverloadedError(
+                        f'Shed method "{request.method}": the server is overloaded.'
+                    )
+                    nursery.start_soon(self._reject, job, error)
+                if not job.cancelled:
+                    self.queue_delay.record(trio.current_time() - job.submitted)
+                nursery.start_soon(self._run_job, job)
+
+    def _next_job(self) -> _Job:
+        """
+        Remove and return the next job from the class whose oldest job has waited
+        longer than ``max_wait``, if any, or else from the highest priority class.
+        """
+        starving_before = trio.current_time() - self.max_wait
+        best = None
+        best_oldest = None
+        for class_ in self._classes:
+            oldest = class_.oldest()
+            if oldest is None:
+                continue
+            if best_oldest is None:
+                best, best_oldest = class_, oldest
+            if oldest.enqueued >= starving_before:
+                continue
+            if best_oldest.enqueued >= starving_before or (
+                oldest.enqueued < best_oldest.enqueued
+            ):
+                best, best_oldest = class_, oldest
+        assert best is not None
+        return best.pop()
+
+    def _should_shed(self, job: _Job) -> bool:
+        """
+        Update the load shedding state of the job's priority class and return True if
+        the job should be shed.
+        """
+        if self.shed_target is None:
+            return False
+        class_ = self._classes[job.priority]
+        shed = False
+        if not job.cancelled:
+            now = trio.current_time()
+            if now - job.submitted < self.shed_target:
+                class_.above_since = None
+                class_.shedding = False
+            elif class_.above_since is None:
+                class_.above_since = now
+            elif now - class_.above_since >= self.shed_interval:
+                class_.shedding = True
+            shed = class_.shedding
+        if class_.size == 0:
+            # Like CoDel, forget the state when the queue empties, so that the delay
+            # of a burst after an idle period is measured from scratch.
+            class_.above_since = None
+            class_.shedding = False
+        return shed
+
+    def _cancel(
+        self, request_id: typing.Any, result_channel: trio.abc.SendChannel
+    ) -> None:
+        """ Cancel a running or queued request on the current connection. """
+        if request_id is None:
+            return
+        if self._dispatch.cancel_request(request_id, result_channel):
+            return
+        key = connection_id.get()
+        for class_ in self._classes:
+            flow = class_.flows.get(key)
+            if flow is not None:
+                for job in flow.jobs:
+                    # Without a connection context, every connection shares a flow,
+                    # so the result channel identifies the connection.
+                    if job.request.id == request_id and (
+                        key is not ContextNotSet or job.result_channel is result_channel
+                    ):
+                        job.cancelled = True
+
+    async def _run_job(self, job: _Job) -> None:
+        try:
+            if job.cancelled:
+                request = job.request
+                error = JsonRpcRequestCancelledError(
+                    f'Request for method "{request.method}" was cancelled.'
+                )
+                await self._reject(job, error)
+                return
+            for var, value in job.context.items():
+                var.set(value)
+            await self._dispatch.handle_request(
+                job.request, job.result_channel, admitted=True
+            )
+        except (trio.BrokenResourceError, trio.ClosedResourceError):
+            # The job's connection closed, which must not stop the other connections.
+            logger.debug("Discarding result for request.id=%s", job.request.id)
+        except Exception:
+            # Neither may any other failure in one job.
+            logger.exception("Unhandled exception in request.id=%s", job.request.id)
+        finally:
+            self._capacity.release()
+
+    async def _reject(self, job: _Job, error: Exception) -> None:
+        """ Send an error for a job that won't run. """
+        try:
+            await job.result_channel.send((job.request, error))
+        except (trio.BrokenResourceError, trio.ClosedResourceError):
+            logger.debug("Discarding error for request.id=%s", job.request.id)
+        except Exception:
+            logger.exception("Cannot send error for request.id=%s", job.request.id)
+        finally:
+            self._dispatch.release()
@@ -7,11 +7,14 @@ coverage.
 """
 from __future__ import annotations
 from collections import defaultdict
+from dataclasses import dataclass, field
 from enum import Enum
 from importlib import import_module
-from inspect import Parameter, signature, Signature
+from inspect import getsourcefile, Parameter, signature, Signature
 import logging
+import os
 import re
+import sys
 from textwrap import dedent
 import typing
 
@@ -27,6 +30,7 @@ from sphinx.util.nodes import make_refnode
 
 if typing.TYPE_CHECKING:
     from sphinx.application import Sphinx
+    from sphinx.environment import BuildEnvironment
     from trio_jsonrpc import Dispatch
 
 
@@ -66,14 +70,14 @@ def load_dispatch(location: str) -> Dispatch:
 
 class JsonRpcDispatch(SphinxDirective):
     """
-    This directive defines how to load the Dispatch object. The object is stored in the
-    Sphinx environment.
+    This directive defines how to load the Dispatch object for the rest of the current
+    document. It overrides the ``jsonrpc_dispatch`` config value.
     """
 
     required_arguments = 1
 
     def run(self) -> typing.List[nodes.Node]:
-        self.env.jsonrpc_dispatch = self.arguments[0]
+        self.env.ref_context["jsonrpc:dispatch"] = self.arguments[0]
         return []
 
 
@@ -98,7 +102,6 @@ class JsonRpcMethod(ObjectDescription):
     """
 
     required_arguments = 1
-    call_style: JsonRpcMethodCallStyle = JsonRpcMethodCallStyle.BOTH
     doc_field_types = [
         Field(
             "paramstyle", label="Parameter Style", has_arg=False, names=("paramstyle",)
@@ -120,9 +123,7 @@ class JsonRpcMethod(ObjectDescription):
         ),
         GroupedField("error", label="Errors", names=("error",), rolename="exception"),
     ]
-    __jsonrpc_method = None
-    __inspect_sig = None
-    __type_hints = None
+    __handler_info = None
 
     def add_target_and_index(self, name_cls, sig, signode):
         """ Create a target ID and add to the domain's list of methods. """
@@ -133,158 +134,248 @@ class JsonRpcMethod(ObjectDescription):
 
     def handle_signature(self, sig, signode):
         """ Generate the signature for the JSON-RPC method. """
-        dispatch = load_dispatch(self.env.jsonrpc_dispatch)
-        self.__jsonrpc_method = dispatch.get_handler(self.arguments[0])
-        method_name = self.__jsonrpc_method.__name__
-        self.__inspect_sig = signature(self.__jsonrpc_method)
-        self.__type_hints = typing.get_type_hints(self.__jsonrpc_method)
+        location = self.env.ref_context.get(
+            "jsonrpc:dispatch", self.config.jsonrpc_dispatch
+        )
+        if location is None:
+            raise Exception(
+                "The location of the Dispatch object must be set with the "
+                "`jsonrpc:dispatch` directive in the same document or the "
+                "`jsonrpc_dispatch` config value."
+            )
+        info = get_handler_info(self.env, location, self.arguments[0])
+        for path in info.sources:
+            # Re-read this document when the handler's source code changes.
+            self.env.note_dependency(path)
+        self.__handler_info = info
+        params = addnodes.desc_parameterlist()
+        for name, annotation, default in info.params:
+            node = addnodes.desc_parameter()
+            node += addnodes.desc_sig_name("", name)
+            if annotation is not None:
+                node += nodes.Text(f": {annotation}")
+            if default is not None:
+                node += nodes.Text(f" [default={default}]")
+            params += node
         signode += [
-            addnodes.desc_name(text=method_name),
-            self._parse_params(),
-            self._parse_return(),
+            addnodes.desc_name(text=info.name),
+            params,
+            addnodes.desc_returns(text=info.returns),
         ]
-        return method_name
+        return info.name
 
     def before_content(self) -> None:
-        """ Insert the docstring from the handler function. Insert any missing types
-        into the docstring. """
-        lines = [""]
-        docstr = self.__jsonrpc_method.__doc__
-        rtype_seen = False
-        param_names = list(self.__type_hints.keys())[:-1]
-        param_start = None
+        """ Insert the docstring from the handler function, with any missing types. """
+        self.content += StringList(self.__handler_info.content)
 
-        if docstr:
-            lines.extend(prepare_docstring(docstr))
 
-        lines.insert(len(lines) - 1, "")
+@dataclass
+class HandlerInfo:
+    """
+    Everything that the ``jsonrpc:method`` directive needs to know about a handler.
 
-        # Add type information to any param that missing it
-        for idx in range(len(lines)):
-            line = lines[idx]
-            match = PARAM_RE.match(line)
-            if match:
-                if param_start is None:
-                    param_start = idx
-                parts = match.group(1).split()
-                param_name = parts[-1]
-                try:
-                    param_names.remove(param_name)
-                except ValueError:
-                    # The docstring declares a parameter that is not type hinted. Just
-                    # ignore it.
-                    pass
-                if len(parts) == 1:
-                    th = self.__type_hints.get(param_name)
-                    if th:
-                        type_ = self._annotation(th)
-                        lines[idx] = ":param {} {}:{}".format(
-                            type_, parts[0], match.group(2)
-                        )
-            elif line.startswith(":rtype:"):
-                rtype_seen = True
-
-        # Add any missing parameters
-        for param_name in param_names:
-            lines.insert(
-                len(lines) - 1,
-                ":param {} {}:".format(
-                    self._annotation(self.__type_hints[param_name]), param_name
-                ),
-            )
+    This only contains plain data, so that it can be stored in the Sphinx environment,
+    which is pickled between builds and between parallel build processes.
+    """
 
-        # Insert the argument style
-        if param_start is not None:
-            lines.insert(
-                param_start, ":paramstyle: {}".format(self.call_style.description())
+    #: The method name.
+    name: str
+    #: Each parameter's name, JSON type (or None), and default value (or None).
+    params: typing.List[typing.Tuple[str, typing.Optional[str], typing.Optional[str]]]
+    #: The JSON type of the return value.
+    returns: str
+    #: The directive content generated from the docstring.
+    content: typing.List[str]
+    #: Maps each source file that the handler was introspected from to its mtime.
+    sources: typing.Dict[str, int] = field(default_factory=dict)
+
+    def is_current(self) -> bool:
+        """ Return True if none of the source files have changed. """
+        try:
+            return all(
+                os.stat(path).st_mtime_ns == mtime
+                for path, mtime in self.sources.items()
             )
+        except OSError:
+            return False
 
-        # Add return type if it's missing.
-        if not rtype_seen:
-            th = self.__type_hints.get("return")
-            if th:
-                rtype = self._annotation(th)
-                lines.insert(len(lines) - 1, "")
-                lines.insert(len(lines) - 1, ":rtype: {}".format(rtype))
 
-        self.content += StringList(lines)
+def get_handler_info(env: BuildEnvironment, location: str, method: str) -> HandlerInfo:
+    """
+    Return the introspection of a handler, from the environment's cache if its source
+    files are unchanged, or else by importing the dispatch and introspecting the
+    handler.
 
-    def _parse_params(self) -> addnodes.desc_parameterlist:
-        """ Convert the function's parameter list to a tree. """
-        params = addnodes.desc_parameterlist()
-        last_kind = None
-
-        for param in self.__inspect_sig.parameters.values():
-            if (
-                param.kind in (Parameter.KEYWORD_ONLY, Parameter.VAR_KEYWORD)
-                or param.default is Parameter.empty
-            ):
-                if self.call_style == JsonRpcMethodCallStyle.ARRAY:
-                    raise Exception(
-                        "A JSON-RPC method cannot contain both positional-only and "
-                        "keyword-only arguments."
-                    )
-                else:
-                    self.call_style = JsonRpcMethodCallStyle.OBJECT
-
-            if param.kind in (Parameter.POSITIONAL_ONLY, Parameter.VAR_POSITIONAL):
-                if self.call_style == JsonRpcMethodCallStyle.OBJECT:
-                    raise Exception(
-                        "A JSON-RPC method cannot contain both positional-only and "
-                        "keyword-only arguments."
+    A cache hit does not import anything, so an incremental build only imports the
+    dispatch module if a handler's source code has changed.
+    """
+    cache = env.jsonrpc_handlers
+    key = (location, method)
+    info = cache.get(key)
+    if info is not None and info.is_current():
+        return info
+    logger.debug("Introspect JSON-RPC method %s from %s", method, location)
+    dispatch = load_dispatch(location)
+    handler = dispatch.get_handler(method)
+    info = introspect_handler(handler)
+    module_name = location.strip().split(":")[0]
+    for path in (getattr(sys.modules[module_name], "__file__", None), _source(handler)):
+        if path is not None:
+            info.sources[path] = os.stat(path).st_mtime_ns
+    cache[key] = info
+    return info
+
+
+def introspect_handler(handler: typing.Callable) -> HandlerInfo:
+    """ Introspect a handler's signature and docstring. """
+    inspect_sig = signature(handler)
+    type_hints = typing.get_type_hints(handler)
+    params, call_style = _parse_params(inspect_sig, type_hints)
+    if inspect_sig.return_annotation is not inspect_sig.empty:
+        returns = json_type(type_hints["return"])
+    else:
+        returns = "null"
+    content = _parse_docstring(handler.__doc__, type_hints, call_style)
+    return HandlerInfo(handler.__name__, params, returns, content)
+
+
+def _source(obj: typing.Any) -> typing.Optional[str]:
+    """ Return the source file that defines an object, if any. """
+    try:
+        return getsourcefile(obj)
+    except TypeError:
+        return None
+
+
+def _parse_params(
+    inspect_sig: Signature, type_hints: typing.Dict[str, typing.Any]
+) -> typing.Tuple[list, JsonRpcMethodCallStyle]:
+    """ Convert the function's parameter list to plain data and find its call style. """
+    params = list()
+    call_style = JsonRpcMethodCallStyle.BOTH
+
+    for param in inspect_sig.parameters.values():
+        if (
+            param.kind in (Parameter.KEYWORD_ONLY, Parameter.VAR_KEYWORD)
+            or param.default is Parameter.empty
+        ):
+            if call_style == JsonRpcMethodCallStyle.ARRAY:
+                raise Exception(
+                    "A JSON-RPC method cannot contain both positional-only and "
+                    "keyword-only arguments."
+                )
+            else:
+                call_style = JsonRpcMethodCallStyle.OBJECT
+
+        if param.kind in (Parameter.POSITIONAL_ONLY, Parameter.VAR_POSITIONAL):
+            if call_style == JsonRpcMethodCallStyle.OBJECT:
+                raise Exception(
+                    "A JSON-RPC method cannot contain both positional-only and "
+                    "keyword-only arguments."
+                )
+            else:
+                call_style = JsonRpcMethodCallStyle.ARRAY
+
+        annotation = None
+        if param.annotation is not param.empty:
+            annotation = json_type(type_hints[param.name])
+        default = None
+        if param.default is not param.empty:
+            default = str(param.default)
+        params.append((param.name, annotation, default))
+
+    return params, call_style
+
+
+def _parse_docstring(
+    docstr: typing.Optional[str],
+    type_hints: typing.Dict[str, typing.Any],
+    call_style: JsonRpcMethodCallStyle,
+) -> typing.List[str]:
+    """ Convert a handler's docstring to directive content. Insert any missing types
+    into the docstring. """
+    lines = [""]
+    rtype_seen = False
+    param_names = list(type_hints.keys())[:-1]
+    param_start = None
+
+    if docstr:
+        lines.extend(prepare_docstring(docstr))
+
+    lines.insert(len(lines) - 1, "")
+
+    # Add type information to any param that missing it
+    for idx in range(len(lines)):
+        line = lines[idx]
+        match = PARAM_RE.match(line)
+        if match:
+            if param_start is None:
+                param_start = idx
+            parts = match.group(1).split()
+            param_name = parts[-1]
+            try:
+                param_names.remove(param_name)
+            except ValueError:
+                # The docstring declares a parameter that is not type hinted. Just
+                # ignore it.
+                pass
+            if len(parts) == 1:
+                th = type_hints.get(param_name)
+                if th:
+                    type_ = json_type(th)
+                    lines[idx] = ":param {} {}:{}".format(
+                        type_, parts[0], match.group(2)
                     )
-                else:
-                    self.call_style = JsonRpcMethodCallStyle.ARRAY
-
-            node = addnodes.desc_parameter()
-
-            node += addnodes.desc_sig_name("", param.name)
-
-            if param.annotation is not param.empty:
-                ann = self._annotation(self.__type_hints[param.name])
-                node += nodes.Text(f": {ann}")
+        elif line.startswith(":rtype:"):
+            rtype_seen = True
+
+    # Add any missing parameters
+    for param_name in param_names:
+        lines.insert(
+            len(lines) - 1,
+            ":param {} {}:".format(json_type(type_hints[param_name]), param_name),
+        )
 
-            if param.default is not param.empty:
-                node += nodes.Text(f" [default={param.default}]")
+    # Insert the argument style
+    if param_start is not None:
+        lines.insert(param_start, ":paramstyle: {}".format(call_style.description()))
 
-            params += node
+    # Add return type if it's missing.
+    if not rtype_seen:
+        th = type_hints.get("return")
+        if th:
+            rtype = json_type(th)
+            lines.insert(len(lines) - 1, "")
+            lines.insert(len(lines) - 1, ":rtype: {}".format(rtype))
 
-        return params
+    return lines
 
-    def _parse_return(self) -> addnodes.desc_returns:
-        """ Convert the function's return to a node. """
-        if self.__inspect_sig.return_annotation is not self.__inspect_sig.empty:
-            return addnodes.desc_returns(
-                text=self._annotation(self.__type_hints["return"])
-            )
-        else:
-            return addnodes.desc_returns(text="null")
 
-    def _annotation(self, annotation):
-        """ Convert a Python data type into a JSON-ish type name. """
-        try:
-            return PYTHON_TO_JSON_TYPE[annotation]
-        except KeyError:
-            pass
-
-        if isinstance(annotation, type):
-            # Handle class references
-            return "{}.{}".format(annotation.__module__, annotation.__name__)
-        elif hasattr(annotation, "_name"):
-            # Handle the special typing.* types
-            if annotation._name == "List":
-                return "array of " + self._annotation(annotation.__args__[0])
-            elif annotation._name == "Dict":
-                return "object"
-            elif (
-                annotation._name is None
-                and annotation._inst
-                and annotation.__args__[1] is type(None)
-            ):
-                return "{} [optional]".format(self._annotation(annotation.__args__[0]))
-
-        logger.error("Cannot process annotation: %r", annotation)
-        return "unknown"
+def json_type(annotation) -> str:
+    """ Convert a Python data type into a JSON-ish type name. """
+    try:
+        return PYTHON_TO_JSON_TYPE[annotation]
+    except KeyError:
+        pass
+
+    if isinstance(annotation, type):
+        # Handle class references
+        return "{}.{}".format(annotation.__module__, annotation.__name__)
+    elif hasattr(annotation, "_name"):
+        # Handle the special typing.* types
+        if annotation._name == "List":
+            return "array of " + json_type(annotation.__args__[0])
+        elif annotation._name == "Dict":
+            return "object"
+        elif (
+            annotation._name is None
+            and annotation._inst
+            and annotation.__args__[1] is type(None)
+        ):
+            return "{} [optional]".format(json_type(annotation.__args__[0]))
+
+    logger.error("Cannot process annotation: %r", annotation)
+    return "unknown"
 
 
 class JsonRpcType(SphinxDirective):
@@ -323,6 +414,9 @@ class JsonRpcError(ObjectDescription):
         module_name = ".".join(module_parts)
         module = import_module(module_name)
         self.__class = getattr(module, class_name)
+        path = _source(self.__class)
+        if path is not None:
+            self.env.note_dependency(path)
         signode += [addnodes.desc_name(text=error_name)]
         return class_name
 
@@ -399,6 +493,21 @@ class JsonRpcDomain(Domain):
             0,
         )
 
+    def clear_doc(self, docname):
+        """ Forget the objects in a document that is about to be re-read. """
+        for key in ("errors", "methods"):
+            objects = self.data[key]
+            for name, obj in list(objects.items()):
+                if obj[2] == docname:
+                    del objects[name]
+
+    def merge_domaindata(self, docnames, otherdata):
+        """ Merge the objects found by a parallel read process. """
+        for key in ("errors", "methods"):
+            for name, obj in otherdata[key].items():
+                if obj[2] in docnames:
+                    self.data[key][name] = obj
+
     def get_objects(self):
         for name, err in self.data["errors"].items():
             yield (name, *err)
@@ -423,7 +532,31 @@ class JsonRpcDomain(Domain):
             )
 
 
+def init_handler_cache(app: Sphinx, env: BuildEnvironment, docnames) -> None:
+    """
+    Create the handler introspection cache. It is stored in the environment so that it
+    persists between incremental builds.
+    """
+    if not hasattr(env, "jsonrpc_handlers"):
+        env.jsonrpc_handlers = dict()
+
+
+def merge_handler_cache(
+    app: Sphinx, env: BuildEnvironment, docnames, other: BuildEnvironment
+) -> None:
+    """ Merge the handlers introspected by a parallel read process. """
+    env.jsonrpc_handlers.update(other.jsonrpc_handlers)
+
+
 def setup(app: Sphinx) -> typing.Dict[str, typing.Any]:
+    app.add_config_value("jsonrpc_dispatch", None, "env")
     app.add_domain(JsonRpcDomain)
-
-    return {"version": "0.1", "parallel_read_safe": True, "parallel_write_safe": True}
+    app.connect("env-before-read-docs", init_handler_cache)
+    app.connect("env-merge-info", merge_handler_cache)
+
+    return {
+        "version": "0.2",
+        "env_version": 1,
+        "parallel_read_safe": True,
+        "parallel_write_safe": True,
+    }
@@ -4,6 +4,10 @@ from abc import ABC, abstractmethod
 class BaseTransport(ABC):
     """ A base class for JSON-RPC transports. """
 
+    #: If True, the transport carries message objects instead of encoded bytes, and
+    #: the connection skips JSON serialization.
+    passes_objects = False
+
     @abstractmethod
     async def recv(self) -> bytes:
         """ Receive data from the transport. """
@@ -12,6 +16,13 @@ class BaseTransport(ABC):
     async def send(self, data: bytes):
         """ Send data through the transport."""
 
+    async def ping(self) -> None:
+        """
+        Check that the peer is alive, e.g. with a WebSocket ping, and return when it
+        answers. The default implementation returns immediately, for transports that
+        have no way to do this.
+        """
+
 
 class TransportClosed(Exception):
     pass
@@ -0,0 +1,186 @@
+"""
+This module contains an opt-in recorder that captures the frames sent and received by
+any transport, so that production traffic can be replayed later (see
+:mod:`trio_jsonrpc.replay`).
+
+A capture file is append-only. It starts with a short header, followed by one record
+per frame: a fixed-size record header (the time, the connection number, the kind of
+record, and the length of the frame), then the frame's bytes exactly as they were sent
+or received. Records are written to a buffered file, so recording a frame costs a
+memory copy, and the buffer is flushed to disk when it fills up or the capture is
+closed.
+"""
+from dataclasses import dataclass
+import enum
+from itertools import count
+import os
+import struct
+import time
+import typing
+
+import trio
+
+from . import BaseTransport
+
+
+MAGIC = b"TJRPCAP1"
+# Time, connection number, kind, and frame length.
+RECORD = struct.Struct("<dIBI")
+
+
+class RecordKind(enum.IntEnum):
+    """ The kind of a record in a capture file. """
+
+    #: A frame that the connection received.
+    RECV = 0
+    #: A frame that the connection sent.
+    SEND = 1
+    #: A client connection was opened, so its requests are the frames it sent.
+    OPEN_CLIENT = 2
+    #: A server connection was opened, so its requests are the frames it received.
+    OPEN_SERVER = 3
+
+
+@dataclass
+class Frame:
+    """ A record read from a capture file. """
+
+    #: The wall clock time when the frame was recorded, in seconds since the epoch.
+    time: float
+    #: The number of the connection within its capture.
+    connection: int
+    kind: RecordKind
+    data: bytes
+
+
+class CaptureFile:
+    """
+    Records the frames of one or more transports to a capture file.
+
+    .. code:: python3
+
+        with CaptureFile("traffic.cap") as capture:
+            ...
+            transport = capture.wrap(WebSocketTransport(ws))
+            rpc_conn = JsonRpcConnection(transport, JsonRpcConnectionType.SERVER)
+
+    If the file already exists, new records are appended to it, and connections are
+    numbered after the ones that are already in the file. A record that was cut off at
+    the end of the file, e.g. because the process that wrote it crashed, is discarded
+    first.
+    """
+
+    def __init__(self, path: str, buffer_size: int = 1 << 20):
+        """
+        Constructor.
+
+        :param path: The path of the capture file.
+        :param buffer_size: The number of bytes to buffer before writing to disk.
+        """
+        first_connection = 0
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            first_connection, length = _scan(path)
+            os.truncate(path, length)
+        self._file = open(path, "ab", buffering=buffer_size)
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        self._connections = count(first_connection)
+        # Times are taken from the Trio clock, so that they are monotonic, and then
+        # converted to wall clock time, so that captures from different runs line up.
+        self._offset = time.time() - trio.current_time()
+
+    def __enter__(self) -> "CaptureFile":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def wrap(self, transport: BaseTransport, is_client: bool = False) -> BaseTransport:
+        """
+        Wrap a transport so that each frame it sends or receives is recorded.
+
+        :param transport: A transport that carries bytes.
+        :param is_client: True if the transport belongs to a client connection.
+        """
+        if transport.passes_objects:
+            raise ValueError("Only a transport that carries bytes can be captured.")
+        connection = next(self._connections)
+        kind = RecordKind.OPEN_CLIENT if is_client else RecordKind.OPEN_SERVER
+        self.record(connection, kind, b"")
+        return CaptureTransport(transport, self, connection)
+
+    def record(self, connection: int, kind: RecordKind, data: bytes) -> None:
+        """ Append a record to the capture. """
+        if isinstance(data, str):
+            data = data.encode("utf8")
+        now = self._offset + trio.current_time()
+        self._file.write(RECORD.pack(now, connection, kind, len(data)))
+        self._file.write(data)
+
+    def flush(self) -> None:
+        """ Write buffered records to disk. """
+        self._file.flush()
+
+    def close(self) -> None:
+        """ Write buffered records to disk and close the file. """
+        self._file.close()
+
+
+class CaptureTransport(BaseTransport):
+    """ A transport that records each frame to a :class:`CaptureFile`. """
+
+    def __init__(self, transport: BaseTransport, capture: CaptureFile, connection: int):
+        self._transport = transport
+        self._capture = capture
+        self._connection = connection
+
+    async def recv(self) -> bytes:
+        data = await self._transport.recv()
+        self._capture.record(self._connection, RecordKind.RECV, data)
+        return data
+
+    async def send(self, data: bytes) -> None:
+        self._capture.record(self._connection, RecordKind.SEND, data)
+        return await self._transport.send(data)
+
+    async def ping(self) -> None:
+        await self._transport.ping()
+
+
+def read_capture(path: str) -> typing.Iterator[Frame]:
+    """
+    Read the records from a capture file.
+
+    A record that was cut off, e.g. because the process that wrote it crashed, ends
+    the capture.
+    """
+    for frame, _ in _iter_records(path):
+        yield frame
+
+
+def _iter_records(path: str) -> typing.Iterator[typing.Tuple[Frame, int]]:
+    """ Yield each complete record with the file offset where it ends. """
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a capture file.")
+        while True:
+            header = file.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            time_, connection, kind, length = RECORD.unpack(header)
+            data = file.read(length)
+            if len(data) < length:
+                return
+            yield Frame(time_, connection, RecordKind(kind), data), file.tell()
+
+
+def _scan(path: str) -> typing.Tuple[int, int]:
+    """
+    Return the number after the highest connection number in a capture file, and the
+    length of the file up to the end of its last complete record.
+    """
+    next_connection = 0
+    length = len(MAGIC)
+    for frame, length in _iter_records(path):
+        next_connection = max(next_connection, frame.connection + 1)
+    return next_connection, length
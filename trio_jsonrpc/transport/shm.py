@@ -0,0 +1,398 @@
+"""
+A transport for processes on the same host that exchanges messages through a pair of
+ring buffers in shared memory.
+
+The shared memory is a file mapped into both processes with :mod:`mmap`, ideally on a
+``tmpfs`` such as ``/dev/shm``. Each direction has its own single-producer,
+single-consumer ring buffer, so sending a message is a copy into shared memory rather
+than a system call. Messages are framed with a 4-byte length prefix.
+
+When a receiver finds its ring buffer empty (or a sender finds it full), it sets a flag
+in the ring header and sleeps until the other process rings a "doorbell": a named pipe
+that Trio can wait on. The doorbell is only rung when the flag is set, so a busy
+connection makes no system calls at all. Python does not provide memory barriers, so in
+rare cases a doorbell can be missed. As a safety net, a sleeping task re-checks its
+ring buffer every ``poll_interval`` seconds.
+
+The lack of memory barriers also means that the ring buffers rely on the processor to
+make stores to shared memory visible to the other process in the order they were made,
+so that a reader never sees a frame's length before its contents. x86-64 guarantees
+this, but weakly ordered processors such as ARM do not, and a reader there could read a
+torn frame. This transport is therefore only supported on x86-64.
+
+Each process records its PID in the shared memory. If the peer process exits without
+closing the transport, e.g. because it crashed, a sleeping task notices when it
+re-checks its ring buffer and raises :exc:`TransportClosed`. This only works if both
+processes are in the same PID namespace, and in the unlikely case that the peer's PID
+is reused by a new process before the check, the transport is not closed.
+
+Many tasks may send or receive on the same transport at once, but only one task at a
+time can wait on a doorbell. Each direction has a lock, and a task that finds the lock
+held waits its turn, which also keeps messages in order.
+
+This transport requires a Unix-like operating system on x86-64.
+"""
+import errno
+import mmap
+import os
+import struct
+import typing
+
+import trio
+
+from . import BaseTransport, TransportClosed
+
+
+# The ring header is: head (u64), tail (u64), reader waiting (u8), writer waiting (u8),
+# closed (u8), padded to 64 bytes so that the data area is aligned.
+_HEADER_SIZE = 64
+_HEAD = 0
+_TAIL = 8
+_READER_WAITING = 16
+_WRITER_WAITING = 17
+_CLOSED = 18
+_U64 = struct.Struct("<Q")
+_FRAME = struct.Struct("<I")
+# The file starts with the capacity of each ring buffer (u64), the server's PID (u64),
+# and the client's PID (u64, 0 until the client connects), padded to 64 bytes.
+_FILE_HEADER = struct.Struct("<Q")
+_FILE_HEADER_SIZE = 64
+_SERVER_PID = 8
+_CLIENT_PID = 16
+
+
+class RingBuffer:
+    """
+    A single-producer, single-consumer ring buffer of length-prefixed frames.
+
+    The head and tail are byte counters that only ever increase: the producer advances
+    the head and the consumer advances the tail, so neither ever writes to a field that
+    the other one writes.
+    """
+
+    def __init__(self, buf: memoryview, capacity: int):
+        """
+        Constructor.
+
+        :param buf: A view of the ring header followed by ``capacity`` bytes of data.
+        :param capacity: The size of the data area.
+        """
+        self._buf = buf
+        self._data = buf[_HEADER_SIZE : _HEADER_SIZE + capacity]
+        self.capacity = capacity
+
+    @property
+    def max_message_size(self) -> int:
+        """ The largest message that fits in the buffer. """
+        return self.capacity - _FRAME.size
+
+    def _get(self, offset: int) -> int:
+        return self._buf[offset]
+
+    def _set(self, offset: int, value: int) -> None:
+        self._buf[offset] = value
+
+    reader_waiting = property(
+        lambda self: self._get(_READER_WAITING),
+        lambda self, value: self._set(_READER_WAITING, value),
+    )
+    writer_waiting = property(
+        lambda self: self._get(_WRITER_WAITING),
+        lambda self, value: self._set(_WRITER_WAITING, value),
+    )
+    closed = property(
+        lambda self: self._get(_CLOSED), lambda self, value: self._set(_CLOSED, value),
+    )
+
+    def try_write(self, data: bytes) -> bool:
+        """ Write a frame if there is enough free space and return True if it fit. """
+        size = _FRAME.size + len(data)
+        if size > self.capacity:
+            raise ValueError(
+                f"Message of {len(data)} bytes is larger than the maximum message size "
+                f"({self.max_message_size} bytes)"
+            )
+        head = _U64.unpack_from(self._buf, _HEAD)[0]
+        tail = _U64.unpack_from(self._buf, _TAIL)[0]
+        if self.capacity - (head - tail) < size:
+            return False
+        self._copy_in(head, _FRAME.pack(len(data)))
+        self._copy_in(head + _FRAME.size, data)
+        # Publish the frame only after its contents are written. This relies on the
+        # processor not reordering the stores, which x86-64 guarantees.
+        _U64.pack_into(self._buf, _HEAD, head + size)
+        return True
+
+    def try_read(self) -> typing.Optional[bytes]:
+        """ Read a frame, or return None if the buffer is empty. """
+        head = _U64.unpack_from(self._buf, _HEAD)[0]
+        tail = _U64.unpack_from(self._buf, _TAIL)[0]
+        if head == tail:
+            return None
+        (length,) = _FRAME.unpack(self._copy_out(tail, _FRAME.size))
+        data = self._copy_out(tail + _FRAME.size, length)
+        _U64.pack_into(self._buf, _TAIL, tail + _FRAME.size + length)
+        return data
+
+    def _copy_in(self, position: int, data: bytes) -> None:
+        start = position % self.capacity
+        first = min(len(data), self.capacity - start)
+        self._data[start : start + first] = data[:first]
+        if first < len(data):
+            self._data[: len(data) - first] = data[first:]
+
+    def _copy_out(self, position: int, length: int) -> bytes:
+        start = position % self.capacity
+        first = min(length, self.capacity - start)
+        data = bytes(self._data[start : start + first])
+        if first < length:
+            data += bytes(self._data[: length - first])
+        return data
+
+    def release(self) -> None:
+        """ Release the views of shared memory. """
+        self._data.release()
+        self._buf.release()
+
+
+class _Doorbell:
+    """ A named pipe that one process writes to in order to wake up the other. """
+
+    def __init__(self, path: str):
+        # Opening a FIFO read-write never blocks and never fails for lack of a peer.
+        self._fd: typing.Optional[int] = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+
+    def ring(self) -> None:
+        fd = self._fd
+        if fd is None:
+            return
+        try:
+            os.write(fd, b"\0")
+        except BlockingIOError:
+            # The pipe is full, so the peer has plenty of wakeups pending already.
+            pass
+
+    async def wait(self, timeout: float) -> bool:
+        """ Wait until the doorbell rings, and return False if the timeout expired. """
+        fd = self._fd
+        if fd is None:
+            return True
+        with trio.move_on_after(timeout) as cancel_scope:
+            try:
+                await trio.lowlevel.wait_readable(fd)
+            except trio.ClosedResourceError:
+                return True
+        # The doorbell may have been closed by another task while this task was waking
+        # up.
+        if self._fd is None:
+            return True
+        if cancel_scope.cancelled_caught:
+            return False
+        try:
+            while os.read(fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self) -> None:
+        fd, self._fd = self._fd, None
+        if fd is None:
+            return
+        trio.lowlevel.notify_closing(fd)
+        os.close(fd)
+
+
+class SharedMemoryTransport(BaseTransport):
+    """
+    A transport between two processes on the same host, using ring buffers in shared
+    memory. One process calls :meth:`create` and the other calls :meth:`connect` with
+    the same path. Each pair of transports carries exactly one connection.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        send_name: str,
+        recv_name: str,
+        capacity: int,
+        poll_interval: float,
+    ):
+        self._path = path
+        self._poll_interval = poll_interval
+        with open(path + ".ring", "r+b") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0)
+        self._view = view = memoryview(self._mmap)
+        rings = {
+            "c2s": RingBuffer(
+                view[_FILE_HEADER_SIZE : _FILE_HEADER_SIZE + _HEADER_SIZE + capacity],
+                capacity,
+            ),
+            "s2c": RingBuffer(
+                view[_FILE_HEADER_SIZE + _HEADER_SIZE + capacity :], capacity
+            ),
+        }
+        self._send_ring = rings[send_name]
+        self._recv_ring = rings[recv_name]
+        if send_name == "s2c":
+            _U64.pack_into(view, _SERVER_PID, os.getpid())
+            self._peer_pid_offset = _CLIENT_PID
+        else:
+            _U64.pack_into(view, _CLIENT_PID, os.getpid())
+            self._peer_pid_offset = _SERVER_PID
+        # The "data" doorbell wakes the receiver and the "space" doorbell wakes the
+        # sender.
+        self._send_data = _Doorbell(f"{path}.{send_name}.data")
+        self._send_space = _Doorbell(f"{path}.{send_name}.space")
+        self._recv_data = _Doorbell(f"{path}.{recv_name}.data")
+        self._recv_space = _Doorbell(f"{path}.{recv_name}.space")
+        self._send_lock = trio.Lock()
+        self._recv_lock = trio.Lock()
+        self._closed = False
+
+    @classmethod
+    def create(
+        cls, path: str, capacity: int = 4 * 1024 * 1024, poll_interval: float = 0.05
+    ) -> "SharedMemoryTransport":
+        """
+        Create the shared memory and doorbells, and return the server side transport.
+
+        :param path: The path prefix for the files that are created, e.g.
+            ``/dev/shm/myapp``.
+        :param capacity: The size of each ring buffer in bytes. A message must be
+            slightly smaller than this.
+        :param poll_interval: The safety net interval for missed wakeups.
+        """
+        size = _FILE_HEADER_SIZE + 2 * (_HEADER_SIZE + capacity)
+        with open(path + ".ring", "wb") as file:
+            file.truncate(size)
+            file.write(_FILE_HEADER.pack(capacity))
+        for name in ("c2s.data", "c2s.space", "s2c.data", "s2c.space"):
+            try:
+                os.mkfifo(f"{path}.{name}")
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+        return cls(path, "s2c", "c2s", capacity, poll_interval)
+
+    @classmethod
+    def connect(
+        cls, path: str, poll_interval: float = 0.05
+    ) -> "SharedMemoryTransport":
+        """
+        Return the client side transport for shared memory created by :meth:`create`.
+        """
+        with open(path + ".ring", "rb") as file:
+            (capacity,) = _FILE_HEADER.unpack(file.read(_FILE_HEADER.size))
+        return cls(path, "c2s", "s2c", capacity, poll_interval)
+
+    async def recv(self) -> bytes:
+        ring = self._recv_ring
+        peer_exited = False
+        await trio.lowlevel.checkpoint_if_cancelled()
+        await _acquire(self._recv_lock)
+        try:
+            while True:
+                if self._closed:
+                    raise TransportClosed()
+                data = ring.try_read()
+                if data is None:
+                    if ring.closed or peer_exited:
+                        raise TransportClosed()
+                    ring.reader_waiting = 1
+                    # Check again in case the sender wrote before it saw the flag.
+                    data = ring.try_read()
+                if data is not None:
+                    ring.reader_waiting = 0
+                    if ring.writer_waiting:
+                        ring.writer_waiting = 0
+                        self._recv_space.ring()
+                    break
+                if not await self._recv_data.wait(self._poll_interval):
+                    # Read any messages that the peer sent before it exited.
+                    peer_exited = not self._peer_alive()
+        finally:
+            self._recv_lock.release()
+        await trio.lowlevel.cancel_shielded_checkpoint()
+        return data
+
+    async def send(self, data: bytes) -> None:
+        ring = self._send_ring
+        peer_exited = False
+        await trio.lowlevel.checkpoint_if_cancelled()
+        await _acquire(self._send_lock)
+        try:
+            while True:
+                if self._closed or ring.closed or peer_exited:
+                    raise TransportClosed()
+                sent = ring.try_write(data)
+                if not sent:
+                    ring.writer_waiting = 1
+                    # Check again in case the receiver read before it saw the flag.
+                    sent = ring.try_write(data)
+                if sent:
+                    ring.writer_waiting = 0
+                    if ring.reader_waiting:
+                        ring.reader_waiting = 0
+                        self._send_data.ring()
+                    break
+                if not await self._send_space.wait(self._poll_interval):
+                    peer_exited = not self._peer_alive()
+        finally:
+            self._send_lock.release()
+        await trio.lowlevel.cancel_shielded_checkpoint()
+
+    def _peer_alive(self) -> bool:
+        """ Return False if the peer process has exited. """
+        pid = _U64.unpack_from(self._view, self._peer_pid_offset)[0]
+        if pid == 0:
+            # The client hasn't connected yet.
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            # The process exists, but it belongs to another user.
+            pass
+        return True
+
+    def close(self) -> None:
+        """
+        Close the transport. The peer can still receive the messages that were already
+        sent, and then it gets :exc:`TransportClosed`.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._send_ring.closed = 1
+        self._recv_ring.closed = 1
+        self._send_data.ring()
+        self._recv_space.ring()
+        for doorbell in (
+            self._send_data,
+            self._send_space,
+            self._recv_data,
+            self._recv_space,
+        ):
+            doorbell.close()
+        self._send_ring.release()
+        self._recv_ring.release()
+        self._view.release()
+        self._mmap.close()
+
+    def unlink(self) -> None:
+        """ Remove the files created by :meth:`create`. """
+        for suffix in ("ring", "c2s.data", "c2s.space", "s2c.data", "s2c.space"):
+            try:
+                os.unlink(f"{self._path}.{suffix}")
+            except FileNotFoundError:
+                pass
+
+
+async def _acquire(lock: trio.Lock) -> None:
+    """ Acquire a lock, without a checkpoint if it is free. """
+    try:
+        lock.acquire_nowait()
+    except trio.WouldBlock:
+        await lock.acquire()
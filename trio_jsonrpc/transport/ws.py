@@ -18,3 +18,9 @@ class WebSocketTransport(BaseTransport):
             return await self._ws.send_message(data)
         except ConnectionClosed:
             raise TransportClosed()
+
+    async def ping(self) -> None:
+        try:
+            await self._ws.ping()
+        except ConnectionClosed:
+            raise TransportClosed()
@@ -0,0 +1,168 @@
+"""
+This module contains an opt-in watchdog that detects handlers which block the Trio event
+loop, i.e. run for a long time without yielding to the scheduler.
+
+Trio can only switch tasks at checkpoints, so a handler that runs CPU-bound code or
+calls a blocking function stalls every other connection until it returns. The watchdog
+has two parts:
+
+* A :class:`trio.abc.Instrument` that records which task is currently running and since
+  when. A monitor thread checks it periodically, and if a handler task has been running
+  for longer than the threshold, it logs the method name, a summary of the params, and
+  the handler's current stack.
+* A probe task that sleeps for a fixed interval and records how late it wakes up. This
+  scheduler lag is recorded in a :class:`~trio_jsonrpc.metrics.Histogram`.
+"""
+from contextlib import contextmanager
+import logging
+import reprlib
+import sys
+import threading
+import time
+import traceback
+import typing
+
+from sansio_jsonrpc import JsonRpcRequest
+import trio
+
+from .metrics import Histogram
+
+
+logger = logging.getLogger(__name__)
+_params_repr = reprlib.Repr()
+_params_repr.maxstring = 40
+_params_repr.maxother = 40
+
+
+class Watchdog(trio.abc.Instrument):
+    """
+    Detects handlers that block the event loop and measures scheduler lag.
+
+    Pass the watchdog to :class:`~trio_jsonrpc.Dispatch` so that it knows which task is
+    running which request, then start :meth:`run` in a nursery:
+
+    .. code:: python3
+
+        watchdog = Watchdog(threshold=0.1)
+        dispatch = Dispatch(watchdog=watchdog)
+
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(watchdog.run)
+            ...
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.1,
+        lag_interval: float = 0.1,
+        check_interval: typing.Optional[float] = None,
+    ):
+        """
+        Constructor.
+
+        :param threshold: A handler that runs for longer than this many seconds without
+            yielding is flagged.
+        :param lag_interval: How often to measure scheduler lag, in seconds.
+        :param check_interval: How often the monitor thread checks the running task, in
+            seconds. Defaults to a quarter of ``threshold``.
+        """
+        self.threshold = threshold
+        self.lag_interval = lag_interval
+        self.check_interval = (
+            check_interval if check_interval is not None else threshold / 4
+        )
+        #: Scheduler lag, i.e. how much later than scheduled a sleeping task wakes up.
+        self.lag = Histogram()
+        #: The duration of each handler step that exceeded the threshold.
+        self.slow_steps = Histogram()
+        self._requests: typing.Dict[trio.lowlevel.Task, JsonRpcRequest] = dict()
+        # The handler step that is currently running as a tuple of (task, request,
+        # start time), or None. This is written by the Trio thread and read by the
+        # monitor thread, so it is only ever replaced, never mutated.
+        self._step: typing.Optional[tuple] = None
+        self._reported: typing.Optional[tuple] = None
+        self._trio_thread_id: typing.Optional[int] = None
+
+    @contextmanager
+    def watch(self, request: JsonRpcRequest) -> typing.Iterator[None]:
+        """ Associate the current task with a request while the block executes. """
+        task = trio.lowlevel.current_task()
+        self._requests[task] = request
+        if self._trio_thread_id is not None:
+            # The task is already running, so before_task_step() missed this step.
+            self._step = (task, request, time.perf_counter())
+        try:
+            yield
+        finally:
+            del self._requests[task]
+
+    async def run(self) -> None:
+        """
+        Run the watchdog until cancelled.
+
+        This installs the instrument, starts the monitor thread, and measures scheduler
+        lag in the current task.
+        """
+        self._trio_thread_id = threading.get_ident()
+        stop = threading.Event()
+        monitor = threading.Thread(
+            target=self._monitor,
+            args=(stop,),
+            name="trio-jsonrpc-watchdog",
+            daemon=True,
+        )
+        trio.lowlevel.add_instrument(self)
+        monitor.start()
+        try:
+            while True:
+                deadline = trio.current_time() + self.lag_interval
+                await trio.sleep_until(deadline)
+                self.lag.record(max(0.0, trio.current_time() - deadline))
+        finally:
+            trio.lowlevel.remove_instrument(self)
+            self._trio_thread_id = None
+            self._step = None
+            stop.set()
+            monitor.join()
+
+    def before_task_step(self, task: trio.lowlevel.Task) -> None:
+        request = self._requests.get(task)
+        if request is not None:
+            self._step = (task, request, time.perf_counter())
+
+    def after_task_step(self, task: trio.lowlevel.Task) -> None:
+        step = self._step
+        if step is None:
+            return
+        self._step = None
+        elapsed = time.perf_counter() - step[2]
+        if elapsed > self.threshold:
+            self.slow_steps.record(elapsed)
+            if step is self._reported:
+                logger.warning(
+                    'Handler "%s" yielded after blocking for %0.3fs',
+                    step[1].method,
+                    elapsed,
+                )
+
+    def _monitor(self, stop: threading.Event) -> None:
+        """ The monitor thread flags each slow step once, while it is still running. """
+        while not stop.wait(self.check_interval):
+            step = self._step
+            if step is None or step is self._reported:
+                continue
+            elapsed = time.perf_counter() - step[2]
+            if elapsed <= self.threshold:
+                continue
+            self._reported = step
+            thread_id = self._trio_thread_id
+            frame = None if thread_id is None else sys._current_frames().get(thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else ""
+            _, request, _ = step
+            logger.warning(
+                'Handler "%s" has blocked the event loop for %0.3fs (params=%s)\n%s',
+                request.method,
+                elapsed,
+                _params_repr.repr(request.params),
+                stack,
+            )
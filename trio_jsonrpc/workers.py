@@ -0,0 +1,276 @@
+"""
+This module contains a pool of long-lived worker tasks for dispatching requests.
+
+The simplest way to dispatch requests is to start a new task for each one, which costs
+a task allocation and a trip through Trio's scheduler before the handler runs. A
+:class:`WorkerPool` instead keeps a set of worker tasks that take requests from a
+bounded queue, so a busy server reuses its tasks. The pool can be a fixed size, or it
+can grow when every worker is busy and shrink again when workers are idle.
+"""
+import contextvars
+from itertools import count
+import logging
+import math
+import typing
+
+from sansio_jsonrpc import JsonRpcRequest
+import trio
+
+from .dispatch import _connection_key, cancelled_request_id
+from .exc import JsonRpcRequestCancelledError, JsonRpcServerShuttingDownError
+from .main import CANCEL_REQUEST_METHOD
+from .metrics import Histogram
+
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerStats:
+    """ Statistics for one worker task. """
+
+    __slots__ = ("id", "started", "requests", "busy_time", "busy")
+
+    def __init__(self, id_: int, started: float):
+        #: A number that identifies the worker.
+        self.id = id_
+        #: The Trio time when the worker started.
+        self.started = started
+        #: The number of requests that the worker has handled.
+        self.requests = 0
+        #: The total time that the worker has spent handling requests, in seconds.
+        self.busy_time = 0.0
+        #: True if the worker is handling a request right now.
+        self.busy = False
+
+
+class WorkerPool:
+    """
+    A pool of long-lived tasks that run handlers.
+
+    Requests are queued by :meth:`submit` and handled by the workers that :meth:`run`
+    starts. The pool starts ``min_workers`` workers. When a request is submitted and no
+    worker is free, another worker is started, up to ``max_workers``. A worker beyond
+    ``min_workers`` exits after it has been idle for ``idle_timeout`` seconds.
+
+    .. code:: python3
+
+        pool = WorkerPool(dispatch, min_workers=16, max_workers=256)
+
+        async with trio.open_nursery() as nursery:
+            await nursery.start(pool.run)
+            ...
+            async for request in rpc_conn.iter_requests():
+                await pool.submit(request, result_send)
+
+    Each worker handles many requests, so a context variable that a handler or
+    middleware sets is still set when the same worker handles its next request. The
+    context variables of the task that called :meth:`submit`, such as the connection
+    context, are set for each request and reset afterwards.
+    """
+
+    def __init__(
+        self,
+        dispatch,
+        min_workers: int = 16,
+        max_workers: typing.Optional[int] = None,
+        max_queued: int = 1024,
+        idle_timeout: float = 10.0,
+    ):
+        """
+        Constructor.
+
+        :param dispatch: The :class:`~trio_jsonrpc.Dispatch` that handles requests.
+        :param min_workers: The number of workers that are always running.
+        :param max_workers: The maximum number of workers. Defaults to
+            ``min_workers``, i.e. a fixed size pool.
+        :param max_queued: The maximum number of requests that wait for a worker.
+            :meth:`submit` blocks while the queue is full.
+        :param idle_timeout: A worker beyond ``min_workers`` exits after this many
+            seconds without a request.
+        """
+        if max_workers is None:
+            max_workers = min_workers
+        if not 1 <= min_workers <= max_workers:
+            raise ValueError("The pool size must satisfy 1 <= min <= max.")
+        self._dispatch = dispatch
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.idle_timeout = idle_timeout
+        self._send, self._recv = trio.open_memory_channel(max_queued)
+        # Maps (connection, request ID) of each queued request to True if it was
+        # cancelled while it waited.
+        self._queued_ids: typing.Dict[tuple, bool] = dict()
+        self._nursery: typing.Optional[trio.Nursery] = None
+        self._workers: typing.Dict[int, WorkerStats] = dict()
+        self._worker_ids = count()
+        # The number of workers that have been started but have not asked for a request
+        # yet. They are about to be free, so they don't need to be replaced.
+        self._starting = 0
+        #: How long each request waited for a worker, in seconds.
+        self.queue_delay = Histogram()
+
+    @property
+    def size(self) -> int:
+        """ The number of workers. """
+        return len(self._workers)
+
+    @property
+    def idle(self) -> int:
+        """ The number of workers that are waiting for a request. """
+        return self._recv.statistics().tasks_waiting_receive
+
+    @property
+    def queued(self) -> int:
+        """ The number of requests waiting for a worker. """
+        return self._send.statistics().current_buffer_used
+
+    @property
+    def workers(self) -> typing.List[WorkerStats]:
+        """ The statistics for each worker that is running. """
+        return list(self._workers.values())
+
+    async def submit(
+        self, request: JsonRpcRequest, result_channel: trio.abc.SendChannel
+    ) -> None:
+        """
+        Queue a request to be handled by a worker.
+
+        The result is sent to ``result_channel`` in the same way as
+        :meth:`Dispatch.handle_request`. A :data:`~trio_jsonrpc.CANCEL_REQUEST_METHOD`
+        notification is not queued; it immediately cancels the matching handler on the
+        same connection, or if that request is still queued, its result is a
+        :class:`~trio_jsonrpc.JsonRpcRequestCancelledError` when a worker takes it.
+        While the dispatch is draining, new requests are not queued, and their result
+        is a :class:`~trio_jsonrpc.JsonRpcServerShuttingDownError`.
+        """
+        if request.method == CANCEL_REQUEST_METHOD:
+            self._cancel(cancelled_request_id(request), result_channel)
+            return
+        try:
+            self._dispatch.admit(request)
+        except JsonRpcServerShuttingDownError as exc:
+            await result_channel.send((request, exc))
+            return
+        if (
+            self._nursery is not None
+            and self._starting == 0
+            and len(self._workers) < self.max_workers
+            and self.idle == 0
+        ):
+            self._start_worker()
+        key = None
+        if not request.is_notification:
+            key = (_connection_key(result_channel), request.id)
+            self._queued_ids[key] = False
+        job = (
+            request,
+            result_channel,
+            contextvars.copy_context(),
+            trio.current_time(),
+            key,
+        )
+        try:
+            await self._send.send(job)
+        except BaseException:
+            if key is not None:
+                self._queued_ids.pop(key, None)
+            self._dispatch.release()
+            raise
+
+    async def run(self, *, task_status=trio.TASK_STATUS_IGNORED) -> None:
+        """ Run the workers until cancelled. """
+        async with trio.open_nursery() as nursery:
+            self._nursery = nursery
+            try:
+                for _ in range(self.min_workers):
+                    self._start_worker()
+                task_status.started()
+                await trio.sleep_forever()
+            finally:
+                self._nursery = None
+
+    def _cancel(
+        self, request_id: typing.Any, result_channel: trio.abc.SendChannel
+    ) -> None:
+        """ Cancel a running or queued request on the current connection. """
+        if request_id is None:
+            return
+        if self._dispatch.cancel_request(request_id, result_channel):
+            return
+        key = (_connection_key(result_channel), request_id)
+        try:
+            if key in self._queued_ids:
+                self._queued_ids[key] = True
+        except TypeError:
+            # The request ID is not valid JSON-RPC, so no request has it.
+            pass
+
+    def _start_worker(self) -> None:
+        stats = WorkerStats(next(self._worker_ids), trio.current_time())
+        self._workers[stats.id] = stats
+        self._starting += 1
+        nursery = self._nursery
+        assert nursery is not None
+        nursery.start_soon(self._worker, stats)
+
+    async def _worker(self, stats: WorkerStats) -> None:
+        """ Handle requests from the queue until idle for too long. """
+        starting = True
+        try:
+            while True:
+                timeout = (
+                    self.idle_timeout
+                    if len(self._workers) > self.min_workers
+                    else math.inf
+                )
+                if starting:
+                    self._starting -= 1
+                    starting = False
+                job = None
+                with trio.move_on_after(timeout):
+                    job = await self._recv.receive()
+                if job is None:
+                    if len(self._workers) > self.min_workers:
+                        return
+                    continue
+                request, result_channel, context, submitted, key = job
+                cancelled = self._queued_ids.pop(key, False)
+                start = trio.current_time()
+                self.queue_delay.record(start - submitted)
+                stats.busy = True
+                tokens = [var.set(value) for var, value in context.items()]
+                try:
+                    if cancelled:
+                        await self._reject(request, result_channel)
+                    else:
+                        await self._dispatch.handle_request(
+                            request, result_channel, admitted=True
+                        )
+                except (trio.BrokenResourceError, trio.ClosedResourceError):
+                    logger.debug("Discarding result for request.id=%s", request.id)
+                except Exception:
+                    # The workers share a nursery, so a failure in one request must not
+                    # escape and cancel every other worker.
+                    logger.exception("Unhandled exception in request.id=%s", request.id)
+                finally:
+                    for token in reversed(tokens):
+                        token.var.reset(token)
+                    stats.busy = False
+                    stats.requests += 1
+                    stats.busy_time += trio.current_time() - start
+        finally:
+            if starting:
+                self._starting -= 1
+            del self._workers[stats.id]
+
+    async def _reject(
+        self, request: JsonRpcRequest, result_channel: trio.abc.SendChannel
+    ) -> None:
+        """ Send an error for a request that was cancelled while it was queued. """
+        try:
+            error = JsonRpcRequestCancelledError(
+                f'Request for method "{request.method}" was cancelled.'
+            )
+            await result_channel.send((request, error))
+        finally:
+            self._dispatch.release()